@@ -4,11 +4,13 @@
 # 
 import os
 import configparser
-from auroraCam import setupLogging, freeSpaceAndArchive
+import platform
+from auroraCam import setupLogging, freeSpaceAndArchive, s3details
 
 if __name__ == '__main__':
     thiscfg = configparser.ConfigParser()
     local_path = os.path.dirname(os.path.abspath(__file__))
     thiscfg.read(os.path.join(local_path, 'config.ini'))
     setupLogging(thiscfg, 'archive_')
-    freeSpaceAndArchive(thiscfg)
+    s3, bucket, s3prefix = s3details(thiscfg, platform.uname().node)
+    freeSpaceAndArchive(thiscfg, s3, bucket, s3prefix)
@@ -0,0 +1,141 @@
+# Copyright (C) Mark McIntyre
+#
+# Compress data folders into zip archives, several at a time
+#
+import os
+import glob
+import time
+import shutil
+import zipfile
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+log = logging.getLogger("logger")
+
+# these are already compressed so deflating them just wastes CPU
+storedexts = ('.jpg', '.jpeg', '.png', '.mp4', '.zip', '.gz', '.tgz')
+
+
+def folderSize(srcdir):
+    """ total size in bytes of the files in a folder """
+    total = 0
+    for root, _, files in os.walk(srcdir):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+def archiveFolder(srcdir, archname=None):
+    """
+    Zip a folder, storing already-compressed files such as JPEGs without recompressing them.
+
+    The archive is written to a temporary name and renamed when it is complete, so a zip
+    file with the final name is always a finished archive. If one already exists, for
+    example because we crashed after creating it but before deleting the folder, it is
+    kept and the folder is not compressed again.
+
+    Parameters:
+        srcdir      [string] - the folder to archive
+        archname    [string] - the archive to create, default srcdir + '.zip'
+
+    Returns:
+        (archname, bytes read, seconds taken)
+    """
+    srcdir = os.path.normpath(srcdir)
+    if archname is None:
+        archname = srcdir + '.zip'
+    if os.path.isfile(archname):
+        return archname, 0, 0.0
+    starttime = time.monotonic()
+    tmpname = archname + '.tmp'
+    with zipfile.ZipFile(tmpname, 'w', allowZip64=True) as zf:
+        nbytes = _addFolder(zf, srcdir)
+    os.replace(tmpname, archname)
+    return archname, nbytes, time.monotonic() - starttime
+
+
+def _addFolder(zf, srcdir):
+    """ add the contents of a folder to an open zip file, returning the bytes read """
+    nbytes = 0
+    for root, dirs, files in os.walk(srcdir):
+        dirs.sort()
+        for f in sorted(files):
+            fullname = os.path.join(root, f)
+            if os.path.splitext(f)[1].lower() in storedexts:
+                ctype = zipfile.ZIP_STORED
+            else:
+                ctype = zipfile.ZIP_DEFLATED
+            zf.write(fullname, os.path.relpath(fullname, srcdir), compress_type=ctype)
+            nbytes += os.path.getsize(fullname)
+    return nbytes
+
+
+def streamFolder(srcdir, outf):
+    """
+    Write a zip of a folder to a file-like object, such as an upload stream, without
+    creating the archive on disk. outf only needs write and flush methods, so it doesn't
+    have to be seekable, and each file in the folder is read once.
+
+    Returns:
+        the number of bytes read from the folder
+    """
+    with zipfile.ZipFile(outf, 'w', allowZip64=True) as zf:
+        return _addFolder(zf, os.path.normpath(srcdir))
+
+
+def removeStaleArchives(datadir):
+    """ remove any partial archives left behind by a crash """
+    for tmpname in glob.glob(os.path.join(datadir, '*.zip.tmp')):
+        log.info(f'removing partial archive {tmpname}')
+        os.remove(tmpname)
+
+
+def archiveFolders(folders, workers=None, delete=True):
+    """
+    Archive several folders in parallel, one process per folder.
+
+    Parameters:
+        folders     [list]  - full paths of the folders to archive
+        workers     [int]   - number of processes to use, default one per core
+        delete      [bool]  - delete each folder once its archive is complete
+
+    Returns:
+        list of the archives created, in the same order as folders. Entries are None if
+        the folder could not be archived.
+    """
+    if len(folders) == 0:
+        return []
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(folders)))
+    for datadir in set([os.path.dirname(os.path.normpath(f)) for f in folders]):
+        removeStaleArchives(datadir)
+    archnames = [None] * len(folders)
+    totalbytes = 0
+    starttime = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(archiveFolder, f): i for i, f in enumerate(folders)}
+        for future in as_completed(futures):
+            i = futures[future]
+            srcdir = folders[i]
+            try:
+                archname, nbytes, elapsed = future.result()
+            except Exception as e:
+                log.warning(f'unable to archive {srcdir}')
+                log.info(e, exc_info=True)
+                continue
+            archnames[i] = archname
+            totalbytes += nbytes
+            if nbytes > 0:
+                log.info(f'archived {srcdir}: {nbytes/1048576:.1f} MB at {nbytes/1048576/max(elapsed, 0.001):.1f} MB/s')
+            else:
+                log.info(f'{archname} already exists')
+            if delete and os.path.isdir(srcdir):
+                shutil.rmtree(srcdir)
+    elapsed = time.monotonic() - starttime
+    log.info(f'archived {len(folders)} folders, {totalbytes/1048576:.1f} MB in {elapsed:.1f}s '
+             f'({totalbytes/1048576/max(elapsed, 0.001):.1f} MB/s) using {workers} processes')
+    return archnames
@@ -7,28 +7,55 @@ import os
 import shutil
 import datetime 
 import time 
-import subprocess
 import configparser
 import boto3 
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError, NoCredentialsError
 import logging 
 import glob
 import logging.handlers
 import paho.mqtt.client as mqtt
 import platform 
-import paramiko
 import tempfile
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from sendToYoutube import sendToYoutube
-from PIL import Image, ImageFont, ImageDraw 
 import ephem
 
-from makeImageIndex import createLatestIndex
+from makeImageIndex import createLatestIndex, ImageIndexWriter
 from setExpo import setCameraExposure
+from captureSession import CaptureSession
+from framePipeline import processFrame, parseRGBAdj, getAnnotator, writeThumbnail
+from timelapseEncoder import StreamingEncoder, timelapseName, tlvcodec, encoderArgs, encodeFrames, savedBackend, selectBackend
+from frameScan import goodFrames
+from keogram import KeogramWriter
+from auroraDetector import AuroraDetector
+from taskQueue import TaskQueue
+from sftpManager import sftpmanager
+from archiver import archiveFolder, archiveFolders, streamFolder, folderSize
+from chunkedUpload import sftpUpload, s3Upload, sftpStreamUpload, s3StreamUpload, journalName
+from sunSchedule import getSunSchedule
+from configWatcher import ConfigWatcher
+from frameScheduler import FrameScheduler
+from captureJournal import CaptureJournal
+from sessionCatalog import getCatalog
+from spacePlanner import spaceNeeded, planEviction
+from retention import applyRetention
 
 
 pausetime = 2 # time to wait between capturing frames 
 uploadperiod = 30 # how often to upload to S3/ftp
 log = logging.getLogger("logger")
 
+# S3 connections are built once and shared by all uploads. They are rebuilt after s3maxage
+# seconds, or sooner if an upload fails with an authentication error
+s3maxage = 24 * 3600
+s3config = BotoConfig(max_pool_connections=10, tcp_keepalive=True, retries={'max_attempts': 5, 'mode': 'standard'})
+s3authcodes = ['InvalidAccessKeyId', 'SignatureDoesNotMatch', 'ExpiredToken', 'TokenRefreshRequired', 'AccessDenied']
+s3cache = {}
+s3cachelock = threading.Lock()
+
 
 def getFilesToUpload(thiscfg, s3, bucket, s3prefix):
     """
@@ -44,17 +71,13 @@ def getFilesToUpload(thiscfg, s3, bucket, s3prefix):
             s3.meta.client.download_file(bucket, f'{s3prefix}/FILES_TO_UPLOAD.inf', os.path.join(datadir,'FILES_TO_UPLOAD.inf'))
         except Exception:
             log.info('no files-to-keep list in S3')
-    elif thiscfg['archive']['archserver'] != '':
+    elif thiscfg['archive']['archserver'] != '' and not thiscfg['archive']['archserver'].startswith('s3://'):
         log.info('getting list of files to upload from archive server')
         archuser = thiscfg['archive']['archuser']
         archfldr = thiscfg['archive']['archfldr']
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        pkey = paramiko.RSAKey.from_private_key_file(os.path.expanduser(thiscfg['archive']['archkey']))
         try:
-            ssh_client.connect(thiscfg['archive']['archserver'], username=archuser, pkey=pkey, look_for_keys=False)
-            ftp_client = ssh_client.open_sftp()
-            ftp_client.get(os.path.join(archfldr,'FILES_TO_UPLOAD.inf'), os.path.join(datadir,'FILES_TO_UPLOAD.inf'))
+            with sftpmanager.sftp(thiscfg['archive']['archserver'], archuser, thiscfg['archive']['archkey']) as ftp_client:
+                ftp_client.get(os.path.join(archfldr,'FILES_TO_UPLOAD.inf'), os.path.join(datadir,'FILES_TO_UPLOAD.inf'))
         except Exception:
             log.info('no files-to-keep list on server')
 
@@ -79,148 +102,155 @@ def pushFilesToUpload(thiscfg, s3, bucket, s3prefix):
     if s3 is not None:
         try:
             s3.meta.client.upload_file(locfnam, bucket, f'{s3prefix}/FILES_TO_UPLOAD.inf')
-        except Exception:
+        except Exception as e:
             log.warning('unable to update files-to-upload')
-    elif thiscfg['archive']['archserver'] != '':
+            if isS3AuthError(e):
+                invalidateS3Cache()
+    elif thiscfg['archive']['archserver'] != '' and not thiscfg['archive']['archserver'].startswith('s3://'):
         log.info('pushing FILES_TO_UPLOAD back to ftpserver')
         archuser = thiscfg['archive']['archuser']
         archfldr = thiscfg['archive']['archfldr']
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        pkey = paramiko.RSAKey.from_private_key_file(os.path.expanduser(thiscfg['archive']['archkey']))
         try:
-            ssh_client.connect(thiscfg['archive']['archserver'], username=archuser, pkey=pkey, look_for_keys=False)
-            ftp_client = ssh_client.open_sftp()
-            ftp_client.put(locfnam, os.path.join(archfldr,'FILES_TO_UPLOAD.inf'))
+            with sftpmanager.sftp(thiscfg['archive']['archserver'], archuser, thiscfg['archive']['archkey']) as ftp_client:
+                ftp_client.put(locfnam, os.path.join(archfldr,'FILES_TO_UPLOAD.inf'))
         except Exception:
             log.warning('unable to update files-to-upload')
     return 
 
 
-def getFreeSpace():
-    free = shutil.disk_usage('/').free
+def getFreeSpace(path='/'):
+    """ free space in kB on the disk holding path, which should be the data folder """
+    free = shutil.disk_usage(path).free
     freekb = free/1024
     return freekb
 
 
-def getNeededSpace():
+def getNeededSpace(ncameras=1, thiscfg=None):
     """
-    Calculate space required for next 24 hours of operation. 
-    each jpg is about 100kB, and we capture about 20,000 per day - about one every 4 seconds 
-    plus extra for the timelapses and tarballs, and a bit of overhead 
+    Calculate space required in kB until the end of the next night, for each camera.
+
+    With the config, this is worked out from the size of each frame and the number of frames
+    per hour in recent sessions, and the length of the night at the camera's location.
+    Otherwise each jpg is assumed to be about 100kB, and we capture about 20,000 per day -
+    about one every 4 seconds - plus extra for the timelapses and tarballs, and a bit of overhead.
     """
+    if thiscfg is not None:
+        try:
+            daytimelapse = int(thiscfg['auroracam']['daytimelapse']) == 1
+        except Exception:
+            daytimelapse = False
+        since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=14)
+        try:
+            needed, plan = spaceNeeded(thiscfg, getCatalog(thiscfg).sessions(since=since), ncameras,
+                                       daytimelapse=daytimelapse)
+            log.info(f'planning for {plan["hours"]} hours at {plan["framesperhour"]} frames per hour, '
+                     f'{plan["framebytes"]/1024:.0f} kB per frame')
+            return needed / 1024
+        except Exception as e:
+            log.warning('unable to estimate the space needed, using the default')
+            log.info(e, exc_info=True)
     jpgspace = 20000 * 100 # 100 kB per file
     mp4space = 100 * 1024  # 100 MB
     tarballspace = 1500 * 1024 # 1.5 GB 
     extraspace = 50 * 1024 # 50 MB extra just in case
-    reqspace = jpgspace + extraspace + tarballspace + mp4space
+    reqspace = (jpgspace + tarballspace + mp4space) * ncameras + extraspace
     return reqspace
 
 
 def getDeletableFiles(thiscfg, filestokeep=[]):
     """
-    Get a list of files and folders that can be deleted
+    Get a list of files and folders that can be deleted, from the session catalog
 
     Parameters:
-        datadir     [string] - the root folder containing the data files eg ~/RMS_data/auroracam
-        daystokeep  [int]    - number of recent days to keep and consider not deletable
+        thiscfg     [object] - the configuration, including DATADIR and DAYSTOKEEP, the
+                                number of recent days to keep and consider not deletable
         filestokeep [string] - a list of files or folders we want to archive before deleting
     """
-    datadir = os.path.expanduser(thiscfg['auroracam']['datadir'])
     try:
         daystokeep = int(thiscfg['auroracam']['daystokeep'])
     except Exception:
         daystokeep = 3
-    allfiles = os.listdir(datadir)
-    allfiles = [x for x in allfiles if 'FILES' not in x]
-    origallfiles = allfiles
-    for d in range(0,daystokeep):
-        yest = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=d)).strftime('%Y%m%d')
-        allfiles = [x for x in allfiles if yest not in x]
-    for patt in filestokeep:
-        toarch = [x for x in origallfiles if patt.strip() in x]
-        allfiles += toarch
-    allfiles.sort()
-    return allfiles
-
-
-def compressAndDelete(thiscfg, thisfile):
-    """
-    Compress and delete a data folder.
-
-    Parameters:
-        thiscfg     [object] - the configuration
-        thisfile    [string] - the name of the file or folder to process
-    
-    """
-    datadir = os.path.expanduser(thiscfg['auroracam']['datadir'])
-    if '.zip' in thisfile or '.tgz' in thisfile:
-        zfname = os.path.join(datadir, thisfile)
-        os.remove(zfname)
-        return zfname
-    else:
-        log.info(f'Archiving {thisfile}')
-        zfname = os.path.join(datadir, thisfile)
-        archname = shutil.make_archive(zfname, 'zip', zfname)
-        if os.path.isfile(archname):
-            shutil.rmtree(zfname)
-    return archname
+    return getCatalog(thiscfg).deletable(daystokeep, filestokeep)
 
 
-def compressAndUpload(thiscfg, thisdir):
+def compressAndUpload(thiscfg, thisdir, s3=None):
     """
     Compress and upload data.
 
+    If ARCHSERVER is of the form s3://bucket/prefix the archive is uploaded to S3, otherwise
+    to the SFTP server. With STREAMARCHIVE=1 a folder is zipped straight into the upload
+    instead of being compressed to a local zip file first, so no extra disk space is needed.
+
     Parameters:
         thiscfg     [object] - the configuration
         thisdir    [string] - the name of the file or folder to process
+        s3          [object] - S3 connection, needed when archiving to S3
     
     """
     datadir = os.path.expanduser(thiscfg['auroracam']['datadir'])
-    if '.zip' in thisdir or '.tgz' in thisdir:
+    archserver = thiscfg['archive']['archserver']
+    try:
+        streaming = int(thiscfg['archive']['streamarchive']) == 1
+    except Exception:
+        streaming = False
+    isfolder = not ('.zip' in thisdir or '.tgz' in thisdir)
+    if archserver == '' or not isfolder:
+        streaming = False
+    if isfolder and not os.path.isdir(os.path.join(datadir, thisdir)):
+        # otherwise we'd create and upload an empty zip file
+        log.warning(f'{thisdir} not found, unable to archive it')
+        return None
+
+    if not isfolder:
         archname = os.path.join(datadir, thisdir)
+    elif streaming:
+        srcdir = os.path.join(datadir, thisdir)
+        archname = srcdir + '.zip'
     else:
         log.info(f'Compressing {thisdir}')
         zfname = os.path.join(datadir, thisdir)
-        archname = shutil.make_archive(zfname,'zip',zfname)
+        archname, _, _ = archiveFolder(zfname)
         log.info(f'{zfname}')
 
-    archserver = thiscfg['archive']['archserver']
     if archserver == '':
         log.info('not uploading zip file')
         return archname
     
-    log.info(f'Uploading {archname}')
+    log.info(f'{"Streaming" if streaming else "Uploading"} {archname}')
     archuser = thiscfg['archive']['archuser']
     archfldr = thiscfg['archive']['archfldr']
-    ssh_client = paramiko.SSHClient()
-    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    pkey = paramiko.RSAKey.from_private_key_file(os.path.expanduser(thiscfg['archive']['archkey']))
     try:
-        ssh_client.connect(archserver, username=archuser, pkey=pkey, look_for_keys=False)
-        ftp_client = ssh_client.open_sftp()
-        uploadfile = os.path.join(archfldr, thisdir +'.zip')
-        try:
-            ftp_client.put(archname, uploadfile)
-            try:
-                filestat = ftp_client.stat(uploadfile)
-                log.info(f'uploaded {filestat.st_size} bytes')
-                os.remove(zfname + '.zip')
-            except Exception as e:
-                log.error(f'unable to upload {thisdir}')
-                log.info(e, exc_info=True)
-                return None
-        except Exception as e:
-            log.error(f'unable to upload {thisdir}')
-            log.info(e, exc_info=True)
-            return None
-        ftp_client.close()
-        ssh_client.close()
+        streams = int(thiscfg['archive']['uploadstreams'])
+    except Exception:
+        streams = 4
+    uploadfile = os.path.join(archfldr, os.path.basename(archname))
+    starttime = time.monotonic()
+    try:
+        if archserver.startswith('s3://'):
+            archbucket, _, archprefix = archserver[5:].partition('/')
+            archkey = '/'.join([x for x in [archprefix.strip('/'), os.path.basename(archname)] if x])
+            if streaming:
+                nbytes = s3StreamUpload(s3, lambda outf: streamFolder(srcdir, outf), archbucket, archkey)
+            else:
+                nbytes = s3Upload(s3, archname, archbucket, archkey)
+        elif streaming:
+            nbytes = sftpStreamUpload(archserver, archuser, thiscfg['archive']['archkey'],
+                                      lambda outf: streamFolder(srcdir, outf), uploadfile)
+        else:
+            nbytes = sftpUpload(archserver, archuser, thiscfg['archive']['archkey'], archname, uploadfile, workers=streams)
     except Exception as e:
-        log.warning(f'connection to {archserver} failed')
+        log.error(f'unable to upload {thisdir}')
         log.info(e, exc_info=True)
+        if isS3AuthError(e):
+            invalidateS3Cache()
         return None
-    
+    elapsed = time.monotonic() - starttime
+    log.info(f'uploaded {nbytes} bytes in {elapsed:.0f}s ({nbytes/1048576/max(elapsed, 0.001):.2f} MB/s)')
+    if not streaming:
+        os.remove(archname)
+    catalog = getCatalog(thiscfg)
+    catalog.setUploaded(thisdir)
+    catalog.updateSession(thisdir)
     return archname
 
 
@@ -248,59 +278,155 @@ def purgeLogs(thiscfg):
     return 
 
 
-def freeSpaceAndArchive(thiscfg, s3, bucket, s3prefix):
+def compressAndDelete(thiscfg, thisfile):
     """
-    Free up space by compressing and deleting older data. 
+    Compress and delete a data folder.
 
-    First we obtain the free space and estimate the required space. 
+    Parameters:
+        thiscfg     [object] - the configuration
+        thisfile    [string] - the name of the file or folder to process
     
+    """
+    datadir = os.path.expanduser(thiscfg['auroracam']['datadir'])
+    if '.zip' in thisfile or '.tgz' in thisfile:
+        zfname = os.path.join(datadir, thisfile)
+        os.remove(zfname)
+        # the record of a partly uploaded archive
+        if os.path.isfile(journalName(zfname)):
+            os.remove(journalName(zfname))
+        getCatalog(thiscfg).updateSession(thisfile)
+        return zfname
+    else:
+        log.info(f'Archiving {thisfile}')
+        zfname = os.path.join(datadir, thisfile)
+        archname, _, _ = archiveFolder(zfname)
+        if os.path.isfile(archname):
+            shutil.rmtree(zfname)
+        getCatalog(thiscfg).updateSession(thisfile)
+    return archname
+
+
+def compressAndDeleteMany(thiscfg, thesefiles):
+    """
+    Compress and delete several data folders in parallel, and delete any old archives.
+
+    Parameters:
+        thiscfg     [object] - the configuration
+        thesefiles  [list]   - the names of the files or folders to process
+    """
+    datadir = os.path.expanduser(thiscfg['auroracam']['datadir'])
+    try:
+        workers = int(thiscfg['archive']['archworkers'])
+    except Exception:
+        workers = None
+    folders = []
+    for thisfile in thesefiles:
+        if '.zip' in thisfile or '.tgz' in thisfile:
+            compressAndDelete(thiscfg, thisfile)
+        else:
+            folders.append(os.path.join(datadir, thisfile))
+    archnames = archiveFolders(folders, workers=workers, delete=True)
+    catalog = getCatalog(thiscfg)
+    for folder in folders:
+        catalog.updateSession(folder)
+    return archnames
+
+
+def evictOldData(thiscfg, deletable, freekb, reqkb, tokeep=[]):
+    """
+    Compress the oldest of the deletable folders and delete the oldest archives until reqkb
+    is free. What to process is worked out in one go from the sizes of the folders and
+    archives, and the free space is only checked again at the end. If that wasn't enough,
+    for example because the folders compressed less than expected, the rest are processed
+    one at a time, including any archives just made.
+
+    Returns:
+        the free space in kB
+    """
+    datadir = os.path.expanduser(thiscfg['auroracam']['datadir'])
+    if freekb >= reqkb:
+        log.info('sufficient space available')
+        return freekb
+    evict, freed = planEviction(datadir, deletable, (reqkb - freekb) * 1024)
+    log.info(f'compressing or deleting {len(evict)} folders and archives to free {freed/1048576:.0f} MB')
+    compressAndDeleteMany(thiscfg, evict)
+    freekb = getFreeSpace(datadir)
+    done = set(evict)
+    while freekb < reqkb:
+        remaining = [x for x in getDeletableFiles(thiscfg) if x not in done and not any([k in x for k in tokeep])]
+        if not remaining:
+            break
+        done.add(remaining[0])
+        compressAndDelete(thiscfg, remaining[0])
+        freekb = getFreeSpace(datadir)
+    log.info(f'free space now {freekb}')
+    if freekb < reqkb:
+        log.warning('unable to free enough space for the next night')
+    return freekb
+
+
+def freeSpaceAndArchive(thiscfg, s3, bucket, s3prefix, reqkb=None):
+    """
+    Free up space by compressing and deleting older data, and archive any data the user wants to keep.
+
+    First we obtain the free space on the data disk and estimate the space needed until the
+    end of the next night, from the recent capture rates and the length of the night.
+
     Next we check for data that the user wants specifically to keep. 
     This info is stored in FILES_TO_UPLOAD.inf which may be on S3, the archive server or locally. 
     The user can also specify they want to keep N days uncompressd. 
 
-    We then get a list of all folders, minus the ones we want to keep, and start compressing them 
-    from the oldest forward, deleting the folder once compressed. As soon as this frees up enough 
-    space, we stop. 
+    We then work out which of the remaining older folders and archives to process, oldest
+    first, to free the space needed. Folders are compressed and then deleted, and archives
+    are deleted. The JPEGs are stored in the zip files uncompressed, so compressing a folder
+    frees little space, which only comes back once its archive is deleted in turn.
+
+    Unless the folders to preserve are streamed straight to the archive server, each is first
+    compressed to a zip file about as big as the folder, so their total size is added to the
+    space needed.
 
     Finally, we revisit the data we want to preserve, and compress it. If an archive server is
     configured we push the compressed file to the archive.
 
-    If compressing and deleting does not free enough space, we can't proceed so we abort. 
+    reqkb is the space needed in kB, when it has been worked out for all the cameras sharing
+    the disk; by default it is estimated for this camera alone.
 
     """    
+    datadir = os.path.expanduser(thiscfg['auroracam']['datadir'])
     log.info('check free space')
-    freekb = getFreeSpace()
-    reqkb = getNeededSpace()
-    log.info(f'Available {freekb} need {reqkb}')
+    freekb = getFreeSpace(datadir)
+    if reqkb is None:
+        reqkb = getNeededSpace(1, thiscfg)
 
     log.info('checking for data to save')
     dirstoupload = getFilesToUpload(thiscfg, s3, bucket, s3prefix)
+    tokeep = [d.strip() for d in dirstoupload if d.strip() != '']
+    try:
+        streaming = int(thiscfg['archive']['streamarchive']) == 1 and thiscfg['archive']['archserver'] != ''
+    except Exception:
+        streaming = False
+    folders = [os.path.join(datadir, d) for d in tokeep if os.path.isdir(os.path.join(datadir, d))]
+    if not streaming:
+        reqkb += sum([folderSize(f) for f in folders]) / 1024
+    log.info(f'Available {freekb} need {reqkb}')
 
     log.info('checking for deletable data')
-    deletable = getDeletableFiles(thiscfg, dirstoupload)
-    for dir in deletable:
-        if freekb > reqkb:
-            log.info('sufficient space available')
-            break
-        compressAndDelete(thiscfg, dir)
-        freekb = getFreeSpace()
-        log.info(f'free space now {freekb}')
+    deletable = [x for x in getDeletableFiles(thiscfg) if not any([k in x for k in tokeep])]
+    freekb = evictOldData(thiscfg, deletable, freekb, reqkb, tokeep)
 
-    log.info('space freed up, now archiving if needed')
+    log.info('now archiving if needed')
+    if not streaming:
+        # compress the folders several at once, one per core, then upload them one by one
+        try:
+            workers = int(thiscfg['archive']['archworkers'])
+        except Exception:
+            workers = None
+        if len(folders) > 1:
+            archiveFolders(folders, workers=workers, delete=False)
     for dir in dirstoupload:
-        compressAndUpload(thiscfg, dir)
+        compressAndUpload(thiscfg, dir, s3)
     pushFilesToUpload(thiscfg, s3, bucket, s3prefix)
 
-    log.info('rechecking for deletable data')
-    deletable = getDeletableFiles(thiscfg, dirstoupload)
-    for dir in deletable:
-        if freekb > reqkb:
-            log.info('sufficient space available')
-            break
-        compressAndDelete(thiscfg, dir)
-        freekb = getFreeSpace()
-        log.info(f'free space now {freekb}')
-
     try: 
         purgeLogs(thiscfg)
     except Exception as e:
@@ -310,29 +436,6 @@ def freeSpaceAndArchive(thiscfg, s3, bucket, s3prefix):
 
 
 
-def annotateImageArbitrary(img_path, message, color='#000'):
-    """
-    Annotate an image with an arbitrary message in the selected colour at the bottom left  
-
-    Arguments:  
-        img_path:   [str] full path and filename of the image to be annotated  
-        message:    [str] message to put on the image  
-        color:      [str] hex colour string, default '#000' which is black  
-
-    """
-    my_image = Image.open(img_path)
-    width, height = my_image.size
-    image_editable = ImageDraw.Draw(my_image)
-    fntheight=20
-    try:
-        fnt = ImageFont.truetype("arial.ttf", fntheight)
-    except Exception:
-        fnt = ImageFont.truetype("DejaVuSans.ttf", fntheight)
-    #fnt = ImageFont.load_default()
-    image_editable.text((15,height-fntheight-15), message, font=fnt, fill=color)
-    my_image.save(img_path)
-
-
 def getNextRiseSet(lati, longi, elev, fordate=None):
     """ Calculate the next rise and set times for a given lat, long, elev  
 
@@ -402,6 +505,29 @@ def sendToMQTT(broker=None):
     return ret
 
 
+def sendAuroraAlert(camname, score, active):
+    """
+    Publish a change in the aurora seen by a camera to the MQTT broker in mqtt.cfg. Runs in
+    the background task queue.
+    """
+    srcdir = os.path.split(os.path.abspath(__file__))[0]
+    localcfg = configparser.ConfigParser()
+    localcfg.read(os.path.join(srcdir, 'mqtt.cfg'))
+    hname = platform.uname().node
+    client = mqtt.Client(hname)
+    client.on_connect = on_connect
+    client.on_publish = on_publish
+    if localcfg['mqtt']['username'] != '':
+        client.username_pw_set(localcfg['mqtt']['username'], localcfg['mqtt']['password'])
+    client.connect(localcfg['mqtt']['broker'], 1883, 60)
+    topic = f'{localcfg["mqtt"]["topic"]}/{hname}/aurora'
+    payload = json.dumps({'camera': camname, 'score': round(score, 2), 'active': active})
+    ret = client.publish(topic, payload=payload, qos=0, retain=True)
+    client.disconnect()
+    log.info(f'sent {payload} to {topic}')
+    return ret
+
+
 def roundTime(dt):
     if dt.microsecond > 500000:
         dt = dt + datetime.timedelta(seconds=1, microseconds = -dt.microsecond)
@@ -430,20 +556,15 @@ def getAWSConn(thiscfg, remotekeyname, uid):
         # retrieve a keyfile from the server
         log.info('retrieving AWS key')
         sshkeyfile = thiscfg['uploads']['idkey']
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        pkey = paramiko.RSAKey.from_private_key_file(os.path.expanduser(sshkeyfile))
         key = ''
         try: 
-            ssh_client.connect(servername, username=uid, pkey=pkey, look_for_keys=False)
-            ftp_client = ssh_client.open_sftp()
-            try:
-                handle, tmpfnam = tempfile.mkstemp()
-                ftp_client.get(remotekeyname + '.csv', tmpfnam)
-            except Exception as e:
-                log.error('unable to find AWS key')
-                log.info(e, exc_info=True)
-            ftp_client.close()
+            with sftpmanager.sftp(servername, uid, sshkeyfile) as ftp_client:
+                try:
+                    handle, tmpfnam = tempfile.mkstemp()
+                    ftp_client.get(remotekeyname + '.csv', tmpfnam)
+                except Exception as e:
+                    log.error('unable to find AWS key')
+                    log.info(e, exc_info=True)
             try:
                 lis = open(tmpfnam, 'r').readlines()
                 os.close(handle)
@@ -455,28 +576,62 @@ def getAWSConn(thiscfg, remotekeyname, uid):
         except Exception as e:
             log.error('unable to retrieve AWS key')
             log.info(e, exc_info=True)
-        ssh_client.close()
     s3 = None
     if key:
         log.info('retrieved key details')
         try:
             conn = boto3.Session(aws_access_key_id=key.strip(), aws_secret_access_key=sec.strip())
-            s3 = conn.resource('s3')
+            s3 = conn.resource('s3', config=s3config)
             log.info('obtained s3 resource')
         except Exception as e:
             log.info(e, exc_info=True)
             pass
     if s3 is None:
         log.warning('no AWS key retrieved, trying current AWS profile')
-        s3 = boto3.resource('s3')
+        s3 = boto3.resource('s3', config=s3config)
     return s3
 
 
-def s3details(thiscfg, hostname):
+def isS3AuthError(e):
+    """ check if an exception from boto3 means the credentials need refreshing """
+    if isinstance(e, NoCredentialsError):
+        return True
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code') in s3authcodes
+    return False
+
+
+def invalidateS3Cache():
+    """ force the S3 connection to be rebuilt next time it is used """
+    with s3cachelock:
+        s3cache.clear()
+    log.info('S3 connection will be refreshed')
+
+
+def s3details(thiscfg, hostname, refresh=False):
+    """
+    Get the S3 resource, bucket and prefix to upload to. 
+
+    The connection is cached, so the AWS key is only retrieved and the boto3 session only
+    created the first time, when the cache expires, or after invalidateS3Cache() has been
+    called because of an authentication error.
+
+    Parameters:
+        thiscfg     [object] - the configuration
+        hostname    [string] - the hostname, used to find the AWS key
+        refresh     [bool]   - rebuild the connection even if it is cached
+    """
     tmpbucket = thiscfg['uploads']['s3uploadloc']
     if tmpbucket == '':
         return None, None, None
-    s3 = getAWSConn(thiscfg, hostname, hostname)
+    cachekey = (thiscfg['uploads']['idserver'], thiscfg['uploads']['idkey'], hostname)
+    with s3cachelock:
+        cached = s3cache.get(cachekey)
+        if refresh or cached is None or time.monotonic() - cached[1] > s3maxage:
+            s3 = getAWSConn(thiscfg, hostname, hostname)
+            s3cache[cachekey] = (s3, time.monotonic())
+        else:
+            s3 = cached[0]
     if tmpbucket[:5]=='s3://':
         tmpbucket =tmpbucket[5:]
     bucket = tmpbucket.replace('/', ' ', 1).split(' ')[0]
@@ -491,11 +646,9 @@ def s3details(thiscfg, hostname):
 
 
 def getStartEndTimes(currdt, thiscfg, origdusk=None):
-    lat = thiscfg['auroracam']['lat']
-    lon = thiscfg['auroracam']['lon']
-    ele = thiscfg['auroracam']['alt']
-    risetm, settm = getNextRiseSet(lat, lon, ele, fordate=currdt)
-    lastdawn, lastdusk = getNextRiseSet(lat, lon, ele, fordate = currdt - datetime.timedelta(days=1))
+    sunschedule = getSunSchedule(thiscfg)
+    risetm, settm = sunschedule.nextRiseSet(currdt)
+    lastdawn, lastdusk = sunschedule.nextRiseSet(currdt - datetime.timedelta(days=1))
     if risetm < settm:
         settm = lastdusk
     # capture from an hour before dusk to an hour after dawn - camera autoadjusts now
@@ -510,71 +663,75 @@ def getStartEndTimes(currdt, thiscfg, origdusk=None):
     return nextset.replace(tzinfo=datetime.timezone.utc), nextrise.replace(tzinfo=datetime.timezone.utc), lastrise.replace(tzinfo=datetime.timezone.utc)
 
 
-def adjustColour(fnam, red=1, green=1, blue=1, fnamnew=None):
-    img = cv2.imread(fnam, flags=cv2.IMREAD_COLOR)
-    img[:,:,2]=img[:,:,2] * red
-    img[:,:,1]=img[:,:,1] * green
-    img[:,:,0]=img[:,:,0] * blue
-    if fnamnew is None:
-        fnamnew = fnam
-    cv2.imwrite(fnamnew, img)    
-
+def grabImage(ipaddress, fnam, hostname, now, thiscfg, capsession=None, rgbadj=None, timings=None):
+    """
+    Grab a frame from the camera, adjust its colour, annotate it and save it. The frame is
+    processed in memory and encoded to JPEG once.
 
-def grabImage(ipaddress, fnam, hostname, now, thiscfg):
-    capstr = f'rtsp://{ipaddress}:554/user=admin&password=&channel=1&stream=0.sdp'
-    # log.info(capstr)
-    try:
-        cap = cv2.VideoCapture(capstr)
-    except Exception as e:
-        log.warning('unable to connect to camera')
-        log.warning(e, exc_info=True)
-        return False
-    ret = False
-    retries = 0
-    while not ret and retries < 10:
+    Parameters:
+        ipaddress   [string] - the camera's IP address
+        fnam        [string] - the file to save the image to
+        hostname    [string] - hostname to include in the annotation
+        now         [datetime] - the timestamp to annotate the image with
+        thiscfg     [object] - the configuration
+        capsession  [CaptureSession] - optional open capture session. If not supplied, the stream
+                                is opened just for this frame which is much slower.
+        rgbadj      [tuple] - optional red, green and blue gains, already parsed. If not supplied
+                                they are read from the config.
+        timings     [dict] - optional dict which is filled in with the milliseconds taken to get
+                                the frame ('capturems') and to process and save it ('encodems'),
+                                and the size of the saved file ('bytes')
+
+    Returns:
+        the processed frame as a numpy array, or None if no frame could be grabbed
+    """
+    starttime = time.monotonic()
+    if capsession is not None:
+        frame = capsession.getFrame(timeout=10)
+        ret = frame is not None
+    else:
+        capstr = f'rtsp://{ipaddress}:554/user=admin&password=&channel=1&stream=0.sdp'
+        # log.info(capstr)
         try:
-            ret, frame = cap.read()
+            cap = cv2.VideoCapture(capstr)
         except Exception as e:
-            log.warning('unable to read frame')
+            log.warning('unable to connect to camera')
             log.warning(e, exc_info=True)
-        retries += 1
-    cap.release()
+            return None
+        ret = False
+        retries = 0
+        while not ret and retries < 10:
+            try:
+                ret, frame = cap.read()
+            except Exception as e:
+                log.warning('unable to read frame')
+                log.warning(e, exc_info=True)
+            retries += 1
+        cap.release()
     if not ret:
         log.warning('unable to grab frame')
-        return False
-    ret = False
-    retries = 0
-    while not ret and retries < 10:
-        try:
-            ret = cv2.imwrite(fnam, frame)
-        except Exception as e:
-            log.info(f'unable to save image {fnam}')
-            log.info(e, exc_info=True)
-        retries += 1
-    cv2.destroyAllWindows()
-    if ret:
-        title = f'{hostname} {now.strftime("%Y-%m-%d %H:%M:%S")}'
-        radj, gadj, badj = (thiscfg['auroracam']['rgbadj']).split(',')
-        radj = float(radj)
-        gadj = float(gadj)
-        badj = float(badj)
-        if radj < 0.99 or gadj < 0.99 or badj < 0.99:
-            adjustColour(fnam, red=radj, green=gadj, blue=badj)
-        annotateImageArbitrary(fnam, title, color='#FFFFFF')
-        return True
-    else:
-        log.warning('no new image so not annotated')
-        return False
+        return None
+    capturedtime = time.monotonic()
+    title = f'{hostname} {now.strftime("%Y-%m-%d %H:%M:%S")}'
+    if rgbadj is None:
+        rgbadj = parseRGBAdj(thiscfg['auroracam']['rgbadj'])
+    annotator = getAnnotator(f'{hostname} ', color='#FFFFFF')
+    frame = processFrame(frame, fnam, title, rgbadj, color='#FFFFFF', annotator=annotator)
+    if frame is None:
+        log.warning(f'unable to save image {fnam}')
+        return None
+    if timings is not None:
+        timings['capturems'] = (capturedtime - starttime) * 1000
+        timings['encodems'] = (time.monotonic() - capturedtime) * 1000
+        timings['bytes'] = os.path.getsize(fnam)
+    return frame
 
 
 def makeTimelapse(dirname, s3, bucket, s3prefix, daytimelapse=False, maketimelapse=True, youtube=True):
     hostname = platform.uname().node
     dirname = os.path.normpath(os.path.expanduser(dirname))
     _, mp4shortname = os.path.split(dirname)[:15]
-    if daytimelapse:
-        mp4name = os.path.join(dirname, mp4shortname + '_day.mp4')
-    else:
-        mp4name = os.path.join(dirname, mp4shortname + '.mp4')
+    mp4name = timelapseName(dirname, daytimelapse)
     log.info(f'creating {mp4name}')
     fps = int(125/pausetime)
     if maketimelapse:
@@ -589,11 +746,21 @@ def makeTimelapse(dirname, s3, bucket, s3prefix, daytimelapse=False, maketimelap
             except Exception:
                 log.warning('unable to remove zero-size image')        
                 
-        cmdline = f'ffmpeg -v quiet -r {fps} -pattern_type glob -i "{dirname}/*.jpg" \
-            -vcodec libx264 -pix_fmt yuv420p -crf 25 -movflags faststart -g 15 -vf "hqdn3d=4:3:6:4.5,lutyuv=y=gammaval(0.77)"  \
-            {mp4name}'
+        # leave out truncated, black and repeated frames
+        jpglist = goodFrames(dirname)
+        vcodec = encoderArgs()
         log.info(f'making timelapse of {dirname}')
-        subprocess.call([cmdline], shell=True)
+        try:
+            encodeFrames(jpglist, mp4name, fps, vcodec)
+        except Exception as e:
+            log.info(e, exc_info=True)
+            if vcodec != tlvcodec:
+                # the selected encoder has stopped working, eg the hardware encoder is busy
+                log.warning('timelapse encoder failed, retrying with the default')
+                try:
+                    encodeFrames(jpglist, mp4name, fps, tlvcodec)
+                except Exception as e:
+                    log.info(e, exc_info=True)
         log.info('done')
         tlnames = glob.glob(mp4name)
         if len(tlnames) > 0:
@@ -607,10 +774,12 @@ def makeTimelapse(dirname, s3, bucket, s3prefix, daytimelapse=False, maketimelap
             targkey = f'{s3prefix}/{mp4shortname[:6]}/{hostname}_{mp4shortname}.mp4'
         try:
             log.info(f'uploading to {bucket}/{targkey}')
-            s3.meta.client.upload_file(mp4name, bucket, targkey, ExtraArgs = {'ContentType': 'video/mp4'})
+            s3Upload(s3, mp4name, bucket, targkey, extraargs={'ContentType': 'video/mp4'})
         except Exception as e:
             log.info('unable to upload mp4')
             log.info(e, exc_info=True)
+            if isS3AuthError(e):
+                invalidateS3Cache()
     else:
         #log.info('created but not uploading mp4 to s3')
         pass
@@ -627,6 +796,93 @@ def makeTimelapse(dirname, s3, bucket, s3prefix, daytimelapse=False, maketimelap
     return 
 
 
+def finishTimelapse(encoder, dirname, s3, bucket, s3prefix, daytimelapse=False, youtube=True):
+    """
+    Finalise the streaming timelapse for a folder and upload it. If there is no streaming
+    encoder for the folder, or it missed any frames, the timelapse is made from scratch.
+    """
+    maketimelapse = True
+    if encoder is not None:
+        if encoder.dirname == os.path.normpath(os.path.expanduser(dirname)) and encoder.daytimelapse == daytimelapse:
+            if encoder.finish() is not None:
+                maketimelapse = False
+        else:
+            encoder.abort()
+    makeTimelapse(dirname, s3, bucket, s3prefix, daytimelapse=daytimelapse, maketimelapse=maketimelapse, youtube=youtube)
+    return
+
+
+def uploadLiveImage(fnam, thiscfg, hostname, ftpserver, ftploc, userid, sshkey):
+    """
+    Upload the live image to S3 and/or the sftp server. Runs in the background task queue.
+    """
+    s3, bucket, s3prefix = s3details(thiscfg, hostname)
+    if s3 is not None:
+        for attempt in range(2):
+            try:
+                s3.meta.client.upload_file(fnam, bucket, f'{s3prefix}/{os.path.basename(fnam)}', ExtraArgs = {'ContentType': 'image/jpeg'})
+                log.info(f'uploaded live image to {bucket}/{s3prefix}')
+                break
+            except Exception as e:
+                log.warning(f'upload to {bucket}/{s3prefix} failed')
+                log.info(e, exc_info=True)
+                if not isS3AuthError(e) or attempt > 0:
+                    break
+                s3, bucket, s3prefix = s3details(thiscfg, hostname, refresh=True)
+    if ftpserver is not None:
+        try:
+            uploadOneFile(fnam, ftploc, ftpserver, userid, sshkey)
+            log.info(f'uploaded live image to {ftpserver}')
+        except Exception as e:
+            log.warning(f'upload to {ftpserver} failed')
+            log.info(e, exc_info=True)
+    return
+
+
+def queueLiveUpload(tasks, camera, hostname, ftpserver, ftploc, userid, sshkey):
+    """ queue an upload of a camera's live image, if there is anywhere to upload it to """
+    if not os.path.isfile(camera.livename):
+        return
+    s3, bucket, s3prefix = s3details(camera.settings.cfg, hostname)
+    if s3 is not None or ftpserver is not None:
+        log.info(f'queueing live image upload for {camera.name}')
+        tasks.submit(camera.uploadjob, uploadLiveImage, camera.livename, camera.settings.cfg, hostname,
+                     ftpserver, ftploc, userid, sshkey)
+
+
+def timelapseJob(encoder, dirname, s3, bucket, s3prefix, daytimelapse=False, youtube=True, keogram=None):
+    """
+    Finish, upload and index the timelapse and keogram for a folder. Runs in the background task queue.
+    """
+    finishTimelapse(encoder, dirname, s3, bucket, s3prefix, daytimelapse=daytimelapse, youtube=youtube)
+    if keogram is not None:
+        if keogram.dirname == os.path.normpath(os.path.expanduser(dirname)):
+            keogram.finish()
+        else:
+            keogram.close()
+    createLatestIndex(dirname)
+    return
+
+
+def createTaskQueue():
+    """
+    Create the background task queue used by the capture loop.
+
+    The live image upload only ever needs the newest image, so only the newest pending
+    upload is kept. Aurora alerts are never dropped, so that the end of an alert isn't
+    lost. Timelapses are never dropped and run on their own worker. Thinning out old
+    sessions can take a long time, so it runs on a separate background worker rather than
+    holding up the dusk or dawn timelapse, as does benchmarking the timelapse encoders.
+    """
+    tasks = TaskQueue(maxdepth=20, ioworkers=2, encworkers=1, bgworkers=1)
+    tasks.registerJobType('liveupload', priority=1, policy='latest')
+    tasks.registerJobType('auroraalert', priority=2, policy='fifo')
+    tasks.registerJobType('timelapse', priority=5, policy='fifo', pool='encode')
+    tasks.registerJobType('retention', priority=9, policy='fifo', pool='background')
+    tasks.registerJobType('encoderbenchmark', priority=8, policy='drop', pool='background')
+    return tasks
+
+
 def setupLogging(thiscfg, prefix='auroracam_'):
     print('about to initialise logger')
     logdir = os.path.expanduser(thiscfg['auroracam']['logdir'])
@@ -653,39 +909,227 @@ def setupLogging(thiscfg, prefix='auroracam_'):
 
 
 def uploadOneFile(fnam, ulloc, ftpserver, userid, sshkey):
-    ssh_client = paramiko.SSHClient()
-    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    pkey = paramiko.RSAKey.from_private_key_file(os.path.expanduser(sshkey))
+    targloc = os.path.join(ulloc, os.path.basename(fnam))
     try: 
-        targloc = os.path.join(ulloc, os.path.basename(fnam))
-        ssh_client.connect(ftpserver, userid, pkey=pkey, look_for_keys=False)
-        ftp_client = ssh_client.open_sftp()
-        ftp_client.put(fnam, targloc)
-        ftp_client.close()
-        ssh_client.close()
+        with sftpmanager.sftp(ftpserver, userid, sshkey) as ftp_client:
+            ftp_client.put(fnam, targloc)
     except Exception as e:
         log.warn(f'unable to upload to {ftpserver}:{targloc}')
         log.info(e, exc_info=True)
     return 
 
 
+class AuroraCamera(object):
+    """
+    The capture state of one camera: its stream, whether it is in night mode, its aurora
+    detector, and the journal, image index, keogram and timelapse encoder for its current
+    capture folder.
+
+    Several cameras can be run from one process. They share the frame scheduler, the dawn
+    and dusk times, the task queue and the S3 and SFTP connections, while each has its own
+    data folder, live image and timelapses.
+
+    Parameters:
+        settings    [CameraSettings] - the camera's settings
+        hostname    [string] - the hostname
+        primary     [bool]   - whether this is the first camera, which keeps the original
+                                live image name and annotation
+    """
+    def __init__(self, settings, hostname, primary=True):
+        self.name = settings.name
+        self.settings = settings
+        self.hostname = hostname
+        self.datadir = settings.datadir
+        if primary:
+            self.label = hostname
+            self.livename = os.path.join(self.datadir, '..', 'live.jpg')
+            self.aurorafile = os.path.join(self.datadir, '..', 'aurora.json')
+            self.uploadjob = 'liveupload'
+        else:
+            self.label = f'{hostname} {self.name}'
+            self.livename = os.path.join(self.datadir, '..', f'live_{self.name}.jpg')
+            self.aurorafile = os.path.join(self.datadir, '..', f'aurora_{self.name}.json')
+            self.uploadjob = f'liveupload_{self.name}'
+        self.isnight = False
+        self.capdirname = None
+        self.capsession = None
+        self.encoder = None
+        self.indexer = None
+        self.journal = None
+        self.keogram = None
+        self.lastframe = None
+        self.catalog = getCatalog(settings.cfg)
+        self.detector = AuroraDetector(threshold=settings.aurorathreshold, period=pausetime)
+
+    def start(self, now, dusk, dawn):
+        """ set the camera's exposure for the time of day and open the stream """
+        os.makedirs(self.datadir, exist_ok=True)
+        if now > dawn or now < dusk:
+            self.isnight = False
+            setCameraExposure(self.settings.ipaddress, 'DAY', self.settings.nightgain, True, True)
+        else:
+            self.isnight = True
+            setCameraExposure(self.settings.ipaddress, 'NIGHT', self.settings.nightgain, True, True)
+        self.capsession = CaptureSession(self.settings.ipaddress)
+        self.capsession.start()
+
+    def setFolder(self, dusk, lastdusk, lastdawn):
+        """ work out which folder this frame belongs in """
+        if self.isnight:
+            self.capdirname = os.path.join(self.datadir, dusk.strftime('%Y%m%d_%H%M%S'))
+        else:
+            self.capdirname = os.path.join(self.datadir, lastdawn.strftime('%Y%m%d_%H%M%S'))
+        if dusk != lastdusk and self.isnight:
+            # its dawn
+            self.capdirname = os.path.join(self.datadir, lastdusk.strftime('%Y%m%d_%H%M%S'))
+
+    def capture(self, now):
+        """
+        Grab, save and record a frame. When there are several cameras this runs for all of
+        them at once.
+
+        Returns:
+            True if a frame was captured
+        """
+        settings = self.settings
+        timings = {}
+        frame = grabImage(settings.ipaddress, self.livename, self.label, now, settings.cfg, self.capsession,
+                          rgbadj=settings.rgbadj, timings=timings)
+        if frame is None:
+            log.warning(f'failed to grab frame from {self.name}')
+            if self.journal is not None:
+                self.journal.flushIfDue()
+            return False
+        # due to slight variations in the results from ephem, the time of dawn and dusk may drift by a second or two
+        # this caters for it be reusing any existing folder thats timestamped within 10s
+        capdirbase = os.path.split(self.capdirname)[1]
+        existingfolder = self.catalog.findFolder(capdirbase[:-2])
+        if existingfolder is not None:
+            self.capdirname = os.path.join(self.datadir, existingfolder)
+
+        thisframe = time.monotonic()
+        framegap = 0 if self.lastframe is None else thisframe - self.lastframe
+        self.lastframe = thisframe
+        if self.journal is None or self.journal.dirname != os.path.normpath(self.capdirname):
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = CaptureJournal(self.capdirname)
+        self.journal.add(now, framegap, timings['capturems'], timings['encodems'], timings['bytes'])
+        log.info(f'grabbed {self.livename}')
+        if self.isnight:
+            self.detector.update(frame)
+            self.detector.save(self.aurorafile, now)
+
+        if settings.daytimelapse or self.isnight:
+            capdirname = self.capdirname
+            os.makedirs(capdirname, exist_ok=True)
+            fnam2 = os.path.join(capdirname, now.strftime('%Y%m%d_%H%M%S') + '.jpg')
+            shutil.copyfile(self.livename, fnam2)
+            self.catalog.addFrame(capdirname, now, timings['bytes'])
+            thumbnam = os.path.join(capdirname, 'thumbs', os.path.basename(fnam2))
+            if not writeThumbnail(frame, thumbnam):
+                thumbnam = None
+            if settings.streamtimelapse:
+                if self.encoder is None or self.encoder.dirname != os.path.normpath(capdirname):
+                    if self.encoder is not None:
+                        self.encoder.abort()
+                    self.encoder = StreamingEncoder(capdirname, int(125/pausetime), daytimelapse=not self.isnight,
+                                                    vcodec=encoderArgs())
+                    self.encoder.start()
+                self.encoder.addFrame(fnam2)
+            if self.indexer is None or self.indexer.here != os.path.normpath(capdirname):
+                if self.indexer is not None:
+                    self.indexer.close()
+                self.indexer = ImageIndexWriter(capdirname)
+            self.indexer.add(fnam2, thumbnam)
+            if self.keogram is None or self.keogram.dirname != os.path.normpath(capdirname):
+                if self.keogram is not None:
+                    self.keogram.close()
+                self.keogram = KeogramWriter(capdirname)
+            self.keogram.add(frame)
+            # keep the keogram on the web page up to date during the night
+            keoname = self.keogram.renderIfDue()
+            if keoname is not None:
+                self.indexer.add(keoname)
+            log.info(f'and copied to {capdirname}')
+        return True
+
+    def checkDayNight(self, now, dusk, dawn, lastdusk, tasks, youtube):
+        """
+        Switch between day and night mode at dusk and dawn, queueing the timelapse of the
+        session that has just ended.
+
+        Returns:
+            True if the camera has just switched to daytime mode
+        """
+        settings = self.settings
+        # when we move from day to night, make the day timelapse then switch exposure and flag
+        if now < dawn and now > dusk and self.isnight is False:
+            if settings.daytimelapse:
+                # make the daytime mp4 in the background
+                s3, bucket, s3prefix = s3details(settings.cfg, self.hostname)
+                tasks.submit('timelapse', timelapseJob, self.encoder, self.capdirname, s3, bucket, s3prefix,
+                             daytimelapse=True, youtube=youtube, keogram=self.keogram)
+                self.encoder = None
+                self.keogram = None
+            self.isnight = True
+            setCameraExposure(settings.ipaddress, 'NIGHT', settings.nightgain, True, True)
+            self.detector.reset()
+            self.capdirname = os.path.join(self.datadir, dusk.strftime('%Y%m%d_%H%M%S'))
+            os.makedirs(self.capdirname, exist_ok=True)
+
+        # when we move from night to day, make the night timelapse in the background then switch exposure
+        if dusk != lastdusk and self.isnight:
+            s3, bucket, s3prefix = s3details(settings.cfg, self.hostname)
+            tasks.submit('timelapse', timelapseJob, self.encoder, self.capdirname, s3, bucket, s3prefix,
+                         youtube=youtube, keogram=self.keogram)
+            self.encoder = None
+            self.keogram = None
+            log.info(f'switched {self.name} to daytime mode')
+            setCameraExposure(settings.ipaddress, 'DAY', settings.nightgain, True, True)
+            self.isnight = False
+            self.detector.reset()
+            return True
+        return False
+
+    def stop(self):
+        if self.capsession is not None:
+            self.capsession.stop()
+        if self.journal is not None:
+            self.journal.close()
+        if self.indexer is not None:
+            self.indexer.close()
+        if self.keogram is not None:
+            self.keogram.close()
+        self.catalog.flush()
+
+
 if __name__ == '__main__':
     hostname = platform.uname().node
 
-    thiscfg = configparser.ConfigParser()
     local_path =os.path.dirname(os.path.abspath(__file__))
-    thiscfg.read(os.path.join(local_path, 'config.ini'))
+    cfgwatcher = ConfigWatcher(os.path.join(local_path, 'config.ini'))
+    camsettings = cfgwatcher.cameras()
+    thiscfg = camsettings[0].cfg
     setupLogging(thiscfg)
 
-    datadir = os.path.expanduser(thiscfg['auroracam']['datadir'])
+    # the first camera's folder holds the files for the whole process, such as the task stats
+    datadir = camsettings[0].datadir
     os.makedirs(datadir, exist_ok=True)
     norebootflag = os.path.join(datadir, '..', '.noreboot')
     open(norebootflag, 'w')
-    s3, bucket, s3prefix = s3details(thiscfg, hostname)
-    if s3 is not None:
-        log.info(f'S3 upload target {bucket}/{s3prefix}')
-
-    freeSpaceAndArchive(thiscfg, s3, bucket, s3prefix)
+    # the space needed is estimated for each camera and added up for each disk, once, so
+    # that cameras sharing a disk don't each reserve space for all of them
+    diskneeds = {}
+    for settings in camsettings:
+        os.makedirs(settings.datadir, exist_ok=True)
+        disk = os.stat(settings.datadir).st_dev
+        diskneeds[disk] = diskneeds.get(disk, 0) + getNeededSpace(1, settings.cfg)
+    for settings in camsettings:
+        s3, bucket, s3prefix = s3details(settings.cfg, hostname)
+        if s3 is not None:
+            log.info(f'{settings.name} S3 upload target {bucket}/{s3prefix}')
+        freeSpaceAndArchive(settings.cfg, s3, bucket, s3prefix, reqkb=diskneeds[os.stat(settings.datadir).st_dev])
 
     ftpserver = thiscfg['uploads']['ftpserver']
     if ftpserver != '':
@@ -706,133 +1150,118 @@ if __name__ == '__main__':
     else:
         yt=False
 
-    ipaddress = thiscfg['auroracam']['ipaddress']
-    macaddress = thiscfg['auroracam']['macaddress']
-    nightgain = int(thiscfg['auroracam']['nightgain'])
     if os.path.isfile(norebootflag):
         os.remove(norebootflag)
     
     # get todays dusk and tomorrows dawn times
     now = datetime.datetime.now(datetime.timezone.utc)
     dusk, dawn, lastdawn = getStartEndTimes(now, thiscfg)
-    daytimelapse = int(thiscfg['auroracam']['daytimelapse'])
-    if now > dawn or now < dusk:
-        isnight = False
-        setCameraExposure(ipaddress, 'DAY', nightgain, True, True)
-    else:
-        isnight = True
-        setCameraExposure(ipaddress, 'NIGHT', nightgain, True, True)
-
     log.info(f'now {now}, dusk {dusk}, dawn {dawn} last dawn {lastdawn}')
+
+    tasks = createTaskQueue()
+    # time the timelapse encoders the first time we run on this host, without holding up a timelapse
+    if savedBackend() is None:
+        tasks.submit('encoderbenchmark', selectBackend)
+    cameras = []
+    for i, settings in enumerate(camsettings):
+        camera = AuroraCamera(settings, hostname, primary=(i == 0))
+        if camera.uploadjob not in tasks.jobtypes:
+            tasks.registerJobType(camera.uploadjob, priority=1, policy='latest')
+        camera.start(now, dusk, dawn)
+        cameras.append(camera)
+        tasks.submit('retention', applyRetention, settings.cfg)
+    log.info(f'capturing from {len(cameras)} camera(s): {", ".join([c.name for c in cameras])}')
+    # the cameras are captured at the same time, so the frame rate doesn't drop as cameras are added
+    cappool = ThreadPoolExecutor(max_workers=len(cameras), thread_name_prefix='capture') if len(cameras) > 1 else None
+
+    rebootpending = False
+    flagset = False
     upload_init_time = datetime.datetime.now()
     log.info(f'uploading every {uploadperiod} seconds')
-    currtime = datetime.datetime.now()
+    scheduler = FrameScheduler(pausetime)
     while True:
         lastdusk = dusk
         dusk, dawn, lastdawn = getStartEndTimes(now, thiscfg, lastdusk)
-        if isnight:
-            capdirname = os.path.join(datadir, dusk.strftime('%Y%m%d_%H%M%S'))
-        else:
-            capdirname = os.path.join(datadir, lastdawn.strftime('%Y%m%d_%H%M%S'))
-        
-        if dusk != lastdusk and isnight:
-            # its dawn
-            capdirname = os.path.join(datadir, lastdusk.strftime('%Y%m%d_%H%M%S'))
+        for camera in cameras:
+            camera.setFolder(dusk, lastdusk, lastdawn)
 
-        #log.info(f'capturing to {capdirname}')
         now = datetime.datetime.now(datetime.timezone.utc)
-        fnam = os.path.expanduser(os.path.join(datadir, '..', 'live.jpg'))
-        thiscfg.read(os.path.join(local_path, 'config.ini'))
-        gotaframe = grabImage(ipaddress, fnam, hostname, now, thiscfg)
-        if not gotaframe:
-            log.warning('failed to grab frame')
+        # only reparses config.ini if it has changed
+        for camera, settings in zip(cameras, cfgwatcher.cameras()):
+            camera.settings = settings
+            camera.detector.threshold = settings.aurorathreshold
+        thiscfg = cameras[0].settings.cfg
+        if cappool is None:
+            captured = [cameras[0].capture(now)]
         else:
-            newtime = datetime.datetime.now()
-            framegap = (newtime - currtime).seconds
-            currtime = newtime
-            os.makedirs(capdirname, exist_ok=True)
-            open(os.path.join(capdirname,'frameintervals.txt'),'a+').write(f"{currtime.strftime('%Y%m%d-%H%M%S')},{framegap}\n")
-            log.info(f'grabbed {fnam}')
-
-        # due to slight variations in the results from ephem, the time of dawn and dusk may drift by a second or two
-        # this caters for it be reusing any existing folder thats timestamped within 10s
-        capdirbase = os.path.split(capdirname)[1]
-        # FIXME
-        existingfolder = glob.glob(os.path.join('/home/mark/data/auroracam', capdirbase[:-2]+'*'))
-        if len(existingfolder) > 0:
-            capdirname = existingfolder[0]
-
-        if gotaframe and (daytimelapse or isnight): 
-            os.makedirs(capdirname, exist_ok=True)
-            fnam2 = os.path.join(capdirname, now.strftime('%Y%m%d_%H%M%S') + '.jpg')
-            shutil.copyfile(fnam, fnam2)
-            createLatestIndex(capdirname)
-            log.info(f'and copied to {capdirname}')
-        # when we move from day to night, make the day timelapse then switch exposure and flag
-        if now < dawn and now > dusk and isnight is False:
-            if daytimelapse:
-                # make the daytime mp4
-                norebootflag = os.path.join(datadir, '..', '.noreboot')
+            captured = list(cappool.map(lambda c: c.capture(now), cameras))
+        if any(captured):
+            scheduler.frameDone()
+
+        for camera in cameras:
+            if camera.checkDayNight(now, dusk, dawn, lastdusk, tasks, yt):
+                # We keep capturing until the timelapses are done, then reboot
+                log.info('will reboot once the timelapses are done')
+                rebootpending = True
+
+        # don't let checkAuroracam restart us while a timelapse is being made
+        if tasks.pending('timelapse') > 0:
+            if not os.path.isfile(norebootflag):
                 open(norebootflag, 'w')
-                makeTimelapse(capdirname, s3, bucket, s3prefix, daytimelapse=True, youtube=yt)
-                createLatestIndex(capdirname)
+                flagset = True
+        elif flagset:
+            if os.path.isfile(norebootflag):
                 os.remove(norebootflag)
-            isnight = True
-            setCameraExposure(ipaddress, 'NIGHT', nightgain, True, True)
-            capdirname = os.path.join(datadir, dusk.strftime('%Y%m%d_%H%M%S'))
-            os.makedirs(capdirname, exist_ok=True)
+            flagset = False
 
-        # when we move from night to day, make the night timelapse then switch exposure and flag and reboot
-        if dusk != lastdusk and isnight:
-            norebootflag = os.path.join(datadir, '..', '.noreboot')
-            open(norebootflag, 'w')
-            makeTimelapse(capdirname, s3, bucket, s3prefix, youtube=yt)
-            createLatestIndex(capdirname)
-            log.info('switched to daytime mode, now rebooting')
-            setCameraExposure(ipaddress, 'DAY', nightgain, True, True)
-            os.remove(norebootflag)
+        if rebootpending and tasks.pending('timelapse') == 0:
+            log.info('timelapse done, now rebooting')
+            tasks.join(timeout=60)
             try:
                 os.system('/usr/bin/sudo /usr/sbin/shutdown -r now')
             except Exception as e:
                 log.info('unable to reboot')
                 log.info(e, exc_info=True)
+            rebootpending = False
         testmode = int(os.getenv('TESTMODE', default=0))
-        log.info(f'fnam is {fnam}')
+
+        # while there is aurora, alert, upload the live image after every frame and capture more often
+        aurora = cameras[0].settings
+        seen = False
+        for camera in cameras:
+            if camera.detector.changed:
+                camera.detector.changed = False
+                log.info(f'aurora {"seen" if camera.detector.active else "over"} on {camera.name}, '
+                         f'score {camera.detector.score:.2f}')
+                if aurora.auroraalert:
+                    tasks.submit('auroraalert', sendAuroraAlert, camera.name, camera.detector.score,
+                                 camera.detector.active)
+            if camera.detector.active:
+                seen = True
+                if aurora.auroraupload and testmode == 0:
+                    queueLiveUpload(tasks, camera, hostname, ftpserver, ftploc, userid, sshkey)
+        scheduler.setPeriod(aurora.auroraperiod if seen and aurora.auroraperiod else pausetime)
 
         upload_trigger_time = datetime.datetime.now()
-        log.info(f'elapsed {(upload_trigger_time - upload_init_time).seconds}')
-        log.info(f'{upload_init_time}, {upload_trigger_time}')
-        if (upload_trigger_time - upload_init_time).seconds > uploadperiod and testmode == 0 and os.path.isfile(fnam):
-            log.info('uploading image')
+        if (upload_trigger_time - upload_init_time).seconds > uploadperiod and testmode == 0:
             upload_init_time = upload_trigger_time
-            if s3 is not None:
-                try:
-                    s3, bucket, s3prefix = s3details(thiscfg, hostname)
-                    s3.meta.client.upload_file(fnam, bucket, f'{s3prefix}/live.jpg', ExtraArgs = {'ContentType': 'image/jpeg'})
-                    log.info(f'uploaded live image to {bucket}/{s3prefix}')
-                    uploadcounter = 0
-                except Exception as e:
-                    log.warning(f'upload to {bucket}/{s3prefix} failed')
-                    log.info(e, exc_info=True)
-            else:
-                #log.info('s3 not configured')
-                pass
-            if ftpserver is not None:
-                try:
-                    uploadOneFile(fnam, ftploc, ftpserver, userid, sshkey)
-                    log.info(f'uploaded live image to {ftpserver}')
-                    uploadcounter = 0
-                except Exception as e:
-                    log.warning(f'upload to {ftpserver} failed')
-                    log.info(e, exc_info=True)
-            else:
-                #log.info('ftpserver not configured')
+            for camera in cameras:
+                queueLiveUpload(tasks, camera, hostname, ftpserver, ftploc, userid, sshkey)
+            taskstats = tasks.logStats()
+            taskstats['frametiming'] = scheduler.logStats()
+            try:
+                json.dump(taskstats, open(os.path.join(datadir, '..', 'taskstats.json'), 'w'), indent=2)
+            except Exception:
                 pass
         if testmode == 1:
-            log.info(f'would have uploaded {fnam}')
-        log.info(f'sleeping for {pausetime} seconds')
+            log.info(f'would have uploaded {", ".join([c.livename for c in cameras])}')
         if os.path.isfile(os.path.expanduser('~/.stopac')):
             os.remove(os.path.expanduser('~/.stopac'))
             log.info('Shutting down at user request')
+            for camera in cameras:
+                camera.stop()
+            tasks.stop(timeout=300)
+            cfgwatcher.close()
             exit(0)
-        time.sleep(pausetime)
+        # wait for the next capture slot, pausetime after the start of this one
+        scheduler.wait()
@@ -0,0 +1,154 @@
+# Copyright (C) Mark McIntyre
+#
+# Score each frame for aurora as it is captured, from how much greener the sky is than usual
+#
+import os
+import sys
+import json
+import time
+import timeit
+import logging
+import cv2
+import numpy as np
+
+from frameScan import frameList, annotationheight
+
+log = logging.getLogger("logger")
+
+scorename = 'aurora.json'
+
+
+class AuroraDetector(object):
+    """
+    Score frames for aurora by the green in the sky compared with the usual sky.
+
+    Each frame is shrunk by scale in each direction, which averages out most of the noise,
+    and the strip with the timestamp is cropped off. The green excess of each pixel, green
+    minus the mean of red and blue, is compared with a rolling per-pixel background, an
+    exponential average over about timeconstant seconds, so that light pollution, moonlight
+    and anything else that is always there doesn't count. The score is the mean over the
+    sky of the excess above the background, counting only pixels more than pixellevel
+    above it, so it grows with both the brightness and the extent of the aurora.
+
+    Aurora is reported when the score reaches threshold, and cleared once it drops below
+    half the threshold so that a flickering display doesn't turn it on and off.
+
+    Parameters:
+        threshold       [float] - score at which aurora is reported
+        scale           [int]   - factor by which frames are shrunk before scoring
+        period          [float] - seconds between frames
+        timeconstant    [float] - seconds over which the background is averaged
+        pixellevel      [float] - levels, out of 255, by which a pixel must be greener than usual to count
+    """
+    def __init__(self, threshold=1.0, scale=8, period=2, timeconstant=1800, pixellevel=5):
+        self.threshold = threshold
+        self.scale = scale
+        self.alpha = min(1.0, period / timeconstant)
+        self.pixellevel = pixellevel
+        self.background = None
+        self.score = 0.0
+        self.active = False
+        self.changed = False
+
+    def reset(self):
+        """ forget the background, eg when the camera switches between day and night settings """
+        self.background = None
+        self.score = 0.0
+        if self.active:
+            self.active = False
+            self.changed = True
+
+    def update(self, frame):
+        """
+        Score a BGR frame and add it to the background.
+
+        Returns:
+            the score
+        """
+        # cropped to a whole number of blocks, which OpenCV averages several times faster
+        rows = int(frame.shape[0] * (1 - annotationheight)) // self.scale
+        cols = frame.shape[1] // self.scale
+        sky = frame[:rows * self.scale, :cols * self.scale]
+        small = cv2.resize(sky, (cols, rows), interpolation=cv2.INTER_AREA).astype(np.float32)
+        excess = small[:, :, 1] - 0.5 * (small[:, :, 0] + small[:, :, 2])
+        if self.background is None or self.background.shape != excess.shape:
+            self.background = excess
+            self.score = 0.0
+            return self.score
+        diff = excess - self.background
+        self.score = float(np.mean(np.where(diff > self.pixellevel, diff, 0)))
+        self.background += self.alpha * diff
+        if not self.active and self.score >= self.threshold:
+            self.active = True
+            self.changed = True
+        elif self.active and self.score < self.threshold / 2:
+            self.active = False
+            self.changed = True
+        return self.score
+
+    def save(self, fnam, now):
+        """ write the latest score to a small JSON file for the web page and other programs """
+        try:
+            json.dump({'time': now.isoformat(timespec='seconds'), 'score': round(self.score, 2),
+                       'active': self.active}, open(fnam + '.tmp', 'w'))
+            os.replace(fnam + '.tmp', fnam)
+        except Exception as e:
+            log.info(f'unable to save {fnam}')
+            log.info(e, exc_info=True)
+
+
+def replayFolder(dirname, threshold=1.0, period=2):
+    """
+    Run the detector over the frames of a night that has already been captured, to see how
+    it would have scored the night and to choose a threshold for the site. Only the time
+    taken to score the frames is measured, not the time to read them.
+
+    Returns:
+        list of (frame name, score, active), and the mean milliseconds taken per frame
+    """
+    detector = AuroraDetector(threshold=threshold, period=period)
+    results = []
+    elapsed = 0
+    for fnam in frameList(dirname):
+        frame = cv2.imread(fnam)
+        if frame is None:
+            continue
+        starttime = time.perf_counter()
+        score = detector.update(frame)
+        elapsed += time.perf_counter() - starttime
+        results.append((os.path.basename(fnam), score, detector.active))
+    return results, elapsed * 1000 / max(len(results), 1)
+
+
+def benchmarkDetector(width=1920, height=1080, number=200):
+    """ the per-frame cost of scoring a frame, with the frame already in memory """
+    frames = np.random.default_rng(0).integers(0, 40, (4, height, width, 3), dtype=np.uint8)
+    detector = AuroraDetector()
+    detector.update(frames[0])
+    i = iter(range(number))
+    scoretime = timeit.timeit(lambda: detector.update(frames[next(i) % 4]), number=number) / number
+    print(f'score frame         {scoretime*1000:.3f} ms per frame at {width}x{height}')
+    return scoretime
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python auroraDetector.py benchmark')
+        print('       python auroraDetector.py replay capturefolder [threshold]')
+        exit(0)
+    if sys.argv[1] == 'benchmark':
+        benchmarkDetector()
+    elif len(sys.argv) > 2:
+        threshold = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+        results, ms = replayFolder(sys.argv[2], threshold)
+        wasactive = False
+        for name, score, active in results:
+            if active != wasactive:
+                print(f'{name[:15]} aurora {"started" if active else "ended"}, score {score:.2f}')
+                wasactive = active
+        scores = [r[1] for r in results]
+        if scores:
+            peak = int(np.argmax(scores))
+            print(f'{len(results)} frames, peak score {scores[peak]:.2f} at {results[peak][0][:15]}, '
+                  f'{sum([r[2] for r in results])} frames with aurora')
+        print(f'{ms:.3f} ms per frame to score')
@@ -0,0 +1,162 @@
+# Copyright (C) Mark McIntyre
+#
+# Per-session log of frame timings, and a reader to analyse it
+#
+import os
+import sys
+import csv
+import time
+import logging
+
+log = logging.getLogger("logger")
+
+journalname = 'capturejournal.csv'
+journalfields = ['timestamp', 'interval', 'capturems', 'encodems', 'bytes']
+
+
+class CaptureJournal(object):
+    """
+    Buffered CSV log of the timing of each frame in a capture session.
+
+    Rows are written through a buffer which is flushed every flushinterval seconds, rather
+    than opening and closing the file for every frame, and the file is synced to disk when
+    the journal is closed at the end of the session.
+
+    Parameters:
+        dirname         [string] - the capture folder
+        flushinterval   [int]    - seconds between flushes
+    """
+    def __init__(self, dirname, flushinterval=30):
+        self.dirname = os.path.normpath(dirname)
+        self.fname = os.path.join(self.dirname, journalname)
+        self.flushinterval = flushinterval
+        os.makedirs(self.dirname, exist_ok=True)
+        newfile = not os.path.isfile(self.fname) or os.path.getsize(self.fname) == 0
+        self._outf = open(self.fname, 'a', newline='', buffering=65536)
+        self._writer = csv.writer(self._outf)
+        if newfile:
+            self._writer.writerow(journalfields)
+        self._lastflush = time.monotonic()
+
+    def add(self, timestamp, interval, capturems=0, encodems=0, nbytes=0):
+        """
+        Record one frame.
+
+        Parameters:
+            timestamp   [datetime] - when the frame was captured
+            interval    [float]    - seconds since the previous frame
+            capturems   [float]    - milliseconds spent getting the frame from the camera
+            encodems    [float]    - milliseconds spent adjusting, annotating and saving it
+            nbytes      [int]      - size of the saved JPEG
+        """
+        self._writer.writerow([timestamp.isoformat(timespec='milliseconds'), f'{interval:.3f}',
+                               f'{capturems:.1f}', f'{encodems:.1f}', nbytes])
+        self.flushIfDue()
+
+    def flushIfDue(self):
+        if time.monotonic() - self._lastflush >= self.flushinterval:
+            self._outf.flush()
+            self._lastflush = time.monotonic()
+
+    def close(self):
+        """ flush and sync the journal at the end of the session """
+        if self._outf is None:
+            return
+        self._outf.flush()
+        try:
+            os.fsync(self._outf.fileno())
+        except OSError:
+            pass
+        self._outf.close()
+        self._outf = None
+
+
+def readJournal(dirname):
+    """
+    Load the frame timings for a capture folder.
+
+    Older folders only have frameintervals.txt, which is read instead. It has just the time
+    and interval, so the other columns are None.
+
+    Returns:
+        a list of dicts with the journal fields
+    """
+    if os.path.isfile(dirname):
+        fname = dirname
+    else:
+        fname = os.path.join(dirname, journalname)
+    rows = []
+    if os.path.isfile(fname) and fname.endswith('.csv'):
+        with open(fname, newline='') as inf:
+            for row in csv.DictReader(inf):
+                rows.append({'timestamp': row['timestamp'], 'interval': float(row['interval']),
+                             'capturems': float(row['capturems']), 'encodems': float(row['encodems']),
+                             'bytes': int(row['bytes'])})
+        return rows
+    if not fname.endswith('frameintervals.txt'):
+        fname = os.path.join(dirname, 'frameintervals.txt')
+    if os.path.isfile(fname):
+        for line in open(fname):
+            if ',' not in line:
+                continue
+            ts, gap = line.strip().split(',')[:2]
+            rows.append({'timestamp': ts, 'interval': float(gap), 'capturems': None, 'encodems': None, 'bytes': None})
+    return rows
+
+
+def _percentiles(values, pcts=(50, 95, 99)):
+    ordered = sorted(values)
+    return [ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in pcts]
+
+
+def summariseJournal(rows, nominal=None):
+    """
+    Summarise the timings of a session.
+
+    Parameters:
+        rows    [list]  - rows from readJournal
+        nominal [float] - the intended interval in seconds, by default the median interval
+
+    Returns:
+        dict of statistics
+    """
+    summary = {'frames': len(rows)}
+    intervals = [r['interval'] for r in rows[1:] if r['interval'] > 0]
+    if intervals:
+        p50, p95, p99 = _percentiles(intervals)
+        nominal = nominal or p50
+        summary['interval'] = {'mean': round(sum(intervals) / len(intervals), 3), 'p50': p50, 'p95': p95, 'p99': p99,
+                               'max': max(intervals)}
+        summary['gaps'] = len([i for i in intervals if i > 1.5 * nominal])
+    for key in ['capturems', 'encodems']:
+        values = [r[key] for r in rows if r[key] is not None]
+        if values:
+            p50, p95, p99 = _percentiles(values)
+            summary[key] = {'mean': round(sum(values) / len(values), 1), 'p50': p50, 'p95': p95, 'p99': p99,
+                            'max': max(values)}
+    sizes = [r['bytes'] for r in rows if r['bytes'] is not None]
+    if sizes:
+        summary['totalmb'] = round(sum(sizes) / 1048576, 1)
+    if rows:
+        summary['first'] = rows[0]['timestamp']
+        summary['last'] = rows[-1]['timestamp']
+    return summary
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python captureJournal.py capturefolder [nominal interval in seconds]')
+        exit(0)
+    nominal = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    summary = summariseJournal(readJournal(sys.argv[1]), nominal)
+    print(f'{summary["frames"]} frames from {summary.get("first")} to {summary.get("last")}')
+    if 'interval' in summary:
+        s = summary['interval']
+        print(f'interval (s)     mean {s["mean"]} p50 {s["p50"]} p95 {s["p95"]} p99 {s["p99"]} max {s["max"]}, '
+              f'{summary["gaps"]} gaps over 1.5x nominal')
+    for key, label in [('capturems', 'capture (ms)'), ('encodems', 'encode (ms) ')]:
+        if key in summary:
+            s = summary[key]
+            print(f'{label}     mean {s["mean"]} p50 {s["p50"]} p95 {s["p95"]} p99 {s["p99"]} max {s["max"]}')
+    if 'totalmb' in summary:
+        print(f'{summary["totalmb"]} MB of images')
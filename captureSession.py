@@ -0,0 +1,148 @@
+# Copyright (C) Mark McIntyre
+#
+# Long-lived RTSP capture session for the auroracam
+#
+import cv2
+import time
+import threading
+import logging
+
+log = logging.getLogger("logger")
+
+
+class CaptureSession(object):
+    """
+    Keep an RTSP stream open and hold the newest frame from it.
+
+    A background thread continually grabs frames from the camera so that the decoder never
+    falls behind the live stream. A frame is only converted to a BGR image when one has been
+    requested, so the cost of the colour conversion is paid once per captured frame rather
+    than once per stream frame. If the stream drops, the reader reconnects with exponential
+    backoff.
+
+    Parameters:
+        ipaddress   [string] - IP address of the camera
+        stream      [int]    - stream number, 0 for the main stream, 1 for the substream
+        minbackoff  [float]  - initial delay in seconds before reconnecting
+        maxbackoff  [float]  - maximum delay in seconds between reconnection attempts
+        maxfailures [int]    - consecutive failed reads before the stream is reopened
+    """
+    def __init__(self, ipaddress, stream=0, minbackoff=1, maxbackoff=60, maxfailures=10):
+        self.capstr = f'rtsp://{ipaddress}:554/user=admin&password=&channel=1&stream={stream}.sdp'
+        self.minbackoff = minbackoff
+        self.maxbackoff = maxbackoff
+        self.maxfailures = maxfailures
+        self.connects = 0
+        self._cap = None
+        self._frame = None
+        self._wanted = False
+        self._grabtime = None
+        self._newframe = threading.Condition()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ start the background reader thread """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._reader, name='capturesession', daemon=True)
+        self._thread.start()
+        log.info('capture session started')
+
+    def stop(self):
+        """ stop the reader thread and release the stream """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=15)
+            self._thread = None
+        self._close()
+        log.info('capture session stopped')
+
+    def isConnected(self):
+        return self._cap is not None
+
+    def frameAge(self):
+        """ seconds since the newest frame was grabbed, or None if there isn't one """
+        if self._grabtime is None:
+            return None
+        return time.monotonic() - self._grabtime
+
+    def getFrame(self, timeout=10):
+        """
+        Return the newest frame from the stream.
+
+        The reader thread decodes the next frame it grabs after this call, so the frame
+        returned is always fresh and the same frame is never handed out twice after the
+        stream stalls.
+
+        Returns:
+            frame   [numpy array] BGR image, or None if no new frame arrived in time
+        """
+        with self._newframe:
+            self._frame = None
+            self._wanted = True
+            gotone = self._newframe.wait_for(lambda: self._frame is not None, timeout=timeout)
+            frame = self._frame
+            self._frame = None
+            self._wanted = False
+        if not gotone:
+            return None
+        return frame
+
+    def _open(self):
+        try:
+            params = [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, 10000, cv2.CAP_PROP_READ_TIMEOUT_MSEC, 10000]
+            cap = cv2.VideoCapture(self.capstr, cv2.CAP_FFMPEG, params)
+        except Exception as e:
+            log.warning('unable to connect to camera')
+            log.warning(e, exc_info=True)
+            return False
+        if not cap.isOpened():
+            cap.release()
+            return False
+        self._cap = cap
+        return True
+
+    def _close(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+    def _reader(self):
+        backoff = self.minbackoff
+        failures = 0
+        while not self._stopping.is_set():
+            if self._cap is None:
+                if not self._open():
+                    log.warning(f'unable to open camera stream, retrying in {backoff}s')
+                    self._stopping.wait(backoff)
+                    backoff = min(backoff * 2, self.maxbackoff)
+                    continue
+                log.info('connected to camera stream')
+                self.connects += 1
+                failures = 0
+            frame = None
+            try:
+                ret = self._cap.grab()
+                if ret and self._wanted:
+                    ret, frame = self._cap.retrieve()
+            except Exception as e:
+                log.warning('unable to read frame')
+                log.warning(e, exc_info=True)
+                ret = False
+            if ret:
+                failures = 0
+                backoff = self.minbackoff
+                self._grabtime = time.monotonic()
+                if frame is not None:
+                    with self._newframe:
+                        self._frame = frame
+                        self._newframe.notify_all()
+            else:
+                failures += 1
+                if failures >= self.maxfailures:
+                    log.warning(f'camera stream dropped, reconnecting in {backoff}s')
+                    self._close()
+                    self._stopping.wait(backoff)
+                    backoff = min(backoff * 2, self.maxbackoff)
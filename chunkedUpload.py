@@ -0,0 +1,344 @@
+# Copyright (C) Mark McIntyre
+#
+# Chunked, concurrent and resumable uploads of large files such as the archive zips
+#
+import os
+import shlex
+import hashlib
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+
+from sftpManager import sftpmanager
+
+log = logging.getLogger("logger")
+
+chunksize = 4 * 1024 * 1024 # each SFTP worker writes this much at a time
+blocksize = 32768 # size of each pipelined SFTP write request
+
+# multipart settings for S3. Parts are sent several at a time, which stays inside the
+# connection pool size set in auroraCam.s3config
+s3transferconfig = TransferConfig(multipart_threshold=16 * 1024 * 1024, multipart_chunksize=16 * 1024 * 1024,
+                                  max_concurrency=8, use_threads=True)
+# when streaming, each part is held in memory until it is sent, so use fewer, smaller parts
+s3streamconfig = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024,
+                                max_concurrency=4, use_threads=True)
+
+
+def localChecksum(fnam):
+    """ the sha256 of a local file as a hex string """
+    sha = hashlib.sha256()
+    with open(fnam, 'rb') as inf:
+        for block in iter(lambda: inf.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def remoteChecksum(client, remotefile):
+    """
+    The sha256 of a file on the server, or None if the server doesn't let us run sha256sum
+
+    Parameters:
+        client      [SSHClient] - the connection to the server
+        remotefile  [string]    - the file to checksum
+    """
+    try:
+        _, stdout, _ = client.exec_command(f'sha256sum {shlex.quote(remotefile)}', timeout=600)
+        output = stdout.read().decode().split()
+        if stdout.channel.recv_exit_status() != 0 or len(output) == 0:
+            return None
+        return output[0].lower()
+    except Exception as e:
+        log.info(f'unable to checksum {remotefile} on the server')
+        log.info(e, exc_info=True)
+        return None
+
+
+def journalName(localfile):
+    """ the file next to the local file recording which chunks the server has acknowledged """
+    return localfile + '.chunks'
+
+
+def pendingChunks(journal, header, localsize, chunksize=chunksize):
+    """
+    The offsets of the chunks still to be sent, from the journal of an earlier attempt.
+
+    Any worker could have been part way through any chunk when an upload stopped, so the
+    size of the partial file on the server says nothing about which chunks are complete.
+    Instead each chunk is recorded in the journal once the server has acknowledged all of
+    it. If there is no journal, or it was written for a different file, target or chunk
+    size, every chunk is sent.
+
+    Parameters:
+        journal     [string] - the journal file
+        header      [string] - the first line the journal must have to be used
+        localsize   [int]    - size of the file being uploaded
+        chunksize   [int]    - bytes in each chunk
+
+    Returns:
+        list of offsets, in order
+    """
+    done = set()
+    try:
+        with open(journal) as inf:
+            if inf.readline().rstrip('\n') == header:
+                for li in inf:
+                    # a line cut short by a crash has no newline and is ignored
+                    if li.endswith('\n') and li.strip().isdigit():
+                        done.add(int(li))
+    except OSError:
+        pass
+    return [off for off in range(0, localsize, chunksize) if off not in done]
+
+
+def _remoteSize(ftp_client, remotefile):
+    try:
+        return ftp_client.stat(remotefile).st_size
+    except IOError:
+        return -1
+
+
+def _verifyAndRename(server, user, keyfile, partname, remotefile, size, checksum, manager):
+    """ check the uploaded file against the expected size and sha256, then move it into place """
+    with manager.sftp(server, user, keyfile) as ftp_client:
+        remotesize = _remoteSize(ftp_client, partname)
+        if remotesize != size:
+            raise IOError(f'{partname} is {remotesize} bytes, expected {size}')
+        remotesum = remoteChecksum(manager.sshClient(server, user, keyfile), partname)
+        if remotesum is None:
+            log.info(f'checksum not available on {server}, size verified only')
+        elif remotesum != checksum:
+            ftp_client.remove(partname)
+            raise IOError(f'checksum mismatch on {partname}, removed it')
+        if _remoteSize(ftp_client, remotefile) >= 0:
+            ftp_client.remove(remotefile)
+        try:
+            ftp_client.posix_rename(partname, remotefile)
+        except IOError:
+            ftp_client.rename(partname, remotefile)
+
+
+def _writeChunks(server, user, keyfile, localfile, partname, nextchunk, chunkdone, manager, chunksize):
+    """
+    worker: write chunks of the local file into the partial file until there are none left.
+    The last block of each chunk is written unpipelined, which waits for the server to
+    acknowledge every write before it, so a chunk is only reported done once it is all there.
+    """
+    written = 0
+    with manager.sftp(server, user, keyfile) as ftp_client, open(localfile, 'rb') as inf:
+        with ftp_client.open(partname, 'r+') as outf:
+            while True:
+                offset = nextchunk()
+                if offset is None:
+                    break
+                inf.seek(offset)
+                outf.seek(offset)
+                outf.set_pipelined(True)
+                remaining = chunksize
+                data = inf.read(min(blocksize, remaining))
+                while data:
+                    remaining -= len(data)
+                    nextdata = inf.read(min(blocksize, remaining)) if remaining > 0 else b''
+                    if not nextdata:
+                        outf.set_pipelined(False)
+                    outf.write(data)
+                    written += len(data)
+                    data = nextdata
+                outf.flush()
+                chunkdone(offset)
+    return written
+
+
+def sftpUpload(server, user, keyfile, localfile, remotefile, workers=4, chunksize=chunksize, manager=sftpmanager):
+    """
+    Upload a large file over SFTP in chunks, several at a time, resuming a partial upload.
+
+    The data goes to remotefile.part. Each chunk is recorded in a journal next to the local
+    file once the server has acknowledged it, so if the upload is interrupted only the
+    chunks not in the journal are sent next time. Each worker has its own SFTP channel on
+    the shared connection and pipelines its writes, so the link stays full even when the
+    round trip time is long. When all the data has been sent the size and sha256 are
+    compared with the local file and, if they match, the partial file is renamed to
+    remotefile. If the server won't run sha256sum only the size is checked.
+
+    Parameters:
+        server      [string] - the SFTP server
+        user        [string] - the user to log in as
+        keyfile     [string] - the SSH key to use
+        localfile   [string] - the file to upload
+        remotefile  [string] - the full remote path to upload to
+        workers     [int]    - number of chunks to send at once
+        chunksize   [int]    - bytes in each chunk
+
+    Returns:
+        the number of bytes sent. Raises an exception if the upload fails or doesn't verify.
+    """
+    st = os.stat(localfile)
+    localsize = st.st_size
+    partname = remotefile + '.part'
+    journal = journalName(localfile)
+    header = f'{server}:{remotefile} {localsize} {st.st_mtime_ns} {chunksize}'
+    with ThreadPoolExecutor(max_workers=1) as checksummer:
+        localsum = checksummer.submit(localChecksum, localfile)
+
+        with manager.sftp(server, user, keyfile) as ftp_client:
+            remotesize = _remoteSize(ftp_client, partname)
+            if remotesize > localsize:
+                ftp_client.remove(partname)
+                remotesize = -1
+            if remotesize < 0:
+                ftp_client.open(partname, 'w').close()
+                pending = list(range(0, localsize, chunksize))
+            else:
+                pending = pendingChunks(journal, header, localsize, chunksize)
+        if len(pending) < len(range(0, localsize, chunksize)):
+            log.info(f'resuming upload of {localfile}, {len(pending)} chunks left to send')
+        else:
+            with open(journal, 'w') as outf:
+                outf.write(header + '\n')
+
+        lock = threading.Lock()
+        offsets = iter(pending)
+
+        def nextchunk():
+            with lock:
+                return next(offsets, None)
+
+        with open(journal, 'a') as jf:
+            def chunkdone(offset):
+                with lock:
+                    jf.write(f'{offset}\n')
+                    jf.flush()
+
+            nworkers = max(1, min(workers, manager.maxchannels, len(pending)))
+            with ThreadPoolExecutor(max_workers=nworkers) as pool:
+                futures = [pool.submit(_writeChunks, server, user, keyfile, localfile, partname, nextchunk,
+                                       chunkdone, manager, chunksize) for _ in range(nworkers)]
+                sent = sum([f.result() for f in futures])
+
+        try:
+            _verifyAndRename(server, user, keyfile, partname, remotefile, localsize, localsum.result(), manager)
+        except Exception:
+            if _partRemoved(server, user, keyfile, partname, manager):
+                os.remove(journal)
+            raise
+    os.remove(journal)
+    return sent
+
+
+def _partRemoved(server, user, keyfile, partname, manager):
+    """ whether the partial file has gone from the server, eg after a checksum mismatch """
+    try:
+        with manager.sftp(server, user, keyfile) as ftp_client:
+            return _remoteSize(ftp_client, partname) < 0
+    except Exception:
+        return False
+
+
+def s3Upload(s3, localfile, bucket, key, extraargs=None):
+    """
+    Upload a file to S3, in parts sent in parallel if it is large.
+
+    Parameters:
+        s3          [object] - the S3 resource
+        localfile   [string] - the file to upload
+        bucket      [string] - the target bucket
+        key         [string] - the target key
+        extraargs   [dict]   - optional ExtraArgs such as the ContentType
+    """
+    s3.meta.client.upload_file(localfile, bucket, key, ExtraArgs=extraargs, Config=s3transferconfig)
+    return os.path.getsize(localfile)
+
+
+class _HashingWriter(object):
+    """ pass writes through to a file object, keeping count of the bytes and their sha256 """
+    def __init__(self, fp):
+        self.fp = fp
+        self.nbytes = 0
+        self.sha = hashlib.sha256()
+
+    def write(self, data):
+        self.sha.update(data)
+        self.nbytes += len(data)
+        self.fp.write(data)
+        return len(data)
+
+    def flush(self):
+        self.fp.flush()
+
+
+class _PipeReader(object):
+    """ read end of the pipe feeding an S3 upload, which fails rather than ending early if the writer fails """
+    def __init__(self, fp):
+        self.fp = fp
+        self.error = None
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        if not data and self.error is not None:
+            raise IOError('archive stream failed') from self.error
+        return data
+
+
+def sftpStreamUpload(server, user, keyfile, producer, remotefile, manager=sftpmanager):
+    """
+    Upload data over SFTP as it is generated, without writing it to local disk first.
+
+    The data is written with pipelined requests to remotefile.part, then checked and
+    renamed in the same way as sftpUpload. As the data only exists while it is being
+    generated, an interrupted upload can't be resumed and starts again next time.
+
+    Parameters:
+        producer    [function] - called with a writable file object, writes the data to it
+        remotefile  [string]   - the full remote path to upload to
+
+    Returns:
+        the number of bytes sent
+    """
+    partname = remotefile + '.part'
+    with manager.sftp(server, user, keyfile) as ftp_client:
+        with ftp_client.open(partname, 'w') as outf:
+            outf.set_pipelined(True)
+            writer = _HashingWriter(outf)
+            producer(writer)
+    _verifyAndRename(server, user, keyfile, partname, remotefile, writer.nbytes, writer.sha.hexdigest(), manager)
+    return writer.nbytes
+
+
+def s3StreamUpload(s3, producer, bucket, key, extraargs=None):
+    """
+    Upload data to S3 as a multipart upload as it is generated, without writing it to local
+    disk first. The producer runs in its own thread and writes into a pipe which the upload
+    reads from. If the producer fails the upload is abandoned.
+
+    Parameters:
+        s3          [object]   - the S3 resource
+        producer    [function] - called with a writable file object, writes the data to it
+        bucket      [string]   - the target bucket
+        key         [string]   - the target key
+
+    Returns:
+        the number of bytes sent
+    """
+    rfd, wfd = os.pipe()
+    reader = _PipeReader(os.fdopen(rfd, 'rb'))
+    writer = _HashingWriter(os.fdopen(wfd, 'wb'))
+
+    def produce():
+        try:
+            producer(writer)
+        except Exception as e:
+            reader.error = e
+            raise
+        finally:
+            writer.fp.close()
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(produce)
+        try:
+            s3.meta.client.upload_fileobj(reader, bucket, key, ExtraArgs=extraargs, Config=s3streamconfig)
+        finally:
+            reader.fp.close()
+        future.result()
+    return writer.nbytes
@@ -0,0 +1,284 @@
+# Copyright (C) Mark McIntyre
+#
+# Parsed, validated settings from config.ini, reloaded only when the file changes
+#
+import os
+import sys
+import time
+import struct
+import ctypes
+import ctypes.util
+import configparser
+import logging
+from typing import NamedTuple, Optional, Tuple
+
+log = logging.getLogger("logger")
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_eventheader = struct.Struct('iIII')
+
+
+class CameraSettings(NamedTuple):
+    """
+    An immutable snapshot of the settings for one camera, converted to the right types when
+    it is loaded. The aurora settings come from the AURORA section, which all the cameras
+    share. cfg is a ConfigParser holding the camera's settings in its auroracam section, for
+    functions that take the whole config.
+    """
+    name: str
+    ipaddress: str
+    macaddress: str
+    nightgain: int
+    rgbadj: Tuple[float, float, float]
+    daytimelapse: bool
+    streamtimelapse: bool
+    daystokeep: int
+    datadir: str
+    logdir: str
+    aurorathreshold: float
+    auroraalert: bool
+    auroraupload: bool
+    auroraperiod: Optional[float]
+    cfg: configparser.ConfigParser
+
+
+def _optionalInt(section, key, default):
+    if key not in section or section[key].strip() == '':
+        return default
+    return int(section[key])
+
+
+def _optionalFloat(section, key, default):
+    if key not in section or section[key].strip() == '':
+        return default
+    return float(section[key])
+
+
+def cameraSections(cfg):
+    """ the names of the sections for additional cameras, eg [camera2] """
+    return [s for s in cfg.sections() if s.lower().startswith('camera')]
+
+
+def cameraConfig(cfg, section):
+    """
+    A copy of the config in which the auroracam section has been overridden by the settings
+    in a camera section, so that it can be passed to anything that expects a single camera.
+    """
+    camcfg = configparser.ConfigParser()
+    camcfg.read_dict(cfg)
+    for key, val in cfg[section].items():
+        camcfg['auroracam'][key] = val
+    return camcfg
+
+
+def loadCameraSettings(cfgfile):
+    """
+    Read and validate the config file, including any additional cameras.
+
+    The first camera is configured by the auroracam section. Each further camera has its own
+    section named camera<something>, containing at least IPADDRESS, DATADIR and CAMID, and
+    optionally any other auroracam settings that differ, such as NIGHTGAIN or RGBADJ. The
+    location and everything else is shared with the first camera.
+
+    Returns:
+        a list of CameraSettings, the first camera first. Raises ValueError naming the
+        setting if a value is invalid.
+    """
+    cfg = configparser.ConfigParser()
+    if not cfg.read(cfgfile):
+        raise ValueError(f'unable to read {cfgfile}')
+    cameras = [_parseSettings('auroracam', cfg)]
+    for section in cameraSections(cfg):
+        for key in ['ipaddress', 'datadir', 'camid']:
+            if key not in cfg[section]:
+                raise ValueError(f'{key.upper()} must be set in [{section}]')
+        cameras.append(_parseSettings(section, cameraConfig(cfg, section)))
+    datadirs = [c.datadir for c in cameras]
+    if len(set(datadirs)) != len(datadirs):
+        raise ValueError('each camera must have its own DATADIR')
+    return cameras
+
+
+def loadSettings(cfgfile):
+    """
+    Read and validate the config file.
+
+    Returns:
+        the CameraSettings for the first camera. Raises ValueError naming the setting if a
+        value is invalid.
+    """
+    return loadCameraSettings(cfgfile)[0]
+
+
+def _parseSettings(name, cfg):
+    cam = cfg['auroracam']
+    try:
+        nightgain = int(cam['nightgain'])
+    except Exception:
+        raise ValueError(f'NIGHTGAIN must be a whole number, not {cam.get("nightgain")}')
+    try:
+        rgbadj = tuple([float(x) for x in cam.get('rgbadj', '1.0,1.0,1.0').split(',')])
+        if len(rgbadj) != 3 or min(rgbadj) < 0:
+            raise ValueError
+    except Exception:
+        raise ValueError(f'RGBADJ must be three positive numbers eg 1.0,0.9,1.0, not {cam.get("rgbadj")}')
+    try:
+        daystokeep = _optionalInt(cam, 'daystokeep', 3)
+        if daystokeep < 0:
+            raise ValueError
+    except Exception:
+        raise ValueError(f'DAYSTOKEEP must be a whole number of days, not {cam.get("daystokeep")}')
+    try:
+        daytimelapse = _optionalInt(cam, 'daytimelapse', 0) == 1
+        streamtimelapse = _optionalInt(cam, 'streamtimelapse', 0) == 1
+    except Exception:
+        raise ValueError('DAYTIMELAPSE and STREAMTIMELAPSE must be 0 or 1')
+    aurora = cfg['aurora'] if cfg.has_section('aurora') else {}
+    try:
+        aurorathreshold = _optionalFloat(aurora, 'threshold', 1.0)
+        if aurorathreshold <= 0:
+            raise ValueError
+    except Exception:
+        raise ValueError(f'THRESHOLD in [aurora] must be a positive number, not {aurora.get("threshold")}')
+    try:
+        auroraalert = _optionalInt(aurora, 'alert', 0) == 1
+        auroraupload = _optionalInt(aurora, 'upload', 0) == 1
+    except Exception:
+        raise ValueError('ALERT and UPLOAD in [aurora] must be 0 or 1')
+    try:
+        auroraperiod = _optionalFloat(aurora, 'period', None)
+        if auroraperiod is not None and auroraperiod < 0.5:
+            raise ValueError
+    except Exception:
+        raise ValueError(f'PERIOD in [aurora] must be at least 0.5 seconds, not {aurora.get("period")}')
+    return CameraSettings(name=name, ipaddress=cam['ipaddress'], macaddress=cam.get('macaddress', ''),
+                          nightgain=nightgain, rgbadj=rgbadj, daytimelapse=daytimelapse, streamtimelapse=streamtimelapse,
+                          daystokeep=daystokeep, datadir=os.path.expanduser(cam['datadir']),
+                          logdir=os.path.expanduser(cam['logdir']), aurorathreshold=aurorathreshold,
+                          auroraalert=auroraalert, auroraupload=auroraupload, auroraperiod=auroraperiod, cfg=cfg)
+
+
+class _Inotify(object):
+    """ minimal non-blocking inotify watch on a folder, using libc through ctypes """
+    def __init__(self, dirname, filename):
+        self.filename = filename.encode()
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch the folder rather than the file, as editors often save by replacing the file
+        wd = libc.inotify_add_watch(self.fd, dirname.encode(), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed on {dirname}')
+
+    def changed(self):
+        """ whether the file has changed since the last call. Never blocks """
+        changed = False
+        while True:
+            try:
+                buf = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return changed
+            pos = 0
+            while pos < len(buf):
+                _, _, _, namelen = _eventheader.unpack_from(buf, pos)
+                pos += _eventheader.size
+                if buf[pos:pos + namelen].rstrip(b'\0') == self.filename:
+                    changed = True
+                pos += namelen
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher(object):
+    """
+    Hold the current CameraSettings for each camera and reload them when config.ini changes.
+
+    On Linux the file is watched with inotify, so checking for a change is a single
+    non-blocking read. Elsewhere, or if inotify isn't available, the file's modification
+    time is checked at most every interval seconds. If the changed file can't be parsed the
+    error is logged and the previous settings are kept. Cameras can't be added or removed
+    without a restart.
+
+    Parameters:
+        cfgfile     [string] - the config file
+        interval    [int]    - seconds between checks when polling
+    """
+    def __init__(self, cfgfile, interval=5):
+        self.cfgfile = os.path.abspath(cfgfile)
+        self.interval = interval
+        self.reloads = 0
+        self._cameras = loadCameraSettings(self.cfgfile)
+        self._mtime = self._getmtime()
+        self._lastcheck = time.monotonic()
+        self._inotify = None
+        if sys.platform.startswith('linux'):
+            try:
+                self._inotify = _Inotify(os.path.dirname(self.cfgfile), os.path.basename(self.cfgfile))
+            except Exception as e:
+                log.info(f'inotify not available, polling {self.cfgfile} instead')
+                log.info(e, exc_info=True)
+
+    def _getmtime(self):
+        try:
+            return os.stat(self.cfgfile).st_mtime_ns
+        except OSError:
+            return None
+
+    def _changed(self):
+        if self._inotify is not None:
+            return self._inotify.changed()
+        now = time.monotonic()
+        if now - self._lastcheck < self.interval:
+            return False
+        self._lastcheck = now
+        mtime = self._getmtime()
+        if mtime != self._mtime:
+            self._mtime = mtime
+            return True
+        return False
+
+    def _reload(self):
+        if not self._changed():
+            return
+        try:
+            cameras = loadCameraSettings(self.cfgfile)
+        except Exception as e:
+            log.warning(f'keeping previous settings, {self.cfgfile} is invalid: {e}')
+            return
+        if [c.name for c in cameras] != [c.name for c in self._cameras]:
+            log.warning('cameras have been added or removed, restart to pick up the change')
+            cameras = [c for c in cameras if c.name in [old.name for old in self._cameras]]
+            if len(cameras) != len(self._cameras):
+                return
+        self._cameras = cameras
+        self.reloads += 1
+        log.info(f'reloaded {self.cfgfile}')
+
+    def settings(self, name=None):
+        """
+        The current settings for a camera, by default the first, reloading them first if the
+        file has changed
+        """
+        self._reload()
+        if name is None:
+            return self._cameras[0]
+        return [c for c in self._cameras if c.name == name][0]
+
+    def cameras(self):
+        """ the current settings for all the cameras, reloading them first if the file has changed """
+        self._reload()
+        return list(self._cameras)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
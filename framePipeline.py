@@ -0,0 +1,252 @@
+# Copyright (C) Mark McIntyre
+#
+# In-memory processing of captured frames: colour adjustment, annotation and saving
+#
+import cv2
+import os
+import sys
+import timeit
+import numpy as np
+import logging
+from PIL import Image, ImageFont, ImageDraw
+
+log = logging.getLogger("logger")
+
+jpegquality = 75 # matches the quality of the images PIL used to write
+
+
+def parseRGBAdj(rgbadj):
+    """
+    Convert the RGBADJ config value into a tuple of floats
+
+    Parameters:
+        rgbadj  [string] comma separated red, green and blue gains eg '1.0,0.9,1.0'
+    """
+    radj, gadj, badj = rgbadj.split(',')
+    return float(radj), float(gadj), float(badj)
+
+
+def applyColourGains(frame, red=1, green=1, blue=1):
+    """
+    Scale the colour channels of a BGR frame in a single vectorised multiply.
+
+    Returns the frame unchanged if no channel is being reduced.
+    """
+    if red >= 0.99 and green >= 0.99 and blue >= 0.99:
+        return frame
+    gains = np.array([blue, green, red], dtype=np.float32)
+    return np.multiply(frame, gains, dtype=np.float32).astype(np.uint8)
+
+
+def hexToBGR(color):
+    """ convert a '#rgb' or '#rrggbb' colour string into a BGR tuple """
+    color = color.lstrip('#')
+    if len(color) == 3:
+        color = ''.join([c*2 for c in color])
+    r, g, b = int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16)
+    return (b, g, r)
+
+
+def loadFont(fntheight=20):
+    try:
+        fnt = ImageFont.truetype("arial.ttf", fntheight)
+    except Exception:
+        fnt = ImageFont.truetype("DejaVuSans.ttf", fntheight)
+    return fnt
+
+
+class FrameAnnotator(object):
+    """
+    Draw text onto frames from a cache of pre-rendered glyphs.
+
+    The font is loaded once, the fixed prefix (typically the hostname) is rendered once as
+    a single bitmap, and each character of the variable part is rendered the first time it
+    is seen. Annotating a frame then only involves joining the cached bitmaps into a mask
+    and blending it into the bottom left of the frame array.
+
+    Parameters:
+        prefix      [string] - fixed text that starts every message
+        color       [string] - hex colour string for the text
+        fntheight   [int]    - font size in pixels
+        chars       [string] - characters to pre-render, others are rendered on demand
+    """
+    def __init__(self, prefix='', color='#FFFFFF', fntheight=20, chars='0123456789-: '):
+        self.prefix = prefix
+        self.color = np.array(hexToBGR(color), dtype=np.uint16)
+        self.fntheight = fntheight
+        self.fnt = loadFont(fntheight)
+        ascent, descent = self.fnt.getmetrics()
+        self.lineheight = ascent + descent
+        self.glyphs = {}
+        self.prefixmask = None
+        self.prefixadvance = 0.0
+        if prefix:
+            self.prefixmask, self.prefixadvance = self._render(prefix)
+        for c in chars:
+            self._glyph(c)
+
+    def _render(self, text):
+        """ render text as an 8-bit alpha mask, returning the mask and its advance width """
+        advance = self.fnt.getlength(text)
+        img = Image.new('L', (int(np.ceil(advance)) + self.fntheight, self.lineheight), 0)
+        ImageDraw.Draw(img).text((0, 0), text, font=self.fnt, fill=255)
+        return np.asarray(img), advance
+
+    def _glyph(self, c):
+        if c not in self.glyphs:
+            self.glyphs[c] = self._render(c)
+        return self.glyphs[c]
+
+    def textMask(self, text):
+        """ build the alpha mask for text from the cached bitmaps """
+        parts = []
+        x = 0.0
+        if self.prefixmask is not None and text.startswith(self.prefix):
+            parts.append((0, self.prefixmask))
+            x = self.prefixadvance
+            text = text[len(self.prefix):]
+        for c in text:
+            glyph, advance = self._glyph(c)
+            parts.append((int(round(x)), glyph))
+            x += advance
+        width = max([pos + glyph.shape[1] for pos, glyph in parts]) if parts else 0
+        mask = np.zeros((self.lineheight, width), dtype=np.uint8)
+        for pos, glyph in parts:
+            region = mask[:, pos:pos + glyph.shape[1]]
+            np.maximum(region, glyph, out=region)
+        return mask
+
+    def annotate(self, frame, text, x=15, y=None):
+        """
+        Blend text into a BGR frame in place. By default the text goes at the bottom left,
+        in the same position annotateFrame uses.
+        """
+        height, width = frame.shape[:2]
+        if y is None:
+            y = height - self.fntheight - 15
+        mask = self.textMask(text)
+        h = min(mask.shape[0], height - y)
+        w = min(mask.shape[1], width - x)
+        if h <= 0 or w <= 0:
+            return frame
+        alpha = mask[:h, :w, np.newaxis].astype(np.uint16)
+        region = frame[y:y + h, x:x + w]
+        region[:] = ((region * (255 - alpha) + self.color * alpha + 127) // 255).astype(np.uint8)
+        return frame
+
+
+_annotators = {}
+
+
+def getAnnotator(prefix='', color='#FFFFFF', fntheight=20):
+    """ return a cached FrameAnnotator, creating it the first time it is needed """
+    key = (prefix, color, fntheight)
+    if key not in _annotators:
+        _annotators[key] = FrameAnnotator(prefix, color=color, fntheight=fntheight)
+    return _annotators[key]
+
+
+def annotateFrame(frame, message, color='#000', fntheight=20):
+    """
+    Annotate a frame with a message at the bottom left, in the same position and font
+    as annotateImageArbitrary. Only the strip of the frame containing the text is
+    converted for drawing, and the frame is updated in place.
+
+    Arguments:
+        frame:      [numpy array] BGR image to be annotated
+        message:    [str] message to put on the image
+        color:      [str] hex colour string, default '#000' which is black
+        fntheight:  [int] font size in pixels
+    """
+    height = frame.shape[0]
+    fnt = loadFont(fntheight)
+    top = max(height - 2 * fntheight - 15, 0)
+    strip = Image.fromarray(frame[top:])
+    ImageDraw.Draw(strip).text((15, height - fntheight - 15 - top), message, font=fnt, fill=hexToBGR(color))
+    frame[top:] = np.asarray(strip)
+    return frame
+
+
+def writeFrame(frame, fnam, quality=jpegquality):
+    """
+    Encode a frame to JPEG and write it to disk, retrying if the write fails. The file is
+    written under a temporary name and renamed, so anything reading it in the background
+    never sees a partial image.
+    """
+    ret = False
+    retries = 0
+    while not ret and retries < 10:
+        try:
+            ret, jpg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if ret:
+                with open(fnam + '.tmp', 'wb') as outf:
+                    outf.write(jpg.tobytes())
+                os.replace(fnam + '.tmp', fnam)
+        except Exception as e:
+            log.info(f'unable to save image {fnam}')
+            log.info(e, exc_info=True)
+            ret = False
+        retries += 1
+    return ret
+
+
+def writeThumbnail(frame, fnam, width=160, quality=70):
+    """
+    Write a small copy of a frame for the web gallery, creating the folder if needed.
+    """
+    height = max(1, int(round(frame.shape[0] * width / frame.shape[1])))
+    thumb = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    os.makedirs(os.path.dirname(fnam), exist_ok=True)
+    return writeFrame(thumb, fnam, quality=quality)
+
+
+def processFrame(frame, fnam, title, rgbadj=(1, 1, 1), color='#FFFFFF', annotator=None):
+    """
+    Apply the colour gains to a raw frame, annotate it and write it as a JPEG. The frame
+    is encoded once, rather than being written, reread and rewritten by each step.
+
+    Parameters:
+        frame   [numpy array] raw BGR frame from the camera
+        fnam    [string] file to write the JPEG to
+        title   [string] annotation to add to the frame
+        rgbadj  [tuple] red, green and blue gains
+        color   [string] hex colour for the annotation
+        annotator [FrameAnnotator] optional cached annotator, which is much faster than drawing with PIL
+
+    Returns:
+        the processed frame, or None if it could not be saved
+    """
+    radj, gadj, badj = rgbadj
+    frame = applyColourGains(frame, red=radj, green=gadj, blue=badj)
+    if not frame.flags.writeable:
+        frame = frame.copy()
+    if annotator is not None:
+        annotator.annotate(frame, title)
+    else:
+        annotateFrame(frame, title, color=color)
+    if not writeFrame(frame, fnam):
+        return None
+    return frame
+
+
+def benchmarkAnnotation(width=1920, height=1080, number=200):
+    """
+    Compare the per-frame cost of annotating with PIL and with the cached glyph annotator
+    """
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    title = 'auroracam 2024-09-17 20:00:00'
+    annotator = FrameAnnotator('auroracam ')
+    piltime = timeit.timeit(lambda: annotateFrame(frame, title, color='#FFFFFF'), number=number) / number
+    cachedtime = timeit.timeit(lambda: annotator.annotate(frame, title), number=number) / number
+    enctime = timeit.timeit(lambda: cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, jpegquality]), number=10) / 10
+    print(f'PIL annotation      {piltime*1000:.3f} ms per frame')
+    print(f'cached annotation   {cachedtime*1000:.3f} ms per frame')
+    print(f'JPEG encode         {enctime*1000:.3f} ms per frame, for comparison')
+    return piltime, cachedtime
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmarkAnnotation()
+    else:
+        print('usage: python framePipeline.py benchmark')
@@ -0,0 +1,213 @@
+# Copyright (C) Mark McIntyre
+#
+# Check the frames in a capture folder before they are made into a timelapse
+#
+import os
+import sys
+import json
+import glob
+import zlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+log = logging.getLogger("logger")
+
+scanname = 'framescan.json'
+blacklevel = 3 # frames with a mean brightness below this, out of 255, are treated as black
+annotationheight = 0.1 # fraction of the frame at the bottom holding the timestamp, ignored when comparing frames
+hashsize = 8 # dHash is hashsize x hashsize bits
+# frames are named for the time they were captured, which leaves out other images such as the keogram
+frameglob = '????????_??????.jpg'
+
+
+def frameList(dirname):
+    """ the frames in a capture folder, in time order """
+    return sorted(glob.glob(os.path.join(dirname, frameglob)))
+
+
+def hasEOI(fnam):
+    """ whether a file starts with the JPEG start marker and ends with the end marker, ie isn't truncated """
+    try:
+        with open(fnam, 'rb') as inf:
+            if inf.read(2) != b'\xff\xd8':
+                return False
+            inf.seek(-32, os.SEEK_END)
+            tail = inf.read()
+    except OSError:
+        return False
+    # some encoders pad the file after the end marker
+    return tail.rstrip(b'\x00\r\n ').endswith(b'\xff\xd9')
+
+
+def scanFrame(fnam):
+    """
+    Check one frame.
+
+    The JPEG is decoded at 1/8 scale, which only needs the DC coefficient of each block and
+    so is many times faster than a full decode. The strip at the bottom with the timestamp
+    is cropped off, so that a repeated frame with a new timestamp still matches.
+
+    Returns:
+        dict with ok, whether the frame is intact, black, whether it is black, dhash, the
+        perceptual hash as a hex string, and digest, a checksum of the decoded pixels
+    """
+    res = {'ok': False, 'black': False, 'dhash': None, 'digest': None}
+    if not hasEOI(fnam):
+        return res
+    try:
+        with Image.open(fnam) as img:
+            img.draft('L', (img.size[0] // 8, img.size[1] // 8))
+            img = img.convert('L')
+            img = img.crop((0, 0, img.size[0], int(img.size[1] * (1 - annotationheight))))
+            pixels = img.tobytes()
+            small = img.resize((hashsize + 1, hashsize), Image.BILINEAR).tobytes()
+    except Exception:
+        return res
+    res['ok'] = True
+    res['black'] = sum(pixels) / max(len(pixels), 1) < blacklevel
+    # dHash: one bit per pixel, set where it is brighter than its right-hand neighbour
+    bits = 0
+    for row in range(hashsize):
+        for col in range(hashsize):
+            i = row * (hashsize + 1) + col
+            bits = (bits << 1) | (small[i] > small[i + 1])
+    res['dhash'] = f'{bits:0{hashsize * hashsize // 4}x}'
+    res['digest'] = zlib.crc32(pixels)
+    return res
+
+
+def _scanMany(fnames):
+    """ worker: scan a batch of frames """
+    return [scanFrame(f) for f in fnames]
+
+
+def classifyFrame(res, prev):
+    """
+    Whether a scanned frame is good, corrupt, black or a duplicate, given the scan of the
+    last good frame before it, or None if there isn't one.
+
+    A frame is a repeat if it has the same perceptual hash as the frame before it and the
+    same decoded pixels, apart from the timestamp. The hash alone would also match frames of
+    a still, cloudless sky, where the sensor noise is all that changes between frames.
+    """
+    if not res['ok']:
+        return 'corrupt'
+    if res['black']:
+        return 'black'
+    if prev is not None and res['dhash'] == prev['dhash'] and res['digest'] == prev['digest']:
+        return 'duplicate'
+    return 'good'
+
+
+def loadScan(dirname):
+    """ the saved scan results for a folder, keyed by frame name """
+    try:
+        return json.load(open(os.path.join(dirname, scanname)))
+    except Exception:
+        return {}
+
+
+def saveScan(dirname, results):
+    """ save scan results, keyed by frame name and including the size and mtime of each frame """
+    scanfile = os.path.join(dirname, scanname)
+    try:
+        json.dump(results, open(scanfile + '.tmp', 'w'))
+        os.replace(scanfile + '.tmp', scanfile)
+    except Exception as e:
+        log.warning(f'unable to save {scanfile}')
+        log.info(e, exc_info=True)
+
+
+def scanEntry(fnam, cache=None):
+    """
+    The scan result of one frame along with its size and mtime, as saved in framescan.json,
+    taken from the cache if the frame hasn't changed. None if the frame has gone.
+    """
+    try:
+        st = os.stat(fnam)
+    except OSError:
+        return None
+    cached = (cache or {}).get(os.path.basename(fnam))
+    if cached is not None and cached['size'] == st.st_size and cached['mtime'] == st.st_mtime_ns:
+        return cached
+    res = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+    res.update(scanFrame(fnam))
+    return res
+
+
+def scanFolder(dirname, workers=None, batchsize=200):
+    """
+    Check all the frames in a capture folder for truncated, black and repeated images.
+
+    The frames are scanned in batches across a pool of processes. The results are saved in
+    framescan.json in the folder along with the size and time of each file, so only new or
+    changed frames are scanned next time. See classifyFrame for how repeats are spotted.
+
+    Parameters:
+        dirname     [string] - the capture folder
+        workers     [int]    - number of processes, default one per core
+        batchsize   [int]    - frames sent to a process at a time
+
+    Returns:
+        dict with lists of the good, corrupt, black and duplicate frames, each sorted by name
+    """
+    dirname = os.path.normpath(os.path.expanduser(dirname))
+    cache = loadScan(dirname)
+    jpgs = frameList(dirname)
+    results = {}
+    toscan = []
+    for jpg in jpgs:
+        name = os.path.basename(jpg)
+        try:
+            st = os.stat(jpg)
+        except OSError:
+            continue
+        cached = cache.get(name)
+        if cached is not None and cached['size'] == st.st_size and cached['mtime'] == st.st_mtime_ns:
+            results[name] = cached
+        else:
+            results[name] = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+            toscan.append(jpg)
+    if toscan:
+        batches = [toscan[i:i + batchsize] for i in range(0, len(toscan), batchsize)]
+        if len(batches) == 1:
+            scanned = [_scanMany(batches[0])]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                scanned = list(pool.map(_scanMany, batches))
+        for batch, batchres in zip(batches, scanned):
+            for jpg, res in zip(batch, batchres):
+                results[os.path.basename(jpg)].update(res)
+        log.info(f'scanned {len(toscan)} frames in {dirname}')
+        saveScan(dirname, results)
+    summary = {'good': [], 'corrupt': [], 'black': [], 'duplicate': []}
+    prev = None
+    for name in sorted(results.keys()):
+        res = results[name]
+        verdict = classifyFrame(res, prev)
+        summary[verdict].append(os.path.join(dirname, name))
+        if verdict == 'good':
+            prev = res
+    return summary
+
+
+def goodFrames(dirname, workers=None):
+    """ the frames in a capture folder that should go into the timelapse, logging any that are left out """
+    summary = scanFolder(dirname, workers)
+    dropped = {k: len(v) for k, v in summary.items() if k != 'good' and v}
+    if dropped:
+        log.info(f'leaving out {", ".join([f"{n} {k}" for k, n in dropped.items()])} frames from {dirname}')
+    return summary['good']
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python frameScan.py capturefolder')
+        exit(0)
+    summary = scanFolder(sys.argv[1])
+    for key in ['corrupt', 'black', 'duplicate']:
+        for fnam in summary[key]:
+            print(f'{key:10s} {os.path.basename(fnam)}')
+    print(f'{len(summary["good"])} good, {len(summary["corrupt"])} corrupt, {len(summary["black"])} black, '
+          f'{len(summary["duplicate"])} duplicate frames')
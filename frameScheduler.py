@@ -0,0 +1,126 @@
+# Copyright (C) Mark McIntyre
+#
+# Fixed-rate scheduling of frame captures, and a record of how well we keep to it
+#
+import time
+import bisect
+import collections
+import logging
+
+log = logging.getLogger("logger")
+
+# upper edges of the histogram buckets in milliseconds. Anything slower goes in the last bucket
+bucketedges = [50, 100, 200, 500, 1000, 1500, 2000, 3000, 5000, 10000]
+
+
+class LatencyHistogram(object):
+    """
+    Rolling histogram of the last few hundred timings, in whole milliseconds.
+
+    Parameters:
+        maxlen  [int]  - number of recent samples to keep
+        edges   [list] - upper edges of the buckets in milliseconds
+    """
+    def __init__(self, maxlen=1800, edges=bucketedges):
+        self.edges = list(edges)
+        self.samples = collections.deque(maxlen=maxlen)
+        self.counts = [0] * (len(self.edges) + 1)
+
+    def add(self, ms):
+        ms = int(round(ms))
+        if len(self.samples) == self.samples.maxlen:
+            self.counts[bisect.bisect_left(self.edges, self.samples[0])] -= 1
+        self.samples.append(ms)
+        self.counts[bisect.bisect_left(self.edges, ms)] += 1
+
+    def percentile(self, pct):
+        if not self.samples:
+            return 0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def summary(self):
+        """ count, mean, percentiles and max in milliseconds, and the bucket counts """
+        n = len(self.samples)
+        labels = [f'<={e}' for e in self.edges] + [f'>{self.edges[-1]}']
+        return {'count': n, 'mean': round(sum(self.samples) / n) if n else 0,
+                'p50': self.percentile(50), 'p95': self.percentile(95), 'p99': self.percentile(99),
+                'max': max(self.samples) if n else 0,
+                'buckets': dict(zip(labels, self.counts))}
+
+
+class FrameScheduler(object):
+    """
+    Fire frame captures at a fixed rate on the monotonic clock.
+
+    Ticks are at fixed multiples of the period from the start, so however long each frame
+    takes to process the captures don't drift. If a frame overruns so that one or more ticks
+    have already passed, those ticks are skipped rather than run back to back, keeping the
+    spacing of the frames even.
+
+    The time from each tick to the end of the frame's processing, and the interval between
+    frames, are recorded in rolling histograms.
+
+    Parameters:
+        period  [float] - seconds between frames
+    """
+    def __init__(self, period):
+        self.period = period
+        self.start = time.monotonic()
+        self.ticks = 0
+        self.skipped = 0
+        self.ticktime = self.start
+        self.lastframe = None
+        self.latency = LatencyHistogram()
+        self.intervals = LatencyHistogram()
+
+    def wait(self):
+        """ sleep until the next tick, skipping any that have already passed, and return its time """
+        now = time.monotonic()
+        nexttick = self.ticks + 1
+        due = self.start + nexttick * self.period
+        if now > due:
+            missed = int((now - due) // self.period) + 1
+            self.skipped += missed
+            nexttick += missed
+            due = self.start + nexttick * self.period
+        time.sleep(max(0, due - time.monotonic()))
+        self.ticks = nexttick
+        self.ticktime = due
+        return due
+
+    def setPeriod(self, period):
+        """ change the time between frames, from the next tick on """
+        if period == self.period:
+            return
+        log.info(f'capturing every {period} seconds')
+        # keep the tick count, so the stats carry on, and place the next tick a period after the last
+        self.start = self.ticktime - self.ticks * period
+        self.period = period
+
+    def frameDone(self):
+        """
+        Record that this tick's frame has been captured and saved.
+
+        Returns:
+            the interval since the previous frame in seconds, or None for the first frame
+        """
+        now = time.monotonic()
+        self.latency.add((now - self.ticktime) * 1000)
+        interval = None
+        if self.lastframe is not None:
+            interval = now - self.lastframe
+            self.intervals.add(interval * 1000)
+        self.lastframe = now
+        return interval
+
+    def stats(self):
+        return {'period': self.period, 'ticks': self.ticks, 'skipped': self.skipped,
+                'latency': self.latency.summary(), 'interval': self.intervals.summary()}
+
+    def logStats(self):
+        stats = self.stats()
+        lat, ivl = stats['latency'], stats['interval']
+        log.info(f'frame timing: {stats["skipped"]} of {stats["ticks"]} ticks skipped, latency p50 {lat["p50"]}ms '
+                 f'p95 {lat["p95"]}ms max {lat["max"]}ms, interval p50 {ivl["p50"]}ms p95 {ivl["p95"]}ms')
+        return stats
@@ -11,7 +11,7 @@ chmod 755 ~
 cd ~/source/auroracam
 mkdir -p ./bkp
 [ -f config.ini ] && mv config.ini config.bkp
-flist=(startAuroraCam.sh auroraCam.py config.ini setExpo.py sendToYoutube.py makeImageIndex.py imgindex.html.template index.html redoTimelapse.py mqtt.cfg requirements.txt auroracam.service makeMP4.sh camManager.sh CamManager.py)  
+flist=(startAuroraCam.sh auroraCam.py config.ini setExpo.py sendToYoutube.py makeImageIndex.py imgindex.html.template index.html redoTimelapse.py mqtt.cfg requirements.txt auroracam.service makeMP4.sh camManager.sh CamManager.py captureSession.py framePipeline.py timelapseEncoder.py taskQueue.py sftpManager.py archiver.py chunkedUpload.py sunSchedule.py configWatcher.py frameScheduler.py captureJournal.py frameScan.py sessionCatalog.py spacePlanner.py keogram.py retention.py auroraDetector.py)  
 for f in ${flist[@]} ; do
 [ -f ${f} ] && mv ${f} ./bkp
 wget https://raw.githubusercontent.com/markmac99/auroracam/refs/heads/master/${f}  
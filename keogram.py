@@ -0,0 +1,211 @@
+# Copyright (C) Mark McIntyre
+#
+# Keograms: the centre column of each frame of a night, side by side, as an overview of the night
+#
+import os
+import sys
+import time
+import timeit
+import logging
+import cv2
+import numpy as np
+
+from frameScan import frameList
+
+log = logging.getLogger("logger")
+
+keogramname = 'keogram.jpg'
+keogramdata = 'keogram.dat' # the columns captured so far, removed once the keogram is finished
+headersize = 4 # the column height, as a little-endian uint32
+
+
+def keogramColumn(frame, step=1):
+    """ the north-south slice through the middle of a frame, taking every step'th pixel """
+    return frame[::step, frame.shape[1] // 2]
+
+
+def _writeKeogram(keo, outname, quality):
+    """ save a keogram, replacing any earlier one in one step so the web page never sees half a file """
+    tmpname = outname[:-4] + '.tmp.jpg'
+    if not cv2.imwrite(tmpname, np.ascontiguousarray(keo), [cv2.IMWRITE_JPEG_QUALITY, quality]):
+        return None
+    os.replace(tmpname, outname)
+    return outname
+
+
+def readColumns(datname):
+    """
+    The columns saved in a keogram.dat file, memory mapped rather than read into memory.
+
+    Returns:
+        array of shape (columns, height, 3), or None if there are none
+    """
+    try:
+        size = os.path.getsize(datname)
+        with open(datname, 'rb') as inf:
+            height = int.from_bytes(inf.read(headersize), 'little')
+    except OSError:
+        return None
+    if height == 0:
+        return None
+    ncols = (size - headersize) // (height * 3)
+    if ncols <= 0:
+        return None
+    return np.memmap(datname, dtype=np.uint8, mode='r', offset=headersize, shape=(ncols, height, 3))
+
+
+class KeogramWriter(object):
+    """
+    Build the keogram for a capture session as the frames are captured.
+
+    The centre column of each frame, at half height to match keogramFromFolder, is appended
+    to keogram.dat in the capture folder, which costs a few microseconds per frame. The file
+    is memory mapped to render keogram.jpg, so no frames are read back from disk. If the
+    process restarts, the writer carries on after the columns already saved.
+
+    Parameters:
+        dirname         [string] - the capture folder
+        renderinterval  [int]    - seconds between renders of the keogram during the session
+    """
+    def __init__(self, dirname, renderinterval=600, step=2):
+        self.dirname = os.path.normpath(dirname)
+        self.fname = os.path.join(self.dirname, keogramdata)
+        self.outname = os.path.join(self.dirname, keogramname)
+        self.renderinterval = renderinterval
+        self.step = step
+        self.height = None
+        self.ncols = 0
+        os.makedirs(self.dirname, exist_ok=True)
+        existing = readColumns(self.fname)
+        if existing is not None:
+            self.ncols, self.height = existing.shape[:2]
+            del existing
+            # drop any partly written column
+            with open(self.fname, 'r+b') as outf:
+                outf.truncate(headersize + self.ncols * self.height * 3)
+        self._outf = open(self.fname, 'ab')
+        self._lastrender = time.monotonic()
+
+    def add(self, frame):
+        """ append the centre column of a BGR frame """
+        col = keogramColumn(frame, self.step)
+        if self.height is None:
+            self.height = col.shape[0]
+            self._outf.seek(0)
+            self._outf.truncate()
+            self._outf.write(self.height.to_bytes(headersize, 'little'))
+        elif col.shape[0] != self.height:
+            # the camera resolution has changed
+            col = cv2.resize(col[:, np.newaxis], (1, self.height))[:, 0]
+        self._outf.write(np.ascontiguousarray(col).tobytes())
+        self.ncols += 1
+
+    def render(self, quality=90):
+        """
+        Render keogram.jpg from the columns so far.
+
+        Returns:
+            the name of the keogram, or None if there are no columns yet
+        """
+        self._lastrender = time.monotonic()
+        if self._outf is None or self.ncols == 0:
+            return None
+        self._outf.flush()
+        columns = readColumns(self.fname)
+        if columns is None:
+            return None
+        res = _writeKeogram(columns.transpose(1, 0, 2), self.outname, quality)
+        del columns
+        return res
+
+    def renderIfDue(self):
+        """ render the keogram if it hasn't been rendered for renderinterval seconds """
+        if time.monotonic() - self._lastrender < self.renderinterval:
+            return None
+        return self.render()
+
+    def finish(self):
+        """
+        Render the keogram at the end of the session and remove the columns file.
+
+        Returns:
+            the name of the keogram, or None if there were no frames
+        """
+        res = self.render()
+        self.close()
+        if res is not None:
+            os.remove(self.fname)
+            log.info(f'created {res} from {self.ncols} frames')
+        return res
+
+    def close(self):
+        if self._outf is not None:
+            self._outf.close()
+            self._outf = None
+
+
+def keogramFromFolder(dirname, outname=None, quality=90):
+    """
+    Make a keogram for a capture folder. If the columns were saved as the frames were
+    captured they are used; otherwise each frame is decoded at half size, which is faster
+    and gives a keogram of a more manageable height.
+
+    Parameters:
+        dirname     [string] - the capture folder
+        outname     [string] - the image to create, default keogram.jpg in the folder
+
+    Returns:
+        the name of the keogram, or None if there were no frames
+    """
+    outname = outname or os.path.join(dirname, keogramname)
+    datname = os.path.join(dirname, keogramdata)
+    columns = readColumns(datname)
+    if columns is not None:
+        ncols = columns.shape[0]
+        res = _writeKeogram(columns.transpose(1, 0, 2), outname, quality)
+        del columns
+        log.info(f'created {outname} from {ncols} saved columns')
+        return res
+    columns = []
+    for fnam in frameList(dirname):
+        frame = cv2.imread(fnam, cv2.IMREAD_REDUCED_COLOR_2)
+        if frame is None:
+            continue
+        if columns and frame.shape[0] != columns[0].shape[0]:
+            frame = cv2.resize(frame, (frame.shape[1], columns[0].shape[0]))
+        columns.append(keogramColumn(frame))
+    if not columns:
+        return None
+    res = _writeKeogram(np.stack(columns, axis=1), outname, quality)
+    log.info(f'created {outname} from {len(columns)} frames')
+    return res
+
+
+def benchmarkKeogram(width=1920, height=1080, number=2000):
+    """
+    The per-frame cost of adding a frame to the keogram as it is captured, compared with
+    decoding the saved frame again
+    """
+    import tempfile
+    frame = np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writer = KeogramWriter(tmpdir)
+        addtime = timeit.timeit(lambda: writer.add(frame), number=number) / number
+        rendertime = timeit.timeit(writer.render, number=1)
+        writer.close()
+        _, jpg = cv2.imencode('.jpg', frame)
+        decodetime = timeit.timeit(lambda: cv2.imdecode(jpg, cv2.IMREAD_REDUCED_COLOR_2), number=20) / 20
+    print(f'add column          {addtime*1e6:.1f} us per frame')
+    print(f'render              {rendertime*1000:.1f} ms for {number} frames')
+    print(f'decode saved frame  {decodetime*1e6:.1f} us per frame, for comparison')
+    return addtime, rendertime
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python keogram.py capturefolder|benchmark')
+        exit(0)
+    if sys.argv[1] == 'benchmark':
+        benchmarkKeogram()
+    else:
+        print(keogramFromFolder(sys.argv[1]))
@@ -1,55 +1,99 @@
 import glob
 import os
 import sys
+import json
 import shutil
 
 
+def installIndexPage(here):
+    """ copy the gallery page into a folder, replacing the old page that used latestindex.js """
+    dstidx = os.path.join(here, 'index.html')
+    if os.path.isfile(dstidx) and 'latestindex.js' not in open(dstidx).read():
+        return
+    srcdir = os.path.split(os.path.abspath(__file__))[0]
+    srcidx = os.path.join(srcdir, 'imgindex.html.template')
+    shutil.copy(srcidx, dstidx)
+    return
+
+
+def manifestEntry(fnam, thumb=None):
+    """ one line of the manifest, describing an image or timelapse and its thumbnail """
+    fnam = os.path.basename(fnam)
+    ftype = 'mp4' if fnam.endswith('.mp4') else 'jpg'
+    entry = {'type': ftype, 'name': fnam}
+    if thumb is not None:
+        entry['thumb'] = 'thumbs/' + os.path.basename(thumb)
+    return json.dumps(entry, separators=(',', ':')) + '\n'
+
+
 def createLatestIndex(here):
+    """
+    Rebuild the manifest of images and timelapses in a folder from scratch.
+
+    The manifest, manifest.jsonl, has one JSON entry per line and is read by the gallery
+    page, index.html, which pages through it in the browser. Images with a thumbnail in
+    the thumbs subfolder are shown using the thumbnail.
+    """
     mp4list = glob.glob(os.path.join(here, '*.mp4'))
     jpglist = glob.glob(os.path.join(here, '*.jpg'))
     jpglist.sort()
-    
-
-    with open(os.path.join(here, 'latestindex.js'), 'w') as jsfile:
-        jsfile.write('$(function() {\n')
+    mp4list.sort()
+    thumbs = set(glob.glob1(os.path.join(here, 'thumbs'), '*.jpg'))
 
-        jsfile.write('var outer_div = document.getElementById("vid-list");\n')
-        jsfile.write('var h3 = document.createElement("h3");\n')
-        jsfile.write('h3.innerText = "Timelapse";\n')
-        jsfile.write('outer_div.appendChild(h3);\n')
+    with open(os.path.join(here, 'manifest.jsonl.tmp'), 'w') as mf:
         for fil in mp4list:
-            fil = os.path.basename(fil)
-            jsfile.write('var a = document.createElement("a");\n')
-            jsfile.write('var img = document.createElement("img");\n')
-            jsfile.write(f'img.src="{os.path.basename(jpglist[-1])}";\n')
-            jsfile.write('img.style.width="10%";\n')
-            jsfile.write('a.appendChild(img);\n')
-            jsfile.write(f'a.href="{fil}";\n')
-            jsfile.write('outer_div.appendChild(a);\n\n')
-
-        jsfile.write('var outer_div = document.getElementById("cam-list");\n')
-        jsfile.write('var h3 = document.createElement("h3");\n')
-        jsfile.write('h3.innerText = "Images";\n')
-        jsfile.write('outer_div.appendChild(h3);\n')
+            mf.write(manifestEntry(fil))
         for fil in jpglist:
-            fil = os.path.basename(fil)
-            jsfile.write('var a = document.createElement("a");\n')
-            jsfile.write('var img = document.createElement("img");\n')
-            jsfile.write(f'img.src="{fil}";\n')
-            jsfile.write('img.style.width="10%";\n')
-            jsfile.write('a.appendChild(img);\n')
-            jsfile.write(f'a.href="{fil}";\n')
-            jsfile.write('outer_div.appendChild(a);\n\n')
-        jsfile.write('})')
+            thumb = os.path.basename(fil) if os.path.basename(fil) in thumbs else None
+            mf.write(manifestEntry(fil, thumb))
+    os.replace(os.path.join(here, 'manifest.jsonl.tmp'), os.path.join(here, 'manifest.jsonl'))
 
-    dstidx = os.path.join(here, 'index.html')
-    if not os.path.isfile(dstidx):
-        srcdir = os.path.split(os.path.abspath(__file__))[0]
-        srcidx = os.path.join(srcdir, 'imgindex.html.template')
-        shutil.copy(srcidx, dstidx)
+    installIndexPage(here)
     return
 
 
+class ImageIndexWriter(object):
+    """
+    Keep the manifest for a capture folder up to date as frames are added.
+
+    Each new entry is appended to manifest.jsonl, so the cost of indexing a frame is the
+    same however many frames are already in the folder. If the folder has no manifest yet,
+    one is built from the existing files the first time it is opened.
+
+    Parameters:
+        here    [string] - the capture folder
+    """
+    def __init__(self, here):
+        self.here = os.path.normpath(here)
+        self.manifest = os.path.join(self.here, 'manifest.jsonl')
+        if not os.path.isfile(self.manifest):
+            createLatestIndex(self.here)
+        else:
+            installIndexPage(self.here)
+        self.names = set()
+        with open(self.manifest) as mf:
+            for li in mf:
+                try:
+                    self.names.add(json.loads(li)['name'])
+                except Exception:
+                    pass
+        self._mf = open(self.manifest, 'a')
+
+    def add(self, fnam, thumb=None):
+        """ append an image or timelapse and its thumbnail to the manifest, if it isn't already there """
+        name = os.path.basename(fnam)
+        if name in self.names:
+            return
+        self._mf.write(manifestEntry(name, thumb))
+        self._mf.flush()
+        self.names.add(name)
+
+    def close(self):
+        if self._mf is not None:
+            self._mf.close()
+            self._mf = None
+
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print('usage: python createLatestIndex.py /path/to/image/folder')
@@ -1,4 +1,5 @@
-from auroraCam import makeTimelapse, setupLogging, s3details
+from auroraCam import makeTimelapse, setupLogging, s3details, pausetime
+from timelapseEncoder import encodeFolders, timelapseName
 import platform
 import os
 import sys
@@ -8,14 +9,16 @@ import logging
 log = logging.getLogger("logger")
 
 if len(sys.argv) < 2:
-    print('usage: python ./redoTimelapse.py yyyymmdd_hhmmss ')
+    print('usage: python ./redoTimelapse.py yyyymmdd_hhmmss [yyyymmdd_hhmmss ...] [0|1|2]')
+    print('    0 uploads the existing timelapse, 1 rebuilds it first, and 2 rebuilds it in parallel segments')
     exit(0)
 
-dirpath = sys.argv[1]
-force = False
-if len(sys.argv) > 2:
-    if int(sys.argv[2])==1:
-        force = True
+# the last argument is the mode if it is a single digit, everything else is a folder
+dirpaths = sys.argv[1:]
+mode = 0
+if len(dirpaths) > 1 and dirpaths[-1].isdigit() and len(dirpaths[-1]) == 1:
+    mode = int(dirpaths.pop())
+force = mode > 0
 
 thiscfg = configparser.ConfigParser()
 local_path =os.path.dirname(os.path.abspath(__file__))
@@ -37,6 +40,17 @@ if s3 is None:
 else:
     print('uploading to AWS S3')
 
-dirname = os.path.join(datadir, dirpath)
-                          
-makeTimelapse(dirname, s3, bucket, s3prefix, daytimelapse=False, maketimelapse=force, youtube=yt)
+folders = [os.path.join(datadir, dirpath) for dirpath in dirpaths]
+
+if mode == 2:
+    # encode all the folders at once, then just upload them below
+    built = encodeFolders([(d, timelapseName(d)) for d in folders], int(125/pausetime))
+    for dirname in folders:
+        if built[timelapseName(dirname)]:
+            makeTimelapse(dirname, s3, bucket, s3prefix, daytimelapse=False, maketimelapse=False, youtube=yt)
+        else:
+            print(f'segmented rebuild of {dirname} failed, rebuilding it in one pass')
+            makeTimelapse(dirname, s3, bucket, s3prefix, daytimelapse=False, maketimelapse=True, youtube=yt)
+else:
+    for dirname in folders:
+        makeTimelapse(dirname, s3, bucket, s3prefix, daytimelapse=False, maketimelapse=force, youtube=yt)
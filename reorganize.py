@@ -1,4 +1,4 @@
-from auroraCam import getNextRiseSet
+from sunSchedule import SunSchedule
 import datetime
 import os
 import glob
@@ -11,6 +11,7 @@ def reorganize():
     lat = 51.88
     lon = -1.31
     ele = 80
+    sunschedule = SunSchedule(lat, lon, ele, cachefile=os.path.join(basedir, 'sunschedule.json'))
     imglist = glob.glob1(srcdir,'*.jpg')
     imglist.sort()
     for img in imglist:
@@ -20,10 +21,10 @@ def reorganize():
             imgdt = imgdt + datetime.timedelta(minutes=60)
         if imgdt.hour < 12 and imgdt.hour > 2:
             imgdt = imgdt - datetime.timedelta(minutes=60)
-        risetm, settm = getNextRiseSet(lat, lon, ele, fordate=imgdt+datetime.timedelta(days=-1))
+        risetm, settm = sunschedule.nextRiseSet(imgdt+datetime.timedelta(days=-1))
         prisetime = risetm + datetime.timedelta(minutes=60)
         psettime = settm - datetime.timedelta(minutes=60)
-        #risetm, settm = getNextRiseSet(lat, lon, ele, fordate=imgdt)
+        #risetm, settm = sunschedule.nextRiseSet(imgdt)
         #nrisetime = risetm + datetime.timedelta(minutes=60)
         #nsettime = settm - datetime.timedelta(minutes=60)
         if prisetime < psettime:   
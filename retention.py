@@ -0,0 +1,189 @@
+# Copyright (C) Mark McIntyre
+#
+# Tiered retention: keep less of each session as it gets older, so more nights fit on the card
+#
+import os
+import sys
+import glob
+import shutil
+import datetime
+import configparser
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image
+
+from frameScan import frameList, scanname
+from keogram import keogramFromFolder, keogramname, keogramdata
+from makeImageIndex import createLatestIndex
+from sessionCatalog import getCatalog
+
+log = logging.getLogger("logger")
+
+# storage tiers
+FULL = 0 # every frame at full quality
+REDUCED = 1 # the timelapse, the keogram and every Nth frame at lower quality
+SUMMARY = 2 # just the timelapse and the keogram
+
+
+class RetentionPolicy(object):
+    """
+    The retention settings from the RETENTION section of the config.
+
+    Parameters:
+        reducedafter    [int] - days after which sessions are reduced, None to never reduce them
+        reducedevery    [int] - keep one frame in this many
+        reducedquality  [int] - JPEG quality of the frames that are kept
+        summaryafter    [int] - days after which only the timelapse and keogram are kept, None for never
+    """
+    def __init__(self, reducedafter=None, reducedevery=10, reducedquality=60, summaryafter=None):
+        self.reducedafter = reducedafter
+        self.reducedevery = reducedevery
+        self.reducedquality = reducedquality
+        self.summaryafter = summaryafter
+
+    @classmethod
+    def fromConfig(cls, thiscfg):
+        """ the policy from the config. Sessions are never thinned within DAYSTOKEEP days """
+        if 'retention' not in thiscfg:
+            return cls()
+        sect = thiscfg['retention']
+        try:
+            daystokeep = int(thiscfg['auroracam']['daystokeep'])
+        except Exception:
+            daystokeep = 3
+        try:
+            reducedafter = max(int(sect['reducedafter']), daystokeep, 1)
+        except Exception:
+            reducedafter = None
+        try:
+            summaryafter = max(int(sect['summaryafter']), daystokeep, 1)
+        except Exception:
+            summaryafter = None
+        try:
+            reducedevery = max(int(sect['reducedevery']), 1)
+        except Exception:
+            reducedevery = 10
+        try:
+            reducedquality = min(max(int(sect['reducedquality']), 10), 95)
+        except Exception:
+            reducedquality = 60
+        return cls(reducedafter, reducedevery, reducedquality, summaryafter)
+
+    def enabled(self):
+        return self.reducedafter is not None or self.summaryafter is not None
+
+    def tierFor(self, foldertime, now):
+        """ the tier a session started at foldertime should be in """
+        age = (now - foldertime).total_seconds() / 86400
+        if self.summaryafter is not None and age >= self.summaryafter:
+            return SUMMARY
+        if self.reducedafter is not None and age >= self.reducedafter:
+            return REDUCED
+        return FULL
+
+
+def _removeFrames(dirname, frames):
+    """ delete frames and their thumbnails """
+    for fnam in frames:
+        os.remove(fnam)
+        thumb = os.path.join(dirname, 'thumbs', os.path.basename(fnam))
+        if os.path.isfile(thumb):
+            os.remove(thumb)
+
+
+def reduceFolder(dirname, tier, every=10, quality=60):
+    """
+    Thin out a capture folder to a storage tier. Runs in a worker process.
+
+    A keogram made while the session was captured is kept; otherwise one is made first,
+    while all the frames are still there. For the reduced tier
+    every Nth frame is kept and recompressed at a lower quality; for the summary tier all
+    the frames are deleted. The folder is only thinned if it has a timelapse, so a night
+    whose timelapse failed keeps its frames until the timelapse has been remade.
+
+    Returns:
+        (bytes before, bytes after), or None if the folder was left alone
+    """
+    if not glob.glob(os.path.join(dirname, '*.mp4')):
+        return None
+    before = sum([os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(dirname) for f in fs])
+    if not os.path.isfile(os.path.join(dirname, keogramname)):
+        keogramFromFolder(dirname)
+    if os.path.isfile(os.path.join(dirname, keogramdata)):
+        os.remove(os.path.join(dirname, keogramdata))
+    frames = frameList(dirname)
+    if tier == SUMMARY:
+        _removeFrames(dirname, frames)
+        shutil.rmtree(os.path.join(dirname, 'thumbs'), ignore_errors=True)
+    else:
+        keep = frames[::every]
+        keepset = set(keep)
+        _removeFrames(dirname, [f for f in frames if f not in keepset])
+        for fnam in keep:
+            with Image.open(fnam) as img:
+                img.load()
+                img.save(fnam + '.tmp', 'JPEG', quality=quality)
+            os.replace(fnam + '.tmp', fnam)
+    if os.path.isfile(os.path.join(dirname, scanname)):
+        os.remove(os.path.join(dirname, scanname))
+    createLatestIndex(dirname)
+    after = sum([os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(dirname) for f in fs])
+    return before, after
+
+
+def applyRetention(thiscfg, now=None, workers=None):
+    """
+    Move each capture session into the storage tier for its age. The folders are processed
+    in parallel, one per core by default, and the tier of each is recorded in the catalog
+    so that it is only done once.
+
+    Returns:
+        the number of bytes freed
+    """
+    policy = RetentionPolicy.fromConfig(thiscfg)
+    if not policy.enabled():
+        return 0
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    datadir = os.path.expanduser(thiscfg['auroracam']['datadir'])
+    catalog = getCatalog(thiscfg)
+    todo = []
+    for s in catalog.sessions():
+        if not s['folder']:
+            continue
+        foldertime = datetime.datetime.strptime(s['name'], '%Y%m%d_%H%M%S').replace(tzinfo=datetime.timezone.utc)
+        tier = policy.tierFor(foldertime, now)
+        if tier > (s['tier'] or FULL):
+            todo.append((s['name'], tier))
+    if not todo:
+        return 0
+    log.info(f'moving {len(todo)} sessions to lower storage tiers')
+    freed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(reduceFolder, os.path.join(datadir, name), tier, policy.reducedevery,
+                               policy.reducedquality): (name, tier) for name, tier in todo}
+        for future in as_completed(futures):
+            name, tier = futures[future]
+            try:
+                res = future.result()
+            except Exception as e:
+                log.warning(f'unable to reduce {name}')
+                log.info(e, exc_info=True)
+                continue
+            if res is None:
+                log.info(f'not reducing {name} as it has no timelapse')
+                continue
+            catalog.setTier(name, tier)
+            freed += res[0] - res[1]
+            log.info(f'reduced {name} to tier {tier}, {res[0]/1048576:.0f} MB to {res[1]/1048576:.0f} MB')
+    log.info(f'retention freed {freed/1048576:.0f} MB')
+    return freed
+
+
+if __name__ == '__main__':
+    thiscfg = configparser.ConfigParser()
+    thiscfg.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini'))
+    if not RetentionPolicy.fromConfig(thiscfg).enabled():
+        print('set REDUCEDAFTER or SUMMARYAFTER in the RETENTION section of config.ini')
+        exit(0)
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    applyRetention(thiscfg)
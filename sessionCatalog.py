@@ -0,0 +1,312 @@
+# Copyright (C) Mark McIntyre
+#
+# Catalog of the capture folders and archives in the data folder, kept in SQLite
+#
+import os
+import re
+import sys
+import sqlite3
+import datetime
+import threading
+import time
+import logging
+
+log = logging.getLogger("logger")
+
+catalogname = 'catalog.db'
+# capture folders are named for the time capture started, and archives after the folder
+sessionpatt = re.compile(r'^(\d{8}_\d{6})(\.zip|\.tgz)?$')
+
+schema = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    name TEXT PRIMARY KEY,  -- the folder name, yyyymmdd_hhmmss
+    start TEXT,             -- time of the first frame
+    end TEXT,               -- time of the last frame
+    frames INTEGER,         -- number of frames captured
+    bytes INTEGER,          -- bytes of frames captured
+    folder INTEGER,         -- 1 if the folder exists
+    archive TEXT,           -- the archive file, if there is one
+    uploaded INTEGER,       -- 1 once the archive has been sent to the archive server
+    tier INTEGER DEFAULT 0  -- 0 all the frames, 1 reduced, 2 timelapse and keogram only
+)'''
+
+
+def _folderStats(dirname):
+    """ number of frames, their total size, and the times of the first and last """
+    frames = []
+    nbytes = 0
+    try:
+        with os.scandir(dirname) as it:
+            for entry in it:
+                if entry.name.endswith('.jpg') and _frameTime(entry.name) is not None and entry.is_file():
+                    frames.append(entry.name)
+                    nbytes += entry.stat().st_size
+    except OSError:
+        pass
+    frames.sort()
+    first = _frameTime(frames[0]) if frames else None
+    last = _frameTime(frames[-1]) if frames else None
+    return len(frames), nbytes, first, last
+
+
+def _frameTime(fname):
+    try:
+        return datetime.datetime.strptime(fname[:15], '%Y%m%d_%H%M%S').isoformat()
+    except ValueError:
+        return None
+
+
+class SessionCatalog(object):
+    """
+    Index of the capture sessions in a data folder, with the time span, number of frames,
+    size, and archive and upload state of each.
+
+    The capture loop records each frame as it is saved, so finding the folder for a frame
+    and choosing what to archive are indexed queries rather than directory scans. Frame
+    counts are kept in memory and written in one transaction every flushframes frames or
+    flushsecs seconds, when the folder changes, before anything reads the catalog, and on
+    close, so the SD card isn't written for every frame. The
+    catalog is reconciled with the data folder when it is opened, and again whenever the
+    folder's modification time shows that something has been added or removed, so sessions
+    copied in or deleted by hand are picked up. Only the new folders are scanned.
+
+    Parameters:
+        datadir     [string] - the data folder
+        dbname      [string] - the SQLite file, by default catalog.db in datadir
+        flushframes [int]    - frames to collect before writing them to the catalog
+        flushsecs   [float]  - longest time to hold frames before writing them
+    """
+    def __init__(self, datadir, dbname=None, flushframes=30, flushsecs=60):
+        self.datadir = os.path.normpath(os.path.expanduser(datadir))
+        os.makedirs(self.datadir, exist_ok=True)
+        self.dbname = dbname or os.path.join(self.datadir, catalogname)
+        self._lock = threading.Lock()
+        self._dirmtime = None
+        self.flushframes = flushframes
+        self.flushsecs = flushsecs
+        # frames not yet written, by folder: [frames, bytes, first time, last time]
+        self._pending = {}
+        self._npending = 0
+        self._pendingsince = None
+        self._conn = sqlite3.connect(self.dbname, timeout=30, check_same_thread=False)
+        # WAL lets redoTimelapse and archAndFree read while we write, and NORMAL sync
+        # avoids an fsync on the SD card for every frame
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(schema)
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(sessions)')]
+        if 'tier' not in columns:
+            self._conn.execute('ALTER TABLE sessions ADD COLUMN tier INTEGER DEFAULT 0')
+        self._conn.commit()
+        self.refresh()
+
+    def refresh(self):
+        """ reconcile the catalog with the data folder, if anything has been added or removed """
+        try:
+            mtime = os.stat(self.datadir).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._dirmtime:
+            return
+        self.sync()
+        self._dirmtime = mtime
+
+    def sync(self):
+        """ reconcile the catalog with the data folder, scanning any folders it doesn't know about """
+        folders = set()
+        archives = {}
+        for name in os.listdir(self.datadir):
+            match = sessionpatt.match(name)
+            if match is None:
+                continue
+            if match.group(2) is None:
+                if os.path.isdir(os.path.join(self.datadir, name)):
+                    folders.add(name)
+            else:
+                archives[match.group(1)] = name
+        with self._lock:
+            self._flush()
+            known = {row[0]: row[1:] for row in self._conn.execute('SELECT name, folder, archive FROM sessions')}
+            for name in sorted(folders | set(archives.keys())):
+                hasfolder = 1 if name in folders else 0
+                archive = archives.get(name)
+                if name not in known:
+                    if hasfolder:
+                        frames, nbytes, first, last = _folderStats(os.path.join(self.datadir, name))
+                    else:
+                        frames, nbytes, first, last = None, os.path.getsize(os.path.join(self.datadir, archive)), None, None
+                    self._conn.execute('INSERT INTO sessions (name, start, end, frames, bytes, folder, archive, uploaded) '
+                                       'VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+                                       (name, first or _frameTime(name), last, frames, nbytes, hasfolder, archive))
+                elif known[name] != (hasfolder, archive):
+                    self._conn.execute('UPDATE sessions SET folder=?, archive=? WHERE name=?', (hasfolder, archive, name))
+            for name, (hasfolder, archive) in known.items():
+                if name not in folders and name not in archives and (hasfolder or archive):
+                    self._conn.execute('UPDATE sessions SET folder=0, archive=NULL WHERE name=?', (name,))
+            self._conn.commit()
+
+    def addFrame(self, dirname, timestamp, nbytes):
+        """
+        Record a frame saved in a capture folder, adding the session if it is new. The frame
+        is held in memory until the next flush.
+
+        Parameters:
+            dirname     [string]   - the capture folder
+            timestamp   [datetime] - when the frame was captured
+            nbytes      [int]      - size of the saved JPEG
+        """
+        name = os.path.basename(os.path.normpath(dirname))
+        ts = timestamp.replace(tzinfo=None).isoformat(timespec='seconds')
+        with self._lock:
+            if self._pending and name not in self._pending:
+                self._flush()
+            if name in self._pending:
+                pending = self._pending[name]
+                pending[0] += 1
+                pending[1] += nbytes
+                pending[3] = ts
+            else:
+                self._pending[name] = [1, nbytes, ts, ts]
+            self._npending += 1
+            if self._pendingsince is None:
+                self._pendingsince = time.monotonic()
+            if self._npending >= self.flushframes or time.monotonic() - self._pendingsince >= self.flushsecs:
+                self._flush()
+
+    def flush(self):
+        """ write any frames held in memory to the catalog """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        # called with the lock held
+        if not self._pending:
+            return
+        for name, (frames, nbytes, first, last) in self._pending.items():
+            cur = self._conn.execute('UPDATE sessions SET frames=COALESCE(frames, 0)+?, bytes=COALESCE(bytes, 0)+?, end=?, folder=1 '
+                                     'WHERE name=?',
+                                     (frames, nbytes, last, name))
+            if cur.rowcount == 0:
+                self._conn.execute('INSERT INTO sessions (name, start, end, frames, bytes, folder, archive, uploaded) '
+                                   'VALUES (?, ?, ?, ?, ?, 1, NULL, 0)', (name, first, last, frames, nbytes))
+        self._conn.commit()
+        self._pending = {}
+        self._npending = 0
+        self._pendingsince = None
+
+    def findFolder(self, prefix):
+        """ the first capture folder whose name starts with prefix, or None """
+        # called for every frame, so this looks at the frames held in memory rather than flushing them
+        with self._lock:
+            row = self._conn.execute('SELECT name FROM sessions WHERE name >= ? AND name < ? AND folder=1 ORDER BY name LIMIT 1',
+                                     (prefix, prefix + '\uffff')).fetchone()
+            names = [n for n in self._pending if n.startswith(prefix)]
+        if row:
+            names.append(row[0])
+        return min(names) if names else None
+
+    def updateSession(self, name):
+        """ recheck whether a session's folder and archive exist, after archiving or deleting it """
+        name = sessionpatt.match(os.path.basename(os.path.normpath(name)))
+        if name is None:
+            return
+        name = name.group(1)
+        hasfolder = 1 if os.path.isdir(os.path.join(self.datadir, name)) else 0
+        archive = None
+        for ext in ['.zip', '.tgz']:
+            if os.path.isfile(os.path.join(self.datadir, name + ext)):
+                archive = name + ext
+        with self._lock:
+            self._flush()
+            self._conn.execute('UPDATE sessions SET folder=?, archive=? WHERE name=?', (hasfolder, archive, name))
+            self._conn.commit()
+
+    def setTier(self, name, tier):
+        """ record that a session has been reduced to a storage tier """
+        with self._lock:
+            self._flush()
+            self._conn.execute('UPDATE sessions SET tier=? WHERE name=?', (tier, name))
+            self._conn.commit()
+
+    def setUploaded(self, name):
+        name = sessionpatt.match(os.path.basename(os.path.normpath(name)))
+        if name is None:
+            return
+        with self._lock:
+            self._flush()
+            self._conn.execute('UPDATE sessions SET uploaded=1 WHERE name=?', (name.group(1),))
+            self._conn.commit()
+
+    def deletable(self, daystokeep=3, filestokeep=[], now=None):
+        """
+        The folders and archives that can be archived or deleted, oldest first: everything
+        older than the last daystokeep days, plus anything matching one of filestokeep.
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        if daystokeep > 0:
+            cutoff = (now - datetime.timedelta(days=daystokeep - 1)).strftime('%Y%m%d')
+        else:
+            cutoff = '99999999'
+        query = 'SELECT name, folder, archive FROM sessions WHERE (folder=1 OR archive IS NOT NULL) AND (name < ?'
+        params = [cutoff]
+        for patt in [p.strip() for p in filestokeep if p.strip() != '']:
+            query += ' OR name LIKE ? OR archive LIKE ?'
+            params += [f'%{patt}%', f'%{patt}%']
+        query += ') ORDER BY name'
+        with self._lock:
+            self._flush()
+            rows = self._conn.execute(query, params).fetchall()
+        names = []
+        for name, hasfolder, archive in rows:
+            if hasfolder:
+                names.append(name)
+            if archive is not None:
+                names.append(archive)
+        return names
+
+    def sessions(self, since=None):
+        """ the sessions as dicts, oldest first, optionally only those starting after since """
+        query = 'SELECT name, start, end, frames, bytes, folder, archive, uploaded, tier FROM sessions'
+        params = []
+        if since is not None:
+            query += ' WHERE name >= ?'
+            params.append(since.strftime('%Y%m%d_%H%M%S'))
+        with self._lock:
+            self._flush()
+            rows = self._conn.execute(query + ' ORDER BY name', params).fetchall()
+        keys = ['name', 'start', 'end', 'frames', 'bytes', 'folder', 'archive', 'uploaded', 'tier']
+        return [dict(zip(keys, row)) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+
+_catalogs = {}
+_catalogslock = threading.Lock()
+
+
+def getCatalog(thiscfg):
+    """ the SessionCatalog for the configured data folder, opened once and brought up to date """
+    datadir = os.path.normpath(os.path.expanduser(thiscfg['auroracam']['datadir']))
+    with _catalogslock:
+        if datadir not in _catalogs:
+            _catalogs[datadir] = SessionCatalog(datadir)
+        catalog = _catalogs[datadir]
+    catalog.refresh()
+    return catalog
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python sessionCatalog.py datadir')
+        exit(0)
+    catalog = SessionCatalog(sys.argv[1])
+    for s in catalog.sessions():
+        state = 'folder' if s['folder'] else ''
+        if s['archive']:
+            state = (state + ' ' + s['archive']).strip()
+        if s['uploaded']:
+            state += ' uploaded'
+        print(f'{s["name"]}  {s["frames"] or "":>6}  {(s["bytes"] or 0)/1048576:8.1f} MB  {s["end"] or "":19s}  {state}')
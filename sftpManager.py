@@ -0,0 +1,144 @@
+# Copyright (C) Mark McIntyre
+#
+# Shared, persistent SFTP connections for the auroracam uploads
+#
+import os
+import threading
+import contextlib
+import logging
+import paramiko
+
+log = logging.getLogger("logger")
+
+
+class _Connection(object):
+    def __init__(self, maxchannels):
+        self.client = None
+        self.idle = []
+        self.lock = threading.Lock()
+        self.channels = threading.BoundedSemaphore(maxchannels)
+
+
+class SFTPManager(object):
+    """
+    Hold warm SSH connections and SFTP channels, keyed by server, user and key file.
+
+    The first upload to a server makes the connection; later uploads reuse it, so the SSH
+    handshake and key exchange are only done once. Connections are health-checked before
+    use and remade if the server has dropped them, and the number of SFTP channels open at
+    once on each connection is limited.
+
+    Parameters:
+        maxchannels [int] - maximum concurrent SFTP channels per connection
+        keepalive   [int] - interval in seconds between SSH keepalive packets
+    """
+    def __init__(self, maxchannels=4, keepalive=30):
+        self.maxchannels = maxchannels
+        self.keepalive = keepalive
+        self._conns = {}
+        self._pkeys = {}
+        self._lock = threading.Lock()
+
+    def _getConnection(self, key):
+        with self._lock:
+            if key not in self._conns:
+                self._conns[key] = _Connection(self.maxchannels)
+            return self._conns[key]
+
+    def _pkey(self, keyfile):
+        keyfile = os.path.expanduser(keyfile)
+        with self._lock:
+            if keyfile not in self._pkeys:
+                self._pkeys[keyfile] = paramiko.RSAKey.from_private_key_file(keyfile)
+            return self._pkeys[keyfile]
+
+    @staticmethod
+    def _isHealthy(client):
+        if client is None:
+            return False
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def _connect(self, conn, server, user, keyfile):
+        """ (re)connect if needed. Must be called with conn.lock held """
+        if self._isHealthy(conn.client):
+            return conn.client
+        self._disconnect(conn)
+        log.info(f'connecting to {server} as {user}')
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(server, username=user, pkey=self._pkey(keyfile), look_for_keys=False)
+        client.get_transport().set_keepalive(self.keepalive)
+        conn.client = client
+        return client
+
+    @staticmethod
+    def _disconnect(conn):
+        for ftp_client in conn.idle:
+            try:
+                ftp_client.close()
+            except Exception:
+                pass
+        conn.idle = []
+        if conn.client is not None:
+            try:
+                conn.client.close()
+            except Exception:
+                pass
+            conn.client = None
+
+    def sshClient(self, server, user, keyfile):
+        """ the connected paramiko SSHClient for a server, eg for running remote commands """
+        conn = self._getConnection((server, user, os.path.expanduser(keyfile)))
+        with conn.lock:
+            return self._connect(conn, server, user, keyfile)
+
+    @contextlib.contextmanager
+    def sftp(self, server, user, keyfile):
+        """
+        Borrow an SFTP channel to a server, connecting if needed.
+
+        If anything goes wrong while the channel is in use the connection is discarded and
+        remade next time, and the exception is passed on to the caller.
+
+        Usage:
+            with sftpmanager.sftp(server, user, keyfile) as ftp_client:
+                ftp_client.put(localfile, remotefile)
+        """
+        conn = self._getConnection((server, user, os.path.expanduser(keyfile)))
+        with conn.channels:
+            with conn.lock:
+                client = self._connect(conn, server, user, keyfile)
+                ftp_client = conn.idle.pop() if conn.idle else client.open_sftp()
+            try:
+                yield ftp_client
+            except Exception:
+                with conn.lock:
+                    try:
+                        ftp_client.close()
+                    except Exception:
+                        pass
+                    if not self._isHealthy(conn.client):
+                        self._disconnect(conn)
+                raise
+            with conn.lock:
+                if conn.client is client:
+                    conn.idle.append(ftp_client)
+                else:
+                    ftp_client.close()
+
+    def closeAll(self):
+        with self._lock:
+            conns = list(self._conns.values())
+        for conn in conns:
+            with conn.lock:
+                self._disconnect(conn)
+
+
+sftpmanager = SFTPManager()
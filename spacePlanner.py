@@ -0,0 +1,157 @@
+# Copyright (C) Mark McIntyre
+#
+# Work out how much space the next night's capture needs, and what to delete to make room
+#
+import os
+import sys
+import datetime
+import configparser
+import logging
+
+from archiver import storedexts
+from sunSchedule import getSunSchedule
+
+log = logging.getLogger("logger")
+
+# used until there are enough recent sessions to measure, the same figures as before
+defaultframebytes = 100 * 1024 # 100 kB per frame
+defaultframesperhour = 20000 / 24 # about 20,000 frames a day
+mp4bytes = 100 * 1024 * 1024 # 100 MB for the timelapse
+extrabytes = 50 * 1024 * 1024 # 50 MB extra just in case
+overhead = 1.05 # thumbnails, index and journal saved alongside the frames
+margin = datetime.timedelta(minutes=60) # capture starts this long before dusk and ends this long after dawn
+minframes = 100 # sessions with fewer frames than this aren't used to measure the rates
+
+
+def captureRates(sessions):
+    """
+    The average size of a frame and the number of frames captured per hour, measured from
+    recent capture sessions.
+
+    Parameters:
+        sessions    [list] - sessions from SessionCatalog.sessions()
+
+    Returns:
+        bytes per frame, frames per hour. The defaults are used if there are no usable sessions.
+    """
+    nframes = 0
+    nbytes = 0
+    hours = 0
+    for s in sessions:
+        if not s['frames'] or s['frames'] < minframes or not s['bytes'] or not s['start'] or not s['end']:
+            continue
+        duration = datetime.datetime.fromisoformat(s['end']) - datetime.datetime.fromisoformat(s['start'])
+        if duration.total_seconds() <= 0:
+            continue
+        nframes += s['frames']
+        nbytes += s['bytes']
+        hours += duration.total_seconds() / 3600
+    if nframes == 0:
+        return defaultframebytes, defaultframesperhour
+    return nbytes / nframes, nframes / hours
+
+
+def captureHours(thiscfg, now, daytimelapse=False):
+    """
+    Hours of frames that will be saved between now and the end of the next night's capture.
+    Only night frames are saved unless DAYTIMELAPSE is set.
+    """
+    risetm, settm = getSunSchedule(thiscfg).nextRiseSet(now)
+    end = risetm + margin
+    if daytimelapse or settm > risetm:
+        # either everything is saved, or it's already dark
+        start = now
+    else:
+        start = max(now, settm - margin)
+    return max(0, (end - start).total_seconds() / 3600)
+
+
+def spaceNeeded(thiscfg, sessions, ncameras=1, now=None, daytimelapse=False):
+    """
+    Bytes needed to capture until the end of the next night, from the measured capture rates
+    and the length of the night at the configured location.
+
+    Parameters:
+        thiscfg         [object] - the configuration
+        sessions        [list]   - recent sessions from the catalog
+        ncameras        [int]    - number of cameras sharing the disk
+        now             [datetime] - the time to plan from, default now
+        daytimelapse    [bool]   - whether daytime frames are saved too
+
+    Returns:
+        the bytes needed, and a dict of the figures used
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    framebytes, framesperhour = captureRates(sessions)
+    hours = captureHours(thiscfg, now, daytimelapse)
+    needed = int((framesperhour * hours * framebytes * overhead + mp4bytes) * ncameras + extrabytes)
+    return needed, {'framebytes': round(framebytes), 'framesperhour': round(framesperhour), 'hours': round(hours, 2),
+                    'needed': needed}
+
+
+def entrySize(datadir, name):
+    """
+    The bytes that compressing a folder or deleting an archive in the data folder would free.
+    Files that are stored in the zip as they are, such as the JPEGs, don't count, and the rest
+    are assumed to compress to almost nothing.
+    """
+    path = os.path.join(datadir, name)
+    if os.path.isdir(path):
+        total = 0
+        for root, _, files in os.walk(path):
+            for f in files:
+                if os.path.splitext(f)[1].lower() not in storedexts:
+                    try:
+                        total += os.path.getsize(os.path.join(root, f))
+                    except OSError:
+                        pass
+        return total
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def planEviction(datadir, candidates, deficit):
+    """
+    The oldest folders and archives which together free at least deficit bytes when the
+    folders are compressed and the archives deleted.
+
+    Compressing a folder frees little, as the JPEGs are stored in the zip as they are, so
+    most of the room comes from deleting the archives of older nights. The candidates are
+    sized one at a time, oldest first, until there is enough.
+
+    Parameters:
+        datadir     [string] - the data folder
+        candidates  [list]   - names of folders and archives that may be deleted, oldest first
+        deficit     [int]    - bytes that need to be freed
+
+    Returns:
+        the names to compress or delete, and the bytes that will be freed
+    """
+    evict = []
+    freed = 0
+    for name in candidates:
+        if freed >= deficit:
+            break
+        evict.append(name)
+        freed += entrySize(datadir, name)
+    return evict, freed
+
+
+if __name__ == '__main__':
+    from sessionCatalog import getCatalog
+    thiscfg = configparser.ConfigParser()
+    thiscfg.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini'))
+    ncameras = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    try:
+        daytimelapse = int(thiscfg['auroracam']['daytimelapse']) == 1
+    except Exception:
+        daytimelapse = False
+    now = datetime.datetime.now(datetime.timezone.utc)
+    catalog = getCatalog(thiscfg)
+    needed, plan = spaceNeeded(thiscfg, catalog.sessions(since=now - datetime.timedelta(days=14)), ncameras,
+                               now, daytimelapse)
+    print(f'{plan["framebytes"]/1024:.0f} kB per frame, {plan["framesperhour"]} frames per hour, '
+          f'{plan["hours"]} hours to capture')
+    print(f'{needed/1048576:.0f} MB needed')
@@ -0,0 +1,159 @@
+# Copyright (C) Mark McIntyre
+#
+# Precomputed table of dawn and dusk times, so we don't need to call ephem for every frame
+#
+import os
+import json
+import bisect
+import datetime
+import threading
+import logging
+import ephem
+
+log = logging.getLogger("logger")
+
+horizon = -6.0 # degrees below horizon for darkness, as in getNextRiseSet
+tabledays = 366 # days to compute at a time
+minlead = 2 # recompute when less than this many days are left in the table
+
+
+def _toEpoch(dt):
+    """ seconds since 1970 for a datetime, treating naive datetimes as UTC like ephem does """
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+
+def _fromEpoch(t):
+    return datetime.datetime.fromtimestamp(t, datetime.timezone.utc)
+
+
+class SunSchedule(object):
+    """
+    A table of sunrise and sunset times for one location, defined with the sun 6 degrees
+    below the horizon as in getNextRiseSet.
+
+    A year of events is computed in one go and optionally saved to disk, after which each
+    lookup is a binary search of the sorted rise and set times. The table is recomputed
+    automatically when a lookup falls outside it.
+
+    Parameters:
+        lati        [float]  - latitude in degrees
+        longi       [float]  - longitude in degrees (+E)
+        elev        [float]  - elevation in metres
+        cachefile   [string] - optional file to save the table in
+    """
+    def __init__(self, lati, longi, elev, cachefile=None):
+        self.lati = float(lati)
+        self.longi = float(longi)
+        self.elev = float(elev)
+        self.cachefile = cachefile
+        self.start = None
+        self.end = None
+        self.rises = []
+        self.sets = []
+        self._lock = threading.Lock()
+        if cachefile is not None:
+            self._load()
+
+    def _key(self):
+        return [self.lati, self.longi, self.elev, horizon]
+
+    def _load(self):
+        try:
+            data = json.load(open(self.cachefile))
+        except Exception:
+            return
+        if data.get('key') != self._key():
+            log.info('location has changed, sun schedule will be recomputed')
+            return
+        self.start, self.end = data['start'], data['end']
+        self.rises, self.sets = data['rises'], data['sets']
+
+    def _save(self):
+        data = {'key': self._key(), 'start': self.start, 'end': self.end, 'rises': self.rises, 'sets': self.sets}
+        try:
+            tmpname = self.cachefile + '.tmp'
+            json.dump(data, open(tmpname, 'w'))
+            os.replace(tmpname, self.cachefile)
+        except Exception as e:
+            log.warning(f'unable to save {self.cachefile}')
+            log.info(e, exc_info=True)
+
+    def _events(self, finder, start, end):
+        """ all the events found by finder, eg obs.next_rising, between two ephem dates """
+        sun = ephem.Sun()
+        events = []
+        obs = self._observer()
+        obs.date = start
+        while obs.date < end:
+            try:
+                t = finder(obs, sun)
+            except (ephem.AlwaysUpError, ephem.NeverUpError):
+                # no twilight today, which happens in summer at high latitudes
+                obs.date = ephem.Date(obs.date + 1)
+                continue
+            if t > end:
+                break
+            events.append(_toEpoch(t.datetime()))
+            obs.date = ephem.Date(t + ephem.minute)
+        return events
+
+    def _observer(self):
+        obs = ephem.Observer()
+        obs.lat = self.lati / 57.3 # convert to radians, same approximation as getNextRiseSet
+        obs.lon = self.longi / 57.3
+        obs.elev = self.elev
+        obs.horizon = horizon / 57.3
+        return obs
+
+    def compute(self, fromdate, days=tabledays):
+        """ compute the table for a number of days starting just before fromdate """
+        start = _toEpoch(fromdate) - 2 * 86400
+        end = start + (days + 2) * 86400
+        estart, eend = ephem.Date(_fromEpoch(start).replace(tzinfo=None)), ephem.Date(_fromEpoch(end).replace(tzinfo=None))
+        self.rises = self._events(lambda obs, sun: obs.next_rising(sun), estart, eend)
+        self.sets = self._events(lambda obs, sun: obs.next_setting(sun), estart, eend)
+        self.start, self.end = start, end
+        log.info(f'computed sun schedule from {_fromEpoch(start)} to {_fromEpoch(end)}')
+        if self.cachefile is not None:
+            self._save()
+
+    def _ensure(self, t):
+        if self.start is None or t < self.start or t > self.end - minlead * 86400:
+            self.compute(_fromEpoch(t))
+
+    def nextRiseSet(self, fordate):
+        """
+        The first rise and set after a given time, the same as getNextRiseSet.
+
+        Parameters:
+            fordate [datetime] - the time to look from, treated as UTC if naive
+
+        Returns:
+            rise, set:  [date tuple] next rise and set as UTC datetimes
+        """
+        t = _toEpoch(fordate)
+        with self._lock:
+            self._ensure(t)
+            rise = self.rises[bisect.bisect_right(self.rises, t)]
+            set = self.sets[bisect.bisect_right(self.sets, t)]
+        return _fromEpoch(rise), _fromEpoch(set)
+
+
+_schedules = {}
+
+
+def getSunSchedule(thiscfg):
+    """ the SunSchedule for the configured location, cached in memory and in DATADIR """
+    lat = thiscfg['auroracam']['lat']
+    lon = thiscfg['auroracam']['lon']
+    ele = thiscfg['auroracam']['alt']
+    datadir = os.path.expanduser(thiscfg['auroracam']['datadir'])
+    key = (lat, lon, ele, datadir)
+    if key not in _schedules:
+        cachefile = None
+        if os.path.isdir(datadir):
+            cachefile = os.path.join(datadir, 'sunschedule.json')
+        _schedules[key] = SunSchedule(lat, lon, ele, cachefile=cachefile)
+    return _schedules[key]
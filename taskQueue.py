@@ -0,0 +1,207 @@
+# Copyright (C) Mark McIntyre
+#
+# Background work queue so that uploads, timelapses and indexing don't hold up the capture loop
+#
+import time
+import heapq
+import threading
+import collections
+import logging
+
+log = logging.getLogger("logger")
+
+
+class JobType(object):
+    """
+    Settings for one type of job
+
+    Parameters:
+        name        [string] - name of the job type eg 'liveupload'
+        priority    [int]    - lower numbers run first
+        policy      [string] - 'fifo' to queue every job, 'latest' to keep only the newest pending job
+                                or 'drop' to discard new jobs while one is already pending
+        pool        [string] - the worker pool to run on, 'io', 'encode' or 'background'
+    """
+    def __init__(self, name, priority=5, policy='fifo', pool='io'):
+        self.name = name
+        self.priority = priority
+        self.policy = policy
+        self.pool = pool
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.running = 0
+        self.waits = collections.deque(maxlen=100)
+        self.runtimes = collections.deque(maxlen=100)
+
+
+class _Job(object):
+    def __init__(self, jobtype, func, args, kwargs):
+        self.jobtype = jobtype
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.queued = time.monotonic()
+        self.cancelled = False
+
+
+class TaskQueue(object):
+    """
+    A bounded priority work queue serviced by pools of worker threads.
+
+    I/O jobs such as uploads and indexing run on a pool of threads. Encoding jobs run on
+    their own worker so that a long ffmpeg run never holds up an upload; the encoding itself
+    happens in the ffmpeg process so it doesn't compete with the capture loop for the GIL.
+    Long-running housekeeping can be given a background pool so that it never occupies the
+    encoding worker.
+
+    Parameters:
+        maxdepth    [int] - maximum number of pending jobs. When full, a new job displaces the
+                            lowest priority pending job if it has a higher priority, otherwise
+                            it is dropped.
+        ioworkers   [int] - number of threads in the I/O pool
+        encworkers  [int] - number of threads in the encoding pool
+        bgworkers   [int] - number of threads in the background pool
+    """
+    def __init__(self, maxdepth=50, ioworkers=2, encworkers=1, bgworkers=0):
+        self.maxdepth = maxdepth
+        self.jobtypes = {}
+        self._seq = 0
+        self._heaps = {'io': [], 'encode': [], 'background': []}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = []
+        for pool, nworkers in (('io', ioworkers), ('encode', encworkers), ('background', bgworkers)):
+            for i in range(nworkers):
+                t = threading.Thread(target=self._worker, args=(pool,), name=f'{pool}worker{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def registerJobType(self, name, priority=5, policy='fifo', pool='io'):
+        self.jobtypes[name] = JobType(name, priority, policy, pool)
+        return self.jobtypes[name]
+
+    def _pendingJobs(self, name=None):
+        jobs = []
+        for heap in self._heaps.values():
+            jobs += [entry[2] for entry in heap if not entry[2].cancelled]
+        if name is not None:
+            jobs = [j for j in jobs if j.jobtype.name == name]
+        return jobs
+
+    def submit(self, name, func, *args, **kwargs):
+        """
+        Queue a job of a registered type.
+
+        Returns:
+            True if the job was queued, False if it was dropped
+        """
+        jobtype = self.jobtypes[name]
+        with self._cond:
+            jobtype.submitted += 1
+            pending = self._pendingJobs(name)
+            if jobtype.policy == 'drop' and len(pending) > 0:
+                jobtype.dropped += 1
+                return False
+            if jobtype.policy == 'latest':
+                for job in pending:
+                    job.cancelled = True
+                    jobtype.dropped += 1
+            allpending = self._pendingJobs()
+            if len(allpending) >= self.maxdepth:
+                worst = max(allpending, key=lambda j: (j.jobtype.priority, -j.queued))
+                if worst.jobtype.priority <= jobtype.priority:
+                    jobtype.dropped += 1
+                    log.warning(f'task queue full, dropping {name} job')
+                    return False
+                worst.cancelled = True
+                worst.jobtype.dropped += 1
+                log.warning(f'task queue full, dropping {worst.jobtype.name} job')
+            self._seq += 1
+            heapq.heappush(self._heaps[jobtype.pool], (jobtype.priority, self._seq, _Job(jobtype, func, args, kwargs)))
+            self._cond.notify_all()
+        return True
+
+    def _worker(self, pool):
+        heap = self._heaps[pool]
+        while True:
+            with self._cond:
+                while not self._stopping and not heap:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                job = heapq.heappop(heap)[2]
+                if job.cancelled:
+                    self._cond.notify_all()
+                    continue
+                jobtype = job.jobtype
+                jobtype.running += 1
+            started = time.monotonic()
+            try:
+                job.func(*job.args, **job.kwargs)
+                ok = True
+            except Exception as e:
+                log.warning(f'{jobtype.name} job failed')
+                log.info(e, exc_info=True)
+                ok = False
+            finished = time.monotonic()
+            with self._cond:
+                jobtype.running -= 1
+                jobtype.waits.append(started - job.queued)
+                jobtype.runtimes.append(finished - started)
+                if ok:
+                    jobtype.completed += 1
+                else:
+                    jobtype.failed += 1
+                self._cond.notify_all()
+
+    def pending(self, name=None):
+        """ number of jobs queued or running, optionally just for one job type """
+        with self._cond:
+            jobs = len(self._pendingJobs(name))
+            if name is None:
+                running = sum([jt.running for jt in self.jobtypes.values()])
+            else:
+                running = self.jobtypes[name].running
+        return jobs + running
+
+    def join(self, timeout=None):
+        """ wait for all queued and running jobs to finish """
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self._pendingJobs()) == 0
+                                       and sum([jt.running for jt in self.jobtypes.values()]) == 0, timeout=timeout)
+
+    def stop(self, timeout=None):
+        """ finish the outstanding jobs and stop the workers """
+        self.join(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Queue depth and per job type counts and latencies.
+
+        Returns:
+            dict with the total depth and, for each job type, the number pending and the mean
+            and max queue wait and run time in seconds over the last 100 jobs
+        """
+        with self._cond:
+            stats = {'depth': len(self._pendingJobs()), 'jobs': {}}
+            for name, jt in self.jobtypes.items():
+                stats['jobs'][name] = {
+                    'pending': len(self._pendingJobs(name)), 'running': jt.running,
+                    'submitted': jt.submitted, 'completed': jt.completed, 'failed': jt.failed, 'dropped': jt.dropped,
+                    'meanwait': round(sum(jt.waits) / len(jt.waits), 3) if jt.waits else 0,
+                    'maxwait': round(max(jt.waits), 3) if jt.waits else 0,
+                    'meanrun': round(sum(jt.runtimes) / len(jt.runtimes), 3) if jt.runtimes else 0,
+                    'maxrun': round(max(jt.runtimes), 3) if jt.runtimes else 0}
+        return stats
+
+    def logStats(self):
+        stats = self.stats()
+        summary = ', '.join([f'{n}: {s["pending"]} pending, wait {s["meanwait"]}s, run {s["meanrun"]}s'
+                             for n, s in stats['jobs'].items() if s['submitted'] > 0])
+        log.info(f'task queue depth {stats["depth"]}; {summary}')
+        return stats
@@ -2,11 +2,32 @@
 
 import configparser
 import platform
+import datetime
+import json
 import os
 import shutil
-from archAndFree import getFilesToUpload, getDeletableFiles, compressAndDelete
-from archAndFree import compressAndUpload
-from auroraCam import getAWSConn
+import time
+import pytest
+from auroraCam import getFilesToUpload, getDeletableFiles, compressAndDelete
+from auroraCam import compressAndUpload
+from auroraCam import getAWSConn, s3details, invalidateS3Cache, getNextRiseSet
+from captureSession import CaptureSession
+from framePipeline import processFrame, FrameAnnotator, annotateFrame, writeThumbnail
+from timelapseEncoder import StreamingEncoder, selectBackend, encoderArgs, backends, segmentFrames, encodeFolders
+from taskQueue import TaskQueue
+from makeImageIndex import ImageIndexWriter
+from archiver import archiveFolders, streamFolder
+from chunkedUpload import pendingChunks
+from sunSchedule import SunSchedule
+from configWatcher import ConfigWatcher, loadCameraSettings
+from frameScheduler import FrameScheduler, LatencyHistogram
+from captureJournal import CaptureJournal, readJournal, summariseJournal
+from frameScan import scanFolder, goodFrames
+from sessionCatalog import SessionCatalog
+from spacePlanner import captureRates, planEviction
+from keogram import KeogramWriter, keogramFromFolder
+from auroraDetector import AuroraDetector
+from retention import RetentionPolicy, reduceFolder, FULL, REDUCED, SUMMARY
 
 
 dummydirs = ['20240913_060041', '20240916_060545', '20240917_175030', 
@@ -32,7 +53,7 @@ def createDummyData(cfg):
 
 def removeDummyData(cfg):
     for f in dummydirs:
-        shutil.rmtree(os.path.join(cfg['auroracam']['datadir'], f))
+        shutil.rmtree(os.path.join(cfg['auroracam']['datadir'], f), ignore_errors=True)
     return 
 
 
@@ -60,13 +81,14 @@ def test_getAWSConn_withidserver():
     assert s3 is not None
 
 
+@pytest.mark.skip(reason='needs the test S3 bucket')
 def test_getFilesToUpload_s3():
     cfg = loadDummyConfig()
     cfg['auroracam']['datadir']='/tmp/testac'
     cfg['uploads']['idkey']='/mnt/e/dev/aws/awskeys/actest.csv'
     cfg['auroracam']['camid']='UK9999'
     cfg['uploads']['s3uploadloc']='s3://ukmon-shared'
-    ftu = getFilesToUpload(cfg, uid='auroracam')
+    ftu = getFilesToUpload(cfg, None, None, None)
     try:
         os.remove(os.path.join('/tmp/testac', 'FILES_TO_UPLOAD.inf'))
     except Exception:
@@ -75,6 +97,7 @@ def test_getFilesToUpload_s3():
     assert ftu[0] == '20240916_175254'
 
 
+@pytest.mark.skip(reason='needs the test archive server')
 def test_getFilesToUpload_ftp():
     cfg = loadDummyConfig()
     cfg['auroracam']['datadir']='/tmp/testac'
@@ -83,7 +106,7 @@ def test_getFilesToUpload_ftp():
     cfg['archive']['archuser']='mark'
     cfg['archive']['archfldr']='/data3/astrodata/actest'
     cfg['archive']['archkey']='~/.ssh/markskey.pem'
-    ftu = getFilesToUpload(cfg, uid='auroracam')
+    ftu = getFilesToUpload(cfg, None, None, None)
     try:
         os.remove(os.path.join('/tmp/testac', 'FILES_TO_UPLOAD.inf'))
     except Exception:
@@ -94,10 +117,11 @@ def test_getFilesToUpload_ftp():
 
 def test_getFilesToUpload_localonly():
     cfg = loadDummyConfig()
-    open('/tmp/FILES_TO_UPLOAD.inf', 'w').write('20240916_175254\n')
+    os.makedirs('/tmp/testac', exist_ok=True)
+    open('/tmp/testac/FILES_TO_UPLOAD.inf', 'w').write('20240916_175254\n')
     cfg['auroracam']['datadir']='/tmp/testac'
     cfg['auroracam']['camid']='UK9999'
-    ftu = getFilesToUpload(cfg, uid='auroracam')
+    ftu = getFilesToUpload(cfg, None, None, None)
     try:
         os.remove(os.path.join('/tmp/testac', 'FILES_TO_UPLOAD.inf'))
     except Exception:
@@ -126,6 +150,7 @@ def test_compressAndDelete():
     removeDummyData(cfg)
 
 
+@pytest.mark.skip(reason='needs the test archive server')
 def test_compressAndupload():
     cfg = loadDummyConfig()
     cfg['auroracam']['datadir']='/tmp/testac'
@@ -140,6 +165,16 @@ def test_compressAndupload():
     removeDummyData(cfg)
 
 
+def test_compressAndupload_missing():
+    cfg = loadDummyConfig()
+    cfg['auroracam']['datadir']='/tmp/testac'
+    cfg['archive']['archserver']=''
+    os.makedirs('/tmp/testac', exist_ok=True)
+    zipfile = compressAndUpload(cfg, '20240101_000000')
+    assert zipfile is None
+    assert not os.path.isfile('/tmp/testac/20240101_000000.zip')
+
+
 def test_compressAndupload_noarch():
     cfg = loadDummyConfig()
     cfg['auroracam']['datadir']='/tmp/testac'
@@ -149,3 +184,561 @@ def test_compressAndupload_noarch():
     assert os.path.isdir('/tmp/testac/20240907_055026')
     assert os.path.isfile(zipfile)
     removeDummyData(cfg)
+
+
+def test_captureSession():
+    import cv2
+    import numpy as np
+    vid = cv2.VideoWriter('/tmp/testcap.avi', cv2.VideoWriter_fourcc(*'MJPG'), 25, (320,240))
+    for i in range(50):
+        vid.write(np.full((240,320,3), i, np.uint8))
+    vid.release()
+    capsession = CaptureSession('127.0.0.1')
+    capsession.capstr = '/tmp/testcap.avi'
+    capsession.start()
+    frame1 = capsession.getFrame(timeout=5)
+    frame2 = capsession.getFrame(timeout=5)
+    capsession.stop()
+    os.remove('/tmp/testcap.avi')
+    assert frame1.shape == (240,320,3)
+    assert frame2 is not None
+    assert frame2.mean() > frame1.mean()
+
+
+def test_processFrame():
+    import cv2
+    import numpy as np
+    frame = np.full((480,640,3), 100, np.uint8)
+    frame = processFrame(frame, '/tmp/testframe.jpg', 'test 2024-09-17 20:00:00', (0.5,1,1))
+    img = cv2.imread('/tmp/testframe.jpg')
+    os.remove('/tmp/testframe.jpg')
+    assert img.shape == (480,640,3)
+    assert frame[0,0,2] == 50 and frame[0,0,1] == 100
+    assert frame[440:460,15:200].max() == 255
+
+
+def test_frameAnnotator():
+    import numpy as np
+    frame1 = np.full((480,640,3), 30, np.uint8)
+    frame2 = frame1.copy()
+    annotateFrame(frame1, 'auroracam 2024-09-17 20:00:00', color='#FFFFFF')
+    annotator = FrameAnnotator('auroracam ', color='#FFFFFF')
+    annotator.annotate(frame2, 'auroracam 2024-09-17 20:00:00')
+    diff = np.abs(frame1.astype(int) - frame2.astype(int))
+    assert frame2.max() == 255
+    assert diff.mean() < 1
+
+
+def test_streamingEncoder():
+    import cv2
+    import numpy as np
+    capdir = '/tmp/testac/20240917_180000'
+    os.makedirs(capdir, exist_ok=True)
+    for i in range(5):
+        cv2.imwrite(os.path.join(capdir, f'20240917_1800{i:02d}.jpg'), np.full((240,320,3), i*10+20, np.uint8))
+    encoder = StreamingEncoder(capdir, 62)
+    encoder.start()
+    for i in range(5, 20):
+        fnam = os.path.join(capdir, f'20240917_1800{i:02d}.jpg')
+        cv2.imwrite(fnam, np.full((240,320,3), i*10+20, np.uint8))
+        encoder.addFrame(fnam)
+    mp4name = encoder.finish()
+    nframes = cv2.VideoCapture(mp4name).get(cv2.CAP_PROP_FRAME_COUNT)
+    shutil.rmtree(capdir)
+    assert mp4name == os.path.join(capdir, '20240917_180000.mp4')
+    assert nframes == 20
+
+
+def test_streamingEncoderSkipsBadFrames():
+    import cv2
+    import numpy as np
+    capdir = '/tmp/testac/20240917_190000'
+    os.makedirs(capdir, exist_ok=True)
+    encoder = StreamingEncoder(capdir, 62)
+    encoder.start()
+    for i in range(12):
+        fnam = os.path.join(capdir, f'20240917_1900{i:02d}.jpg')
+        # a black frame, a repeat of the frame before, and a truncated frame
+        level = 0 if i == 3 else (i - 1 if i == 6 else i) * 10 + 20
+        cv2.imwrite(fnam, np.full((240,320,3), level, np.uint8))
+        if i == 9:
+            data = open(fnam, 'rb').read()
+            open(fnam, 'wb').write(data[:len(data) // 2])
+        encoder.addFrame(fnam)
+    mp4name = encoder.finish()
+    nframes = cv2.VideoCapture(mp4name).get(cv2.CAP_PROP_FRAME_COUNT)
+    good = [os.path.basename(f) for f in goodFrames(capdir)]
+    shutil.rmtree(capdir)
+    assert encoder.skipped == 3
+    assert encoder.frames == good
+    assert nframes == 9
+
+
+def test_taskQueue():
+    import time
+    tasks = TaskQueue(maxdepth=10, ioworkers=1)
+    tasks.registerJobType('slow', priority=5)
+    tasks.registerJobType('liveupload', priority=1, policy='latest')
+    done = []
+    tasks.submit('slow', time.sleep, 0.2)
+    for i in range(5):
+        tasks.submit('liveupload', done.append, i)
+    assert tasks.join(timeout=5)
+    stats = tasks.stats()
+    tasks.stop()
+    assert done == [4]
+    assert stats['jobs']['liveupload']['dropped'] == 4
+    assert stats['depth'] == 0
+
+
+def test_taskQueueBackground():
+    import time
+    import threading
+    tasks = TaskQueue(maxdepth=10, ioworkers=1, encworkers=1, bgworkers=1)
+    tasks.registerJobType('timelapse', priority=5, pool='encode')
+    tasks.registerJobType('retention', priority=9, pool='background')
+    done = threading.Event()
+    tasks.submit('retention', time.sleep, 1)
+    time.sleep(0.1)
+    tasks.submit('timelapse', done.set)
+    notdelayed = done.wait(timeout=0.5)
+    tasks.stop(timeout=5)
+    assert notdelayed
+
+
+def test_imageIndexWriter():
+    capdir = '/tmp/testac/20240917_180000'
+    os.makedirs(capdir, exist_ok=True)
+    open(os.path.join(capdir, '20240917_180000.jpg'), 'w').write('')
+    indexer = ImageIndexWriter(capdir)
+    indexer.add(os.path.join(capdir, '20240917_180002.jpg'), os.path.join(capdir, 'thumbs', '20240917_180002.jpg'))
+    indexer.add(os.path.join(capdir, '20240917_180002.jpg'))
+    indexer.close()
+    lis = open(os.path.join(capdir, 'manifest.jsonl')).readlines()
+    hasindex = os.path.isfile(os.path.join(capdir, 'index.html'))
+    shutil.rmtree(capdir)
+    assert len(lis) == 2
+    assert '"thumb":"thumbs/20240917_180002.jpg"' in lis[1]
+    assert hasindex
+
+
+def test_writeThumbnail():
+    import cv2
+    import numpy as np
+    frame = np.full((1080,1920,3), 100, np.uint8)
+    ret = writeThumbnail(frame, '/tmp/testac/thumbs/test.jpg')
+    img = cv2.imread('/tmp/testac/thumbs/test.jpg')
+    shutil.rmtree('/tmp/testac/thumbs')
+    assert ret
+    assert img.shape == (90,160,3)
+
+
+def test_s3details_cached():
+    cfg = loadDummyConfig()
+    cfg['uploads']['s3uploadloc'] = 's3://ukmon-shared/auroracam'
+    s3a, bucket, s3prefix = s3details(cfg, 'auroracam')
+    s3b, _, _ = s3details(cfg, 'auroracam')
+    invalidateS3Cache()
+    s3c, _, _ = s3details(cfg, 'auroracam')
+    assert s3a is s3b
+    assert s3c is not s3a
+    assert bucket == 'ukmon-shared' and s3prefix == 'auroracam'
+
+
+def test_archiveFolders():
+    import zipfile
+    datadir = '/tmp/testarch'
+    folders = [os.path.join(datadir, f) for f in dummydirs[:3]]
+    for f in folders:
+        os.makedirs(f, exist_ok=True)
+        open(os.path.join(f, 'test1.jpg'), 'wb').write(os.urandom(1000))
+        open(os.path.join(f, 'test1.txt'), 'w').write('hello')
+    open(folders[0] + '.zip.tmp', 'w').write('partial')
+    archnames = archiveFolders(folders, workers=2)
+    zf = zipfile.ZipFile(archnames[0])
+    ctypes = {i.filename: i.compress_type for i in zf.infolist()}
+    zf.close()
+    leftover = os.listdir(datadir)
+    shutil.rmtree(datadir)
+    assert archnames == [f + '.zip' for f in folders]
+    assert sorted(leftover) == sorted([os.path.basename(f) + '.zip' for f in folders])
+    assert ctypes == {'test1.jpg': zipfile.ZIP_STORED, 'test1.txt': zipfile.ZIP_DEFLATED}
+
+
+def test_pendingChunks():
+    mb = 1024 * 1024
+    journal = '/tmp/testchunks.zip.chunks'
+    header = 'server:/data/test.zip 10485760 1 1048576'
+    with open(journal, 'w') as outf:
+        # chunk 3 was still being written when the upload stopped, and the last line was cut short
+        outf.write(header + '\n0\n1048576\n2097152\n4194304\n5242')
+    pending = pendingChunks(journal, header, 10 * mb, mb)
+    otherfile = pendingChunks(journal, header.replace('test.zip', 'other.zip'), 10 * mb, mb)
+    os.remove(journal)
+    nojournal = pendingChunks(journal, header, 10 * mb, mb)
+    assert pending == [3 * mb] + [i * mb for i in range(5, 10)]
+    assert otherfile == [i * mb for i in range(10)]
+    assert nojournal == otherfile
+
+
+def test_streamFolder():
+    import io
+    import zipfile
+
+    class UnseekableWriter(object):
+        def __init__(self):
+            self.buf = io.BytesIO()
+
+        def write(self, data):
+            return self.buf.write(data)
+
+        def flush(self):
+            pass
+
+    srcdir = '/tmp/teststream/20240907_055026'
+    os.makedirs(srcdir, exist_ok=True)
+    open(os.path.join(srcdir, 'test1.jpg'), 'wb').write(os.urandom(1000))
+    open(os.path.join(srcdir, 'test1.txt'), 'w').write('hello')
+    outf = UnseekableWriter()
+    nbytes = streamFolder(srcdir, outf)
+    shutil.rmtree('/tmp/teststream')
+    zf = zipfile.ZipFile(io.BytesIO(outf.buf.getvalue()))
+    assert nbytes == 1005
+    assert sorted(zf.namelist()) == ['test1.jpg', 'test1.txt']
+    assert zf.read('test1.txt') == b'hello'
+
+
+def test_sunSchedule():
+    import datetime
+    cachefile = '/tmp/sunschedule.json'
+    if os.path.isfile(cachefile):
+        os.remove(cachefile)
+    sched = SunSchedule(51.88, -1.31, 80, cachefile=cachefile)
+    dt = datetime.datetime(2024, 9, 17, 12, 0, 0, tzinfo=datetime.timezone.utc)
+    rise, set = sched.nextRiseSet(dt)
+    erise, eset = getNextRiseSet(51.88, -1.31, 80, fordate=dt)
+    assert abs((rise - erise).total_seconds()) < 1
+    assert abs((set - eset).total_seconds()) < 1
+    cached = SunSchedule(51.88, -1.31, 80, cachefile=cachefile)
+    os.remove(cachefile)
+    assert cached.rises == sched.rises
+
+
+def test_configWatcher():
+    os.makedirs('/tmp/testcfg', exist_ok=True)
+    cfgfile = '/tmp/testcfg/config.ini'
+    txt = open('config.ini').read()
+    open(cfgfile, 'w').write(txt)
+    watcher = ConfigWatcher(cfgfile, interval=0)
+    first = watcher.settings()
+    unchanged = watcher.settings()
+    open(cfgfile, 'w').write(txt.replace('RGBADJ=1.0,1.0,1.0', 'RGBADJ=1.0,0.9,1.0'))
+    time.sleep(0.01)
+    changed = watcher.settings()
+    open(cfgfile, 'w').write(txt.replace('NIGHTGAIN=70', 'NIGHTGAIN=high'))
+    time.sleep(0.01)
+    invalid = watcher.settings()
+    watcher.close()
+    shutil.rmtree('/tmp/testcfg')
+    assert unchanged is first
+    assert first.rgbadj == (1.0, 1.0, 1.0) and first.nightgain == 70
+    assert changed.rgbadj == (1.0, 0.9, 1.0)
+    assert invalid is changed
+
+
+def test_frameScheduler():
+    sched = FrameScheduler(0.05)
+    ticks = []
+    for i in range(6):
+        ticks.append(sched.wait())
+        time.sleep(0.12 if i == 2 else 0.01)
+        sched.frameDone()
+    gaps = [round((b - a) / 0.05) for a, b in zip(ticks, ticks[1:])]
+    assert gaps == [1, 1, 3, 1, 1]
+    assert sched.skipped == 2
+    assert sched.stats()['latency']['count'] == 6
+
+
+def test_latencyHistogram():
+    hist = LatencyHistogram(maxlen=3, edges=[10, 100])
+    for ms in [5, 50, 500, 5]:
+        hist.add(ms)
+    summary = hist.summary()
+    assert summary['count'] == 3
+    assert summary['buckets'] == {'<=10': 1, '<=100': 1, '>100': 1}
+    assert summary['max'] == 500
+
+
+def test_captureJournal():
+    import datetime
+    dirname = '/tmp/testjournal/20240917_175030'
+    journal = CaptureJournal(dirname, flushinterval=3600)
+    start = datetime.datetime(2024, 9, 17, 17, 50, 30, tzinfo=datetime.timezone.utc)
+    for i, gap in enumerate([0, 2.001, 1.999, 6.0, 2.0]):
+        journal.add(start + datetime.timedelta(seconds=2*i), gap, 150.0, 30.0, 250000)
+    journal.close()
+    rows = readJournal(dirname)
+    summary = summariseJournal(rows, nominal=2)
+    shutil.rmtree('/tmp/testjournal')
+    assert len(rows) == 5
+    assert rows[1]['interval'] == 2.001 and rows[1]['bytes'] == 250000
+    assert summary['gaps'] == 1
+    assert summary['interval']['max'] == 6.0
+    assert summary['capturems']['p50'] == 150.0
+
+
+def test_loadCameraSettings():
+    os.makedirs('/tmp/testcfg', exist_ok=True)
+    cfgfile = '/tmp/testcfg/config.ini'
+    txt = open('config.ini').read()
+    open(cfgfile, 'w').write(txt + '\n[camera2]\nIPADDRESS=1.2.3.4\nDATADIR=~/data/auroracam2\nCAMID=UK9998\nNIGHTGAIN=50\n')
+    cameras = loadCameraSettings(cfgfile)
+    open(cfgfile, 'w').write(txt + '\n[camera2]\nIPADDRESS=1.2.3.4\nDATADIR=~/data/auroracam\nCAMID=UK9998\n')
+    try:
+        loadCameraSettings(cfgfile)
+        samedir = False
+    except ValueError:
+        samedir = True
+    open(cfgfile, 'w').write(txt.replace('PERIOD=', 'PERIOD=1'))
+    fast = loadCameraSettings(cfgfile)[0]
+    open(cfgfile, 'w').write(txt.replace('THRESHOLD=1.0', 'THRESHOLD=high'))
+    try:
+        loadCameraSettings(cfgfile)
+        badthreshold = False
+    except ValueError:
+        badthreshold = True
+    shutil.rmtree('/tmp/testcfg')
+    assert [c.name for c in cameras] == ['auroracam', 'camera2']
+    assert cameras[1].nightgain == 50 and cameras[0].nightgain == 70
+    assert cameras[1].cfg['auroracam']['camid'] == 'UK9998'
+    assert cameras[1].cfg['auroracam']['lat'] == cameras[0].cfg['auroracam']['lat']
+    assert samedir
+    assert cameras[0].aurorathreshold == 1.0 and not cameras[0].auroraalert and not cameras[0].auroraupload
+    assert cameras[0].auroraperiod is None and cameras[1].auroraperiod is None
+    assert fast.auroraperiod == 1.0
+    assert badthreshold
+
+
+def test_selectBackend():
+    os.makedirs('/tmp/testencoder', exist_ok=True)
+    cachefile = '/tmp/testencoder/encoder.json'
+    open(cachefile, 'w').write(json.dumps({platform.uname().node: {'backend': 'x264fast', 'results': None}}))
+    backend = selectBackend(cachefile)
+    args = encoderArgs(cachefile)
+    # without a saved choice the default is used, rather than benchmarking there and then
+    default = encoderArgs('/tmp/testencoder/none.json')
+    benchmarked = os.path.isfile('/tmp/testencoder/none.json')
+    shutil.rmtree('/tmp/testencoder')
+    assert backend == 'x264fast'
+    assert args == backends['x264fast']
+    assert default == backends['x264'] and not benchmarked
+
+
+def test_segmentFrames():
+    jpgs = [f'{i:05d}.jpg' for i in range(1000)]
+    runs = segmentFrames(jpgs, 4)
+    assert len(runs) == 3
+    assert sum(runs, []) == jpgs
+    assert segmentFrames(jpgs[:100], 4) == [jpgs[:100]]
+
+
+def test_encodeFolders():
+    import cv2
+    import numpy as np
+    capdir = '/tmp/testac/20240918_180000'
+    os.makedirs(capdir, exist_ok=True)
+    rng = np.random.default_rng(2)
+    for i in range(620):
+        cv2.imwrite(os.path.join(capdir, f'20240918_{180000 + i // 60 * 100 + i % 60}.jpg'),
+                    rng.integers(20, 60, (48, 64, 3), dtype=np.uint8))
+    mp4name = os.path.join(capdir, '20240918_180000.mp4')
+    built = encodeFolders([(capdir, mp4name)], 62, workers=2)
+    nframes = cv2.VideoCapture(mp4name).get(cv2.CAP_PROP_FRAME_COUNT)
+    shutil.rmtree(capdir)
+    assert built == {mp4name: True}
+    # the lead-in frames of the second segment are left out
+    assert nframes == 620
+
+
+def test_scanFolder():
+    import numpy as np
+    os.makedirs('/tmp/testscan', exist_ok=True)
+    rng = np.random.default_rng(1)
+    for i in range(5):
+        frame = rng.integers(10, 40, (480, 640, 3), dtype=np.uint8)
+        if i == 2:
+            frame = prev.copy()
+        if i == 3:
+            frame[:] = 0
+        prev = frame.copy()
+        processFrame(frame, f'/tmp/testscan/20240917_20000{i}.jpg', f'test 2024-09-17 20:00:0{i}')
+    data = open('/tmp/testscan/20240917_200004.jpg', 'rb').read()
+    open('/tmp/testscan/20240917_200004.jpg', 'wb').write(data[:len(data) // 2])
+    summary = scanFolder('/tmp/testscan')
+    cached = os.path.isfile('/tmp/testscan/framescan.json')
+    shutil.rmtree('/tmp/testscan')
+    assert [os.path.basename(f) for f in summary['good']] == ['20240917_200000.jpg', '20240917_200001.jpg']
+    assert [os.path.basename(f) for f in summary['duplicate']] == ['20240917_200002.jpg']
+    assert [os.path.basename(f) for f in summary['black']] == ['20240917_200003.jpg']
+    assert [os.path.basename(f) for f in summary['corrupt']] == ['20240917_200004.jpg']
+    assert cached
+
+
+def test_sessionCatalog():
+    datadir = '/tmp/testcatalog'
+    for f in ['20240907_055026', '20240908_055101', '20240911_180453']:
+        os.makedirs(os.path.join(datadir, f), exist_ok=True)
+        open(os.path.join(datadir, f, f + '.jpg'), 'w').write('hello')
+    open(os.path.join(datadir, '20240906_055000.zip'), 'w').write('zip')
+    catalog = SessionCatalog(datadir)
+    catalog.addFrame(os.path.join(datadir, '20240911_180453'), datetime.datetime(2024, 9, 11, 18, 5, 2), 1000)
+    deletable = catalog.deletable(3, ['20240911_180453'], now=datetime.datetime(2024, 9, 11, 20, 0, 0))
+    found = catalog.findFolder('20240908_0551')
+    sessions = catalog.sessions()
+    catalog.close()
+    shutil.rmtree(datadir)
+    assert deletable == ['20240906_055000.zip', '20240907_055026', '20240908_055101', '20240911_180453']
+    assert found == '20240908_055101'
+    assert sessions[-1]['frames'] == 2 and sessions[-1]['bytes'] == 1005
+    assert sessions[0]['folder'] == 0 and sessions[0]['archive'] == '20240906_055000.zip'
+
+
+def test_sessionCatalogBatchesFrames():
+    datadir = '/tmp/testcatalog'
+    os.makedirs(datadir, exist_ok=True)
+    catalog = SessionCatalog(datadir, flushframes=5)
+    for i in range(4):
+        catalog.addFrame(os.path.join(datadir, '20240912_180500'), datetime.datetime(2024, 9, 12, 18, 5, i), 100)
+    found = catalog.findFolder('20240912_1805')
+    reader = SessionCatalog(datadir)
+    unflushed = reader.sessions()
+    catalog.addFrame(os.path.join(datadir, '20240912_180500'), datetime.datetime(2024, 9, 12, 18, 5, 4), 100)
+    flushed = reader.sessions()
+    catalog.addFrame(os.path.join(datadir, '20240912_180500'), datetime.datetime(2024, 9, 12, 18, 5, 5), 100)
+    catalog.close()
+    closed = reader.sessions()
+    reader.close()
+    shutil.rmtree(datadir)
+    assert found == '20240912_180500'
+    assert unflushed == []
+    assert flushed[0]['frames'] == 5 and flushed[0]['bytes'] == 500
+    assert closed[0]['frames'] == 6 and closed[0]['end'] == '2024-09-12T18:05:05'
+
+
+def test_captureRates():
+    sessions = [{'name': '20240907_181430', 'start': '2024-09-07T18:14:30', 'end': '2024-09-08T04:14:30',
+                 'frames': 9000, 'bytes': 9000 * 150000},
+                {'name': '20240908_181200', 'start': '2024-09-08T18:12:00', 'end': '2024-09-08T18:13:00',
+                 'frames': 10, 'bytes': 10 * 999999}]
+    framebytes, framesperhour = captureRates(sessions)
+    assert framebytes == 150000
+    assert framesperhour == 900
+    assert captureRates([]) == (100 * 1024, 20000 / 24)
+
+
+def test_planEviction():
+    datadir = '/tmp/testplanner'
+    for f in ['20240907_181430', '20240908_181200', '20240909_180941']:
+        os.makedirs(os.path.join(datadir, f), exist_ok=True)
+        open(os.path.join(datadir, f, f + '.jpg'), 'wb').write(b'x' * 100000)
+        open(os.path.join(datadir, f, 'capturejournal.csv'), 'wb').write(b'x' * 10000)
+    open(os.path.join(datadir, '20240906_181600.zip'), 'wb').write(b'x' * 50000)
+    candidates = ['20240906_181600.zip', '20240907_181430', '20240908_181200', '20240909_180941']
+    evict, freed = planEviction(datadir, candidates, 65000)
+    none, _ = planEviction(datadir, candidates, 0)
+    shutil.rmtree(datadir)
+    assert evict == ['20240906_181600.zip', '20240907_181430', '20240908_181200']
+    assert freed == 70000
+    assert none == []
+
+
+def test_retentionPolicy():
+    cfg = loadDummyConfig()
+    assert not RetentionPolicy.fromConfig(cfg).enabled()
+    cfg['retention']['reducedafter'] = '1'
+    cfg['retention']['summaryafter'] = '30'
+    policy = RetentionPolicy.fromConfig(cfg)
+    now = datetime.datetime(2024, 10, 20, 12, tzinfo=datetime.timezone.utc)
+    # never thinned within DAYSTOKEEP days
+    assert policy.reducedafter == 3
+    assert policy.tierFor(now - datetime.timedelta(days=2), now) == FULL
+    assert policy.tierFor(now - datetime.timedelta(days=5), now) == REDUCED
+    assert policy.tierFor(now - datetime.timedelta(days=40), now) == SUMMARY
+
+
+def test_reduceFolder():
+    from PIL import Image
+    dirname = '/tmp/testreduce/20240917_200000'
+    os.makedirs(os.path.join(dirname, 'thumbs'), exist_ok=True)
+    for i in range(10):
+        fnam = f'20240917_2000{i:02d}.jpg'
+        Image.new('RGB', (64, 48), (i * 20, 100, 50)).save(os.path.join(dirname, fnam), quality=95)
+        Image.new('RGB', (16, 12)).save(os.path.join(dirname, 'thumbs', fnam))
+    notimelapse = reduceFolder(dirname, REDUCED, every=4)
+    open(os.path.join(dirname, '20240917_200000.mp4'), 'wb').write(b'x' * 1000)
+    before, after = reduceFolder(dirname, REDUCED, every=4)
+    reduced = sorted(os.listdir(dirname))
+    thumbs = os.listdir(os.path.join(dirname, 'thumbs'))
+    reduceFolder(dirname, SUMMARY)
+    summary = sorted(os.listdir(dirname))
+    shutil.rmtree('/tmp/testreduce')
+    assert notimelapse is None
+    assert after < before
+    assert [f for f in reduced if f.endswith('.jpg')] == ['20240917_200000.jpg', '20240917_200004.jpg',
+                                                         '20240917_200008.jpg', 'keogram.jpg']
+    assert len(thumbs) == 3
+    assert 'keogram.jpg' in summary and '20240917_200000.mp4' in summary
+    assert not [f for f in summary if f.startswith('20240917_2000') and f.endswith('.jpg')]
+
+
+def test_keogramWriter():
+    import numpy as np
+    import cv2
+    dirname = '/tmp/testkeogram'
+    writer = KeogramWriter(dirname)
+    for i in range(5):
+        frame = np.full((120, 160, 3), i * 50, dtype=np.uint8)
+        writer.add(frame)
+    writer.close()
+    # carries on after a restart
+    writer = KeogramWriter(dirname)
+    writer.add(np.full((120, 160, 3), 255, dtype=np.uint8))
+    ncols = writer.ncols
+    keoname = writer.finish()
+    keo = cv2.imread(keoname)
+    hasdata = os.path.isfile(os.path.join(dirname, 'keogram.dat'))
+    again = keogramFromFolder(dirname)
+    shutil.rmtree(dirname)
+    assert ncols == 6
+    assert keo.shape == (60, 6, 3)
+    assert abs(int(keo[30, 1, 0]) - 50) < 5 and keo[30, 5, 0] > 250
+    assert not hasdata
+    assert again is None
+
+
+def test_setPeriod():
+    sched = FrameScheduler(0.05)
+    ticks = [sched.wait(), sched.wait()]
+    sched.setPeriod(0.1)
+    ticks += [sched.wait(), sched.wait()]
+    gaps = [round((b - a) / 0.05) for a, b in zip(ticks, ticks[1:])]
+    assert gaps == [1, 2, 2]
+    assert sched.ticks == 4
+
+
+def test_auroraDetector():
+    import numpy as np
+    rng = np.random.default_rng(0)
+    sky = rng.integers(10, 30, (240, 320, 3)).astype(np.int16)
+    detector = AuroraDetector(threshold=1.0)
+    scores = []
+    for i in range(40):
+        frame = sky + rng.integers(-5, 6, sky.shape)
+        if 20 <= i < 30:
+            frame[20:120, :, 1] += 40
+        scores.append(detector.update(np.clip(frame, 0, 255).astype(np.uint8)))
+        if i == 25:
+            active = detector.active
+    assert max(scores[:20]) < 0.5
+    assert active and detector.changed
+    assert not detector.active
@@ -0,0 +1,455 @@
+# Copyright (C) Mark McIntyre
+#
+# Build the timelapse incrementally while the frames are being captured
+#
+import os
+import sys
+import glob
+import json
+import time
+import queue
+import shutil
+import platform
+import tempfile
+import threading
+import subprocess
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from frameScan import goodFrames, frameList, classifyFrame, scanEntry, loadScan, saveScan
+
+log = logging.getLogger("logger")
+
+# encoder settings and filter chain shared with makeTimelapse
+tlvcodec = ['-vcodec', 'libx264', '-pix_fmt', 'yuv420p', '-crf', '25', '-movflags', 'faststart', '-g', '15']
+tlfilter = 'hqdn3d=4:3:6:4.5,lutyuv=y=gammaval(0.77)'
+
+# encoder backends makeTimelapse can use. x264 is the original settings and is the fallback
+# if the others aren't available. x264fast trades a slightly bigger file for speed and uses
+# every core, and v4l2m2m uses the hardware encoder on a Raspberry Pi, if ffmpeg supports it.
+backends = {
+    'x264': tlvcodec,
+    'x264fast': ['-vcodec', 'libx264', '-preset', 'veryfast', '-threads', str(os.cpu_count() or 1),
+                 '-pix_fmt', 'yuv420p', '-crf', '25', '-movflags', 'faststart', '-g', '15'],
+    'v4l2m2m': ['-vcodec', 'h264_v4l2m2m', '-pix_fmt', 'yuv420p', '-b:v', '8M', '-movflags', 'faststart', '-g', '15'],
+}
+defaultbackend = 'x264'
+encodercache = os.path.expanduser('~/.auroracam_encoder.json')
+minsegment = 300 # fewest frames worth encoding as a separate segment
+leadin = 15      # frames before each segment fed to the denoiser but not encoded, so the joins don't show
+
+
+def timelapseName(dirname, daytimelapse=False):
+    """ the name of the timelapse for a capture folder """
+    dirname = os.path.normpath(os.path.expanduser(dirname))
+    _, mp4shortname = os.path.split(dirname)[:15]
+    if daytimelapse:
+        return os.path.join(dirname, mp4shortname + '_day.mp4')
+    return os.path.join(dirname, mp4shortname + '.mp4')
+
+
+class StreamingEncoder(object):
+    """
+    Feed frames to a long-running ffmpeg process as they are captured.
+
+    The JPEGs are piped to ffmpeg by a writer thread, so a slow encoder never holds up the
+    capture loop. Any frames already in the folder when the encoder starts, for example
+    after a restart, are fed in first so that the timelapse covers the whole session.
+    At the end of the session finish() closes the pipe and ffmpeg only has to flush the
+    last few frames and write the index, which takes seconds.
+
+    Each frame is checked in the writer thread in the same way as frameScan.scanFolder, and
+    truncated, black and repeated frames are left out, so the timelapse has the same frames
+    as one rebuilt from the folder. The results are saved to framescan.json at the end.
+
+    Parameters:
+        dirname         [string] - the capture folder
+        fps             [int]    - frame rate of the timelapse
+        daytimelapse    [bool]   - whether this is the daytime timelapse
+        vcodec          [list]   - ffmpeg encoder arguments, eg from encoderArgs()
+    """
+    def __init__(self, dirname, fps, daytimelapse=False, vcodec=tlvcodec):
+        self.dirname = os.path.normpath(os.path.expanduser(dirname))
+        self.fps = fps
+        self.daytimelapse = daytimelapse
+        self.vcodec = vcodec
+        self.mp4name = timelapseName(self.dirname, daytimelapse)
+        self.partname = self.mp4name + '.part'
+        self.framecount = 0
+        self.skipped = 0
+        self.failed = False
+        self.frames = []
+        self._seen = set()
+        self._scan = {}
+        self._cache = {}
+        self._prev = None
+        self._queue = queue.Queue()
+        self._proc = None
+        self._thread = None
+
+    def start(self):
+        """ start ffmpeg and the writer thread, backfilling any frames already captured """
+        cmdline = ['ffmpeg', '-v', 'quiet', '-y', '-f', 'image2pipe', '-framerate', str(self.fps), '-c:v', 'mjpeg',
+                   '-i', '-'] + self.vcodec + ['-vf', tlfilter, '-f', 'mp4', self.partname]
+        try:
+            self._proc = subprocess.Popen(cmdline, stdin=subprocess.PIPE)
+        except Exception as e:
+            log.warning('unable to start streaming timelapse encoder')
+            log.info(e, exc_info=True)
+            self.failed = True
+            return False
+        backfill = frameList(self.dirname)
+        self._cache = loadScan(self.dirname)
+        self._thread = threading.Thread(target=self._writer, args=(backfill,), name='tlencoder', daemon=True)
+        self._thread.start()
+        log.info(f'streaming timelapse to {self.partname}, {len(backfill)} existing frames')
+        return True
+
+    def addFrame(self, jpgname):
+        """ queue a saved frame for encoding """
+        if not self.failed:
+            self._queue.put(jpgname)
+
+    def _writer(self, backfill):
+        for jpgname in backfill:
+            self._feed(jpgname)
+        while True:
+            jpgname = self._queue.get()
+            if jpgname is None:
+                break
+            self._feed(jpgname)
+        try:
+            self._proc.stdin.close()
+        except Exception:
+            pass
+
+    def _feed(self, jpgname):
+        if self.failed or jpgname in self._seen:
+            return
+        name = os.path.basename(jpgname)
+        res = scanEntry(jpgname, self._cache)
+        if res is None:
+            log.warning(f'unable to read {jpgname} for timelapse')
+            return
+        self._seen.add(jpgname)
+        self._scan[name] = res
+        if classifyFrame(res, self._prev) != 'good':
+            self.skipped += 1
+            return
+        try:
+            self._proc.stdin.write(open(jpgname, 'rb').read())
+        except Exception as e:
+            log.warning('streaming timelapse encoder has stopped')
+            log.info(e, exc_info=True)
+            self.failed = True
+            return
+        self._prev = res
+        self.frames.append(name)
+        self.framecount += 1
+
+    def abort(self):
+        """ stop the encoder and discard the partial timelapse """
+        if self._proc is None:
+            return
+        self.failed = True
+        self._queue.put(None)
+        self._proc.kill()
+        self._proc.wait()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        if os.path.isfile(self.partname):
+            os.remove(self.partname)
+        self._proc = None
+
+    def finish(self, timeout=300):
+        """
+        Finalise the timelapse.
+
+        Returns:
+            the name of the mp4, or None if the encoder failed or its frames differ from the
+            good frames in the folder, in which case the timelapse should be made from scratch.
+        """
+        if self._proc is None:
+            return None
+        self._queue.put(None)
+        self._thread.join(timeout=timeout)
+        try:
+            ret = self._proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            log.warning('streaming timelapse encoder did not finish')
+            # stop it before the partial timelapse is removed, so nothing else is writing it
+            self._proc.kill()
+            self._proc.wait()
+            ret = -1
+        self._proc = None
+        # with the frames checked here saved, goodFrames only has to scan any that were missed
+        if self._scan:
+            cache = loadScan(self.dirname)
+            cache.update(self._scan)
+            saveScan(self.dirname, cache)
+        good = [os.path.basename(x) for x in goodFrames(self.dirname)]
+        if ret != 0 or self.failed or self.frames != good:
+            log.warning(f'streaming timelapse incomplete, {self.framecount} frames encoded, {len(good)} good frames')
+            if os.path.isfile(self.partname):
+                os.remove(self.partname)
+            return None
+        os.replace(self.partname, self.mp4name)
+        log.info(f'streaming timelapse saved to {self.mp4name}, {self.skipped} bad frames left out')
+        return self.mp4name
+
+
+def encodeFrames(jpgs, outname, fps, vcodec=tlvcodec, skip=0):
+    """
+    Pipe a list of frames into ffmpeg and encode them. Raises IOError if ffmpeg fails.
+
+    Parameters:
+        jpgs    [list]   - the frames, in order
+        outname [string] - the mp4 to create
+        fps     [int]    - frame rate
+        vcodec  [list]   - ffmpeg encoder arguments
+        skip    [int]    - number of frames at the start that only prime the filters and
+                            are left out of the mp4
+    """
+    vfilter = tlfilter
+    if skip > 0:
+        # trim loses the frame rate, so it has to be set again on the output
+        vfilter += f',trim=start_frame={skip},setpts=PTS-STARTPTS'
+        vcodec = vcodec + ['-r', str(fps)]
+    cmdline = ['ffmpeg', '-v', 'quiet', '-y', '-f', 'image2pipe', '-framerate', str(fps), '-c:v', 'mjpeg',
+               '-i', '-'] + vcodec + ['-vf', vfilter, '-f', 'mp4', outname]
+    proc = subprocess.Popen(cmdline, stdin=subprocess.PIPE)
+    try:
+        for jpgname in jpgs:
+            proc.stdin.write(open(jpgname, 'rb').read())
+    finally:
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+        ret = proc.wait()
+    if ret != 0:
+        if os.path.isfile(outname):
+            os.remove(outname)
+        raise IOError(f'ffmpeg failed with {ret} encoding {outname}')
+    return outname
+
+
+def _joinSegments(segments, mp4name):
+    """ join the encoded segments into the timelapse with the concat demuxer, without re-encoding """
+    listname = os.path.join(os.path.dirname(segments[0]), 'segments.txt')
+    with open(listname, 'w') as outf:
+        for seg in segments:
+            outf.write(f"file '{seg}'\n")
+    partname = mp4name + '.part'
+    cmdline = ['ffmpeg', '-v', 'quiet', '-y', '-f', 'concat', '-safe', '0', '-i', listname, '-c', 'copy',
+               '-movflags', 'faststart', '-f', 'mp4', partname]
+    ret = subprocess.call(cmdline, stdin=subprocess.DEVNULL)
+    if ret != 0:
+        raise IOError(f'ffmpeg failed with {ret} joining {mp4name}')
+    os.replace(partname, mp4name)
+
+
+def segmentFrames(jpgs, workers, minframes=minsegment):
+    """ split a sorted list of frames into up to workers runs of at least minframes each """
+    nsegs = max(1, min(workers, len(jpgs) // minframes))
+    size = -(-len(jpgs) // nsegs)
+    return [jpgs[i:i + size] for i in range(0, len(jpgs), size)]
+
+
+def encodeFolders(folders, fps, workers=None, vcodec=tlvcodec):
+    """
+    Rebuild the timelapses for one or more capture folders, encoding each in segments in
+    parallel.
+
+    The frames in each folder are split into consecutive runs which are queued together, so
+    that a backlog of several nights keeps all the cores busy. Each run is encoded by its
+    own ffmpeg process, and when all the runs for a folder are done they are joined with
+    the concat demuxer, which just copies the streams. All the segments must be encoded with
+    the same settings to be joined, so the software encoder is used by default rather than
+    the one selected for the host.
+
+    Each ffmpeg process is limited to one thread, and by default one core is left free, so
+    the segments don't starve the capture loop. The denoiser averages over time, so each
+    segment after the first is fed the leadin frames before it as well, and these are
+    dropped after filtering, so that the denoising doesn't restart at each join.
+
+    Parameters:
+        folders [list]  - (capture folder, timelapse name) pairs
+        fps     [int]   - frame rate of the timelapses
+        workers [int]   - number of segments to encode at once, default one less than the
+                            number of cores
+        vcodec  [list]  - ffmpeg encoder arguments
+
+    Returns:
+        dict of timelapse name to whether it was built
+    """
+    workers = workers or max(1, (os.cpu_count() or 1) - 1)
+    if '-threads' not in vcodec:
+        vcodec = vcodec + ['-threads', '1']
+    results = {}
+    pending = {}
+    tmpdirs = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for dirname, mp4name in folders:
+            jpgs = goodFrames(dirname)
+            if not jpgs:
+                log.warning(f'no images in {dirname}')
+                results[mp4name] = False
+                continue
+            tmpdirs[mp4name] = tempfile.mkdtemp(dir=dirname, prefix='.tlsegments')
+            runs = segmentFrames(jpgs, workers)
+            segments = [os.path.join(tmpdirs[mp4name], f'seg{i:04d}.mp4') for i in range(len(runs))]
+            pending[mp4name] = [segments, len(runs)]
+            log.info(f'encoding {len(jpgs)} frames from {dirname} in {len(runs)} segments')
+            start = 0
+            for run, seg in zip(runs, segments):
+                skip = min(start, leadin)
+                futures[pool.submit(encodeFrames, jpgs[start - skip:start] + run, seg, fps, vcodec, skip)] = mp4name
+                start += len(run)
+        for future in as_completed(futures):
+            mp4name = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                log.warning(f'unable to encode part of {mp4name}')
+                log.info(e, exc_info=True)
+                results[mp4name] = False
+            pending[mp4name][1] -= 1
+            if pending[mp4name][1] > 0:
+                continue
+            if results.get(mp4name, True):
+                try:
+                    _joinSegments(pending[mp4name][0], mp4name)
+                    results[mp4name] = True
+                    log.info(f'saved to {mp4name}')
+                except Exception as e:
+                    log.warning(f'unable to join segments of {mp4name}')
+                    log.info(e, exc_info=True)
+                    results[mp4name] = False
+            shutil.rmtree(tmpdirs[mp4name], ignore_errors=True)
+    return results
+
+
+def _benchmarkCmd(backend, outname, sampledir=None, nframes=100):
+    """ ffmpeg command line to encode nframes from sampledir, or from a test pattern, with a backend """
+    if sampledir is not None:
+        inputs = ['-framerate', '60', '-pattern_type', 'glob', '-i', os.path.join(sampledir, '*.jpg')]
+    else:
+        inputs = ['-f', 'lavfi', '-i', 'testsrc2=size=1920x1080:rate=60']
+    return ['ffmpeg', '-v', 'quiet', '-y'] + inputs + ['-frames:v', str(nframes)] + backends[backend] + \
+        ['-vf', tlfilter, outname]
+
+
+def benchmarkBackends(sampledir=None, nframes=100, names=None):
+    """
+    Time each encoder backend on the same frames.
+
+    Parameters:
+        sampledir   [string] - folder of JPEGs to encode, by default a 1080p test pattern
+        nframes     [int]    - number of frames to encode
+        names       [list]   - backends to try, default all of them
+
+    Returns:
+        dict of backend name to (seconds, output bytes), or None if the backend failed
+    """
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in names or list(backends.keys()):
+            outname = os.path.join(tmpdir, f'{name}.mp4')
+            starttime = time.monotonic()
+            try:
+                ret = subprocess.run(_benchmarkCmd(name, outname, sampledir, nframes), timeout=600,
+                                     stdin=subprocess.DEVNULL).returncode
+            except Exception as e:
+                log.info(e, exc_info=True)
+                ret = -1
+            elapsed = time.monotonic() - starttime
+            if ret == 0 and os.path.isfile(outname) and os.path.getsize(outname) > 0:
+                results[name] = (elapsed, os.path.getsize(outname))
+            else:
+                results[name] = None
+            log.info(f'encoder {name}: {"failed" if results[name] is None else f"{elapsed:.1f}s"}')
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+def _loadCache(cachefile):
+    try:
+        return json.load(open(cachefile))
+    except Exception:
+        return {}
+
+
+def saveBackend(name, results=None, cachefile=encodercache):
+    """ record the backend to use on this host """
+    cache = _loadCache(cachefile)
+    cache[platform.uname().node] = {'backend': name, 'results': results}
+    try:
+        json.dump(cache, open(cachefile, 'w'), indent=2)
+    except Exception as e:
+        log.warning(f'unable to save {cachefile}')
+        log.info(e, exc_info=True)
+
+
+def savedBackend(cachefile=encodercache):
+    """ the encoder backend saved for this host, or None if the encoders haven't been benchmarked """
+    cached = _loadCache(cachefile).get(platform.uname().node)
+    if cached is not None and cached.get('backend') in backends:
+        return cached['backend']
+    return None
+
+
+def selectBackend(cachefile=encodercache, refresh=False):
+    """
+    The encoder backend to use on this host. The first time this is called on a host, or if
+    refresh is set, the backends are benchmarked and the fastest one is saved in cachefile.
+    This can take several minutes, so it should be run as a background job.
+    """
+    name = savedBackend(cachefile)
+    if name is not None and not refresh:
+        return name
+    log.info('benchmarking timelapse encoders, this only happens once')
+    results = benchmarkBackends()
+    working = [(res[0], name) for name, res in results.items() if res is not None]
+    name = min(working)[1] if working else defaultbackend
+    log.info(f'using {name} to encode timelapses')
+    saveBackend(name, results, cachefile)
+    return name
+
+
+def encoderArgs(cachefile=encodercache):
+    """
+    The ffmpeg encoder arguments for the backend selected for this host, or the default
+    until selectBackend has benchmarked the encoders. This never runs the benchmark itself.
+    """
+    try:
+        return backends[savedBackend(cachefile) or defaultbackend]
+    except Exception as e:
+        log.warning('unable to select a timelapse encoder, using the default')
+        log.info(e, exc_info=True)
+        return backends[defaultbackend]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        sampledir = sys.argv[2] if len(sys.argv) > 2 else None
+        nframes = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+        results = benchmarkBackends(sampledir, nframes)
+        for name, res in results.items():
+            if res is None:
+                print(f'{name:10s} not available')
+            else:
+                print(f'{name:10s} {res[0]:6.1f}s  {nframes/res[0]:6.1f} fps  {res[1]/1048576:6.1f} MB')
+        working = [(res[0], name) for name, res in results.items() if res is not None]
+        if working:
+            saveBackend(min(working)[1], results)
+            print(f'{min(working)[1]} will be used for timelapses on this host')
+    elif len(sys.argv) > 2 and sys.argv[1] == 'use' and sys.argv[2] in backends:
+        saveBackend(sys.argv[2])
+        print(f'{sys.argv[2]} will be used for timelapses on this host')
+    else:
+        print('usage: python timelapseEncoder.py benchmark [sample folder] [number of frames]')
+        print(f'       python timelapseEncoder.py use {"|".join(backends.keys())}')
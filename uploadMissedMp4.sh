@@ -5,8 +5,9 @@ here="$( cd "$(dirname "$0")" >/dev/null 2>&1 ; pwd -P )"
 
 source ~/vAuroracam/bin/activate
 
-# Takes two arguments:
-#   the datetime for which tyou want to upload eg 20250115_162343
-#   0 or 1: 0 will upload the mp4 if it exists, while 1 will force recreation of the mp4 and then upload
+# Takes two or more arguments:
+#   the datetime for which tyou want to upload eg 20250115_162343, or several of them
+#   0, 1 or 2: 0 will upload the mp4 if it exists, while 1 will force recreation of the mp4 and then upload
+#   2 recreates the mp4s in parallel segments, which is much quicker for a backlog of several nights
 
-python $here/redoTimelapse.py $1 $2
+python $here/redoTimelapse.py "$@"